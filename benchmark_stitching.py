@@ -0,0 +1,231 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Benchmark for the stitching pipeline. Generates a synthetic mosaic in the directory layout read by
+get_section_data and create_section_json, times every section through stitch_section as the pipeline
+runs it, then again stage by stage, and writes the timings to a JSON file so runs can be compared
+against each other.
+
+call as: python benchmark_stitching.py --output benchmark.json {--rows 4 --columns 4 --channels 4 --sections 2}
+"""
+
+# Standard library imports
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+logging.getLogger().setLevel(logging.INFO)
+
+# Third party imports
+import cv2
+import numpy as np
+import SimpleITK as sitk
+
+# Custom imports
+import run_tissuecyte_stitching_classic as stitching
+from deformation import DeformationCorrector, load_deformation_map, load_deformation_operator
+from stitcher import Stitcher
+from tile import TileTable
+
+
+TILE_SHAPE = (832, 832)
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the stitching pipeline on a synthetic mosaic')
+    parser.add_argument('--output', default='benchmark.json', type=str,
+                        help='path of the JSON file with the timings')
+    parser.add_argument('--data_dir', default=None, type=str,
+                        help='where to generate the synthetic mosaic. A temporary directory is used if not provided.')
+    parser.add_argument('--rows', default=4, type=int, help='tile rows per section')
+    parser.add_argument('--columns', default=4, type=int, help='tile columns per section')
+    parser.add_argument('--channels', default=4, type=int, help='channels per tile')
+    parser.add_argument('--sections', default=2, type=int, help='number of sections')
+    parser.add_argument('--layers', default=1, type=int, help='layers imaged per section')
+    parser.add_argument('--n_threads', default=-3, type=int, help='workers for discovery and average tiles')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the synthetic tiles')
+    parser.add_argument('--bezier_path', default='bezier16x.pkl', type=str, help='Bezier patch file')
+    parser.add_argument('--deformation_backend', default='sparse', choices=['sparse', 'numba'], type=str,
+                        help='deformation correction backend')
+    parser.add_argument('--tile_workers', default=1, type=int, help='threads reading and processing the tiles of a section')
+    parser.add_argument('--canvas', default='memory', choices=['memory', 'memmap'], type=str, help='section image canvas')
+    return parser
+
+
+def generate_synthetic_tile(rng: np.random.Generator, tissue: np.ndarray) -> np.ndarray:
+    """Generates a tile with smooth background, brighter tissue and sparse bright cells.
+
+    Args:
+        rng (np.random.Generator): Random generator
+        tissue (np.ndarray): Tissue mask of the tile position
+
+    Returns:
+        np.ndarray: Tile image array
+    """
+    im = cv2.GaussianBlur(rng.random(TILE_SHAPE), (0, 0), 6) * 20 + 5
+    im = im + tissue * 150
+    ys, xs = rng.integers(0, TILE_SHAPE[0], (2, 300))
+    im[ys, xs] += rng.uniform(500, 5000, len(ys))
+    im = cv2.GaussianBlur(im, (0, 0), 1.0) * 3
+    return np.clip(im, 0, 65535).astype(np.uint16)
+
+
+def generate_synthetic_mosaic(root_dir: str, sections: int, rows: int, columns: int, channels: int,
+                              layers: int = 1, seed: int = 0, sample_id: str = 'S1'):
+    """Writes a Mosaic_*.txt file and the section directories of tiles named like the acquisition
+    (<sample>-<section>/<sample>-<index>_<channel>.tif).
+
+    Args:
+        root_dir (str): Directory to generate the mosaic in
+        sections (int): Number of sections
+        rows (int): Tile rows per section
+        columns (int): Tile columns per section
+        channels (int): Channels per tile
+        layers (int, optional): Layers imaged per section. Defaults to 1.
+        seed (int, optional): Seed of the synthetic tiles. Defaults to 0.
+        sample_id (str, optional): Sample ID. Defaults to 'S1'.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(root_dir, exist_ok=True)
+    with open(os.path.join(root_dir, 'Mosaic_{}.txt'.format(sample_id)), 'w') as fp:
+        fp.write('Sample ID:{}\nmrows:{}\nmcolumns:{}\nlayers:{}\nchannels:{}\n'.format(
+            sample_id, rows, columns, layers, channels))
+
+    for sno in range(sections):
+        section_dir = os.path.join(root_dir, '{}-{:04d}'.format(sample_id, sno + 1))
+        os.makedirs(section_dir, exist_ok=True)
+        for layer in range(layers):
+            for k in range(rows * columns):
+                index = (sno * layers + layer) * rows * columns + k
+                tissue = cv2.GaussianBlur(rng.random(TILE_SHAPE), (0, 0), 40) > 0.5
+                for ch in range(channels):
+                    im = generate_synthetic_tile(rng, tissue)
+                    path = os.path.join(section_dir, '{}-{}_{:02d}.tif'.format(sample_id, index, ch + 1))
+                    sitk.WriteImage(sitk.GetImageFromArray(im), path)
+
+
+class StageTimer(object):
+
+    def __init__(self):
+
+        self.seconds = {}
+
+
+    def time(self, stage: str, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+        return result
+
+
+def benchmark_section(data: dict, avg_tiles: list, deformation: DeformationCorrector, output_dir: str,
+                      timer: StageTimer, thresh: int = 15) -> int:
+    """Runs the stages of stitch_section one after another so each one is timed on its own. The positions
+    are read and processed serially, without the prefetch and the thread pools of generate_tiles, and
+    the section is blended only once all of them are processed, so the stage times add up to more than
+    the time of stitch_section.
+
+    Args:
+        data (dict): Section data
+        avg_tiles (list): List of average tiles for each channel
+        deformation (DeformationCorrector): Deformation correction shared by every tile
+        output_dir (str): Directory for the stitched sections
+        timer (StageTimer): Timer accumulating the stage durations
+        thresh (int, optional): Background threshold. Defaults to 15.
+
+    Returns:
+        int: Number of tiles processed
+    """
+    groups = stitching.get_tile_groups(data['tiles'])
+    tiles = []
+    for group in groups:
+        images = timer.time('read', stitching.read_tile_group, group)
+        tiles.append(timer.time('process', stitching.process_tile_group, group, images, avg_tiles, deformation,
+                                thresh))
+
+    table = TileTable.from_groups(groups)
+    channels = sorted(set(table.channels.tolist()))
+    stitcher = Stitcher(data['image_dimensions'], table, iter(tiles), [c + 1 for c in channels])
+    image, _ = timer.time('blend', stitcher.run)
+
+    for i, ch in enumerate(channels):
+        path = os.path.join(output_dir, '{}_{}.tif'.format(data['slice_fname'], ch))
+        timer.time('write', stitching.write_output, np.ascontiguousarray(image[:, :, i]), path)
+    return sum(len(group) for group in groups)
+
+
+def main():
+    args = arg_parser().parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='stitching_benchmark_')
+    data_dir = args.data_dir if args.data_dir is not None else os.path.join(work_dir, 'data')
+    output_dir = os.path.join(work_dir, 'output')
+    os.makedirs(output_dir)
+
+    try:
+        timer = StageTimer()
+        print("Generating synthetic mosaic in {}".format(data_dir))
+        timer.time('synthetic_data', generate_synthetic_mosaic, data_dir, args.sections, args.rows, args.columns,
+                   args.channels, args.layers, args.seed)
+
+        _, section_jsons = timer.time('discovery', stitching.get_section_data, os.path.join(data_dir, ''),
+                                      args.n_threads, args.layers, -1, os.path.join(output_dir, 'tile_index'))
+
+        avg_tiles_dir = os.path.join(output_dir, 'avg_tiles')
+        timer.time('average_tiles', stitching.generate_avg_tiles, section_jsons, avg_tiles_dir, args.n_threads,
+                   regenerate=True)
+        avg_tiles = [stitching.load_average_tile(os.path.join(avg_tiles_dir, 'avg_tile_{}.tif'.format(i)))
+                     for i in range(4)]
+
+        corners1 = np.asarray([[33, 10], [796, 21], [30, 813], [793, 818]])
+        corners2 = np.asarray([[20, 20], [776, 20], [20, 794], [776, 794]])
+        H, _ = cv2.findHomography(corners1, corners2)
+        pX_, pY_ = timer.time('deformation_map', load_deformation_map, args.bezier_path)
+        # The lookup operator is built once for the run, as publish_shared_state does
+        operator = timer.time('deformation_operator', load_deformation_operator, pX_, pY_)
+        deformation = DeformationCorrector(H, pX_, pY_, backend=args.deformation_backend, operator=operator)
+        # The kernel is compiled before the tiles are timed
+        timer.time('deformation_init', deformation.correct, np.zeros(TILE_SHAPE, dtype=np.float32))
+
+        for ch in range(args.channels):
+            os.makedirs(os.path.join(output_dir, 'stitched_ch{}'.format(ch)), exist_ok=True)
+        stages_dir = os.path.join(output_dir, 'stages')
+        os.makedirs(stages_dir)
+
+        ntiles = 0
+        for data in section_jsons:
+            timer.time('stitch_section', stitching.stitch_section, data, avg_tiles, output_dir, H, pX_, pY_,
+                       canvas=args.canvas, n_workers=args.tile_workers, deformation_backend=args.deformation_backend,
+                       operator=operator)
+            ntiles += benchmark_section(data, avg_tiles, deformation, stages_dir, timer)
+
+        results = {'parameters': vars(args),
+                   'system': {'platform': platform.platform(),
+                              'python': platform.python_version(),
+                              'numpy': np.__version__,
+                              'opencv': cv2.__version__,
+                              'cpu_count': os.cpu_count()},
+                   'tiles': ntiles,
+                   'seconds': timer.seconds,
+                   'ms_per_tile': {stage: 1000 * timer.seconds[stage] / ntiles
+                                   for stage in ('stitch_section', 'read', 'process') if ntiles > 0}}
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=1)
+
+        for stage, seconds in timer.seconds.items():
+            print("{:>20}: {:8.3f} s".format(stage, seconds))
+        print("Results written to {}".format(args.output))
+        return 0
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -35,6 +35,7 @@ from joblib import Parallel, delayed
 
 import cellAnalysis.StructureElement as se
 from ng_utils import *
+from tif_reader import read_section_tif
 def arg_parser():
     parser = argparse.ArgumentParser(description='Cell Counting Argments')
     parser.add_argument('--img_dir', type=str,
@@ -112,16 +113,9 @@ def createShardedPointAnnotation(points, output_directory ):
 
 def readSectionTif( file_path):
     """
-    Read tif section image using SITK
+    Read tif section image through tifffile, which also decodes the tiled sections SITK misreads
     """
-    image = sitk.ReadImage(str(file_path))
-    image = sitk.GetArrayFromImage(image)
-    image[image<0] = 0
-    image = image.T
-    image = np.flip(image,axis=0)
-    image = np.flip(image,axis=1)
-    image  = np.squeeze(image)
-    return image
+    return read_section_tif(file_path)
 
 
 def remove_background(source, shape =(10,10), form = 'Disk'):
@@ -0,0 +1,528 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Deformation correction for individual tiles. The Bezier patch lookup only depends on the
+homography and the Bezier parameters, which are fixed for a whole run, so the deformation map and
+the sparse lookup operator built from it are cached next to the Bezier patch file and reused for
+every tile.
+
+The lookup is applied either as a sparse operator or, when numba is installed, by a compiled
+parallel kernel that gathers, weights and downsamples the tile into preallocated buffers.
+"""
+
+# Standard library imports
+import os
+import hashlib
+import logging
+import threading
+
+# Third party imports
+import cv2
+import joblib
+import numpy as np
+import scipy.sparse
+from scipy.special import binom
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Region of the homography-warped tile that is kept before Bezier correction
+WARP_CROP = (slice(20, 794), slice(20, 776))
+TILE_SHAPE = (774, 756)
+BACKENDS = ('sparse', 'numba')
+
+
+def bernstein(u, n: int, k: int) -> float:
+    """Bernstein polynomial for deformation mapping.
+
+    Args:
+        u (_type_): Input value
+        n (int): Top binomial coefficient
+        k (int): Bottom binomial coefficient
+
+    Returns:
+        float: Bernstein polynomial output
+    """
+    return binom(n, k) * u**k * (1 - u)**(n - k)
+
+
+def barray(u: np.ndarray, v: np.ndarray, n: int, m: int) -> np.ndarray:
+    """Generates a Bernstein polynomial matrix.
+
+    Args:
+        u (np.ndarray): _description_
+        v (np.ndarray): _description_
+        n (int): _description_
+        m (int): _description_
+
+    Returns:
+        np.ndarray: Output matrix
+    """
+    bu = bernstein_basis(u, n)
+    bv = bernstein_basis(v, m)
+    return np.reshape(bu[:, :, np.newaxis] * bv[:, np.newaxis, :], (len(u), (n + 1) * (m + 1)))
+
+
+def bernstein_basis(u: np.ndarray, n: int) -> np.ndarray:
+    """Evaluates every Bernstein polynomial of degree n.
+
+    Args:
+        u (np.ndarray): Input values
+        n (int): Polynomial degree
+
+    Returns:
+        np.ndarray: Basis matrix of shape (len(u), n + 1)
+    """
+    return bernstein(np.asarray(u, dtype=np.float64)[:, np.newaxis], n, np.arange(n + 1))
+
+
+def get_deformation_map(width: int, height: int, kx, ky) -> tuple:
+    """Retrieves deformation map for image correction. The Bezier patch is a tensor product, so
+    it is evaluated separably on the 2x supersampled grid instead of building the full Bernstein
+    matrix for every pixel.
+
+    Args:
+        width (int): Width of map
+        height (int): Height of map
+        kx (_type_): Bezier patch parameters
+        ky (_type_): Bezier patch parameters
+
+    Returns:
+        tuple: _description_
+    """
+    # u runs along the columns (fast axis) and v along the rows of the supersampled grid
+    bu = bernstein_basis(np.arange(2 * height) / (2 * float(height)), 4)
+    bv = bernstein_basis(np.arange(2 * width) / (2 * float(width)), 4)
+
+    # pX_[row, col] = sum_ij bu[col, i] * bv[row, j] * kx[i * 5 + j]
+    pX_ = np.ravel(bv @ np.reshape(kx, (5, 5)).T @ bu.T)
+    pY_ = np.ravel(bv @ np.reshape(ky, (5, 5)).T @ bu.T)
+    pX_ = pX_ * height
+    pY_ = pY_ * width
+    # Clip values
+    pX_[pX_ <= 0] = 0
+    pX_[pX_ >= height - 1] = height - 1
+    pY_[pY_ <= 0] = 0
+    pY_[pY_ >= width - 1] = width -1
+
+    return pX_, pY_
+
+
+def build_deformation_operator(pX_: np.ndarray, pY_: np.ndarray, shape: tuple, 
+                               dtype=np.float64) -> scipy.sparse.csr_matrix:
+    """Builds the sparse operator mapping a warped tile onto the 2x supersampled Bezier grid.
+
+    Each supersampled pixel is a 4-tap combination of the warped tile using the same indices and
+    weights as correct_deformation, so applying the operator reproduces its gather exactly.
+
+    Args:
+        pX_ (np.ndarray): Bezier x coordinates for every supersampled pixel
+        pY_ (np.ndarray): Bezier y coordinates for every supersampled pixel
+        shape (tuple): (rows, columns) of the warped tile
+        dtype (optional): dtype of the weights. Defaults to np.float64.
+
+    Returns:
+        scipy.sparse.csr_matrix: Operator of shape (len(pX_), rows * columns)
+    """
+    h, w = shape
+    x1 = np.floor(pX_).astype(np.int64)
+    x2 = np.ceil(pX_).astype(np.int64)
+    y1 = np.floor(pY_).astype(np.int64)
+    y2 = np.ceil(pY_).astype(np.int64)
+
+    dx1 = pX_ - x1
+    dx2 = x2 - pX_
+    dy1 = pY_ - y1
+    dy2 = y2 - pY_
+    dx1[y1 == y2] = 1
+    dy1[x1 == x2] = 1
+
+    indices = np.stack([y1 * w + x1, y1 * w + x2, y2 * w + x1, y2 * w + x2], axis=1)
+    weights = np.stack([dx1 * dy1, dx2 * dy1, dy2 * dx1, dy2 * dx2], axis=1).astype(dtype)
+    indptr = np.arange(0, indices.size + 1, 4)
+    return scipy.sparse.csr_matrix((weights.ravel(), indices.ravel().astype(np.int32), indptr),
+                                   shape=(len(pX_), h * w))
+
+
+def downsample_supersampled(im: np.ndarray) -> np.ndarray:
+    """Halves a supersampled image. Matches skimage resize with anti-aliasing, which smooths with a
+    sigma 0.5 Gaussian (mirrored borders) before averaging each 2x2 block.
+
+    Args:
+        im (np.ndarray): Supersampled image array
+
+    Returns:
+        np.ndarray: Downsampled image array
+    """
+    h, w = im.shape[0] // 2, im.shape[1] // 2
+    im = cv2.GaussianBlur(im, (5, 5), 0.5, borderType=cv2.BORDER_REFLECT_101)
+    return cv2.resize(im, (w, h), interpolation=cv2.INTER_AREA)
+
+
+def get_downsample_taps() -> np.ndarray:
+    """Weights of the supersampled rows 2i-2 to 2i+3 combined into row i by downsample_supersampled,
+    the same along the columns. The Gaussian smoothing and the 2x2 average fold into one 6-tap filter.
+
+    Returns:
+        np.ndarray: Filter taps
+    """
+    gauss = cv2.getGaussianKernel(5, 0.5, cv2.CV_64F).ravel()
+    taps = np.zeros(6)
+    taps[:-1] += 0.5 * gauss
+    taps[1:] += 0.5 * gauss
+    return taps
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _reflect(i, n):
+        # Mirrored border without repeating the edge, like cv2.BORDER_REFLECT_101
+        if i < 0:
+            return -i
+        if i >= n:
+            return 2 * (n - 1) - i
+        return i
+
+
+    @numba.njit(parallel=True, cache=True)
+    def warp_kernel(im_warp, pX_, pY_, taps, supersampled, rows, out):
+        """Bezier correction of a warped tile, the lookup of correct_deformation followed by
+        downsample_supersampled, written into the given buffers. The first pass gathers and weights
+        the supersampled tile, the second filters each output row from it, both in parallel over rows.
+
+        Args:
+            im_warp (np.ndarray): Cropped homography-warped tile
+            pX_ (np.ndarray): Bezier x coordinates for every supersampled pixel
+            pY_ (np.ndarray): Bezier y coordinates for every supersampled pixel
+            taps (np.ndarray): Filter taps from get_downsample_taps
+            supersampled (np.ndarray): (2 * rows, 2 * columns) buffer for the supersampled tile
+            rows (np.ndarray): (rows, 2 * columns + 4) buffer for the tile filtered along the rows, 
+                               with mirrored borders
+            out (np.ndarray): (rows, columns) corrected tile
+        """
+        hs, ws = supersampled.shape
+        for i in numba.prange(hs):
+            for j in range(ws):
+                k = i * ws + j
+                x, y = pX_[k], pY_[k]
+                # The coordinates are clipped to the tile, so truncation is the floor
+                x1, y1 = int(x), int(y)
+                x2 = x1 + 1 if x > x1 else x1
+                y2 = y1 + 1 if y > y1 else y1
+                dx1, dx2 = x - x1, x2 - x
+                dy1, dy2 = y - y1, y2 - y
+                if y1 == y2:
+                    dx1 = 1.0
+                if x1 == x2:
+                    dy1 = 1.0
+                supersampled[i, j] = (im_warp[y1, x1] * dx1 * dy1 + im_warp[y1, x2] * dx2 * dy1 +
+                                      im_warp[y2, x1] * dy2 * dx1 + im_warp[y2, x2] * dy2 * dx2)
+
+        for i in numba.prange(out.shape[0]):
+            row = rows[i]
+            for j in range(ws):
+                row[j + 2] = 0.0
+            for t in range(taps.size):
+                r = _reflect(2 * i - 2 + t, hs)
+                for j in range(ws):
+                    row[j + 2] += taps[t] * supersampled[r, j]
+            row[0], row[1] = row[4], row[3]
+            row[ws + 2], row[ws + 3] = row[ws], row[ws - 1]
+            for j in range(out.shape[1]):
+                total = 0.0
+                for t in range(taps.size):
+                    total += taps[t] * row[2 * j + t]
+                out[i, j] = total
+
+
+class DeformationCorrector(object):
+
+    def __init__(self, H, pX_, pY_, shape=TILE_SHAPE, dtype=np.float32, backend='sparse', operator=None):
+
+        self.H = np.asarray(H, dtype=np.float64)
+        self.pX_ = pX_
+        self.pY_ = pY_
+        self.shape = tuple(shape)
+
+        # working dtype of the corrected tiles, float64 matches correct_deformation to rounding error
+        self.dtype = np.dtype(dtype)
+
+        if backend not in BACKENDS:
+            raise ValueError('backend must be one of {0}'.format(BACKENDS))
+        if backend == 'numba' and numba is None:
+            logging.warning('numba is not installed, correcting deformation with the sparse operator')
+            backend = 'sparse'
+        self.backend = backend
+
+        # lookup shared by every tile of the run, built on first use unless it was built once for the run
+        if operator is not None and operator.dtype != self.dtype:
+            operator = operator.astype(self.dtype)
+        self._operator = operator
+        # coordinates of the numba kernel, built on first use, and scratch buffers of every thread
+        self._kernel_args = None
+        self._scratch = threading.local()
+        # the workqueue threading layer of numba aborts on kernels launched from several threads at once
+        self._workqueue_lock = threading.Lock()
+        # remap coordinates of the downsampled correction, by factor and tile shapes
+        self._downsampled_maps = {}
+
+
+    @property
+    def operator(self):
+        if self._operator is None:
+            self._operator = build_deformation_operator(self.pX_, self.pY_, self.shape, self.dtype)
+        return self._operator
+
+
+    @property
+    def kernel_args(self):
+        if self._kernel_args is None:
+            h, w = self.shape
+            self._kernel_args = (np.ascontiguousarray(self.pX_, dtype=np.float64), 
+                                 np.ascontiguousarray(self.pY_, dtype=np.float64), 
+                                 get_downsample_taps())
+        return self._kernel_args
+
+
+    def get_scratch(self) -> tuple:
+        """Scratch buffers of the numba kernel for the calling thread, so threads correct tiles concurrently.
+
+        Returns:
+            tuple: Supersampled tile and row filtered tile buffers
+        """
+        if not hasattr(self._scratch, 'buffers'):
+            h, w = self.shape
+            self._scratch.buffers = (np.empty((2 * h, 2 * w), dtype=self.dtype), 
+                                     np.empty((h, 2 * w + 4), dtype=self.dtype))
+        return self._scratch.buffers
+
+
+    def run_kernel(self, im_warp: np.ndarray, out: np.ndarray):
+        args = (im_warp,) + self.kernel_args + self.get_scratch() + (out,)
+        try:
+            workqueue = numba.threading_layer() == 'workqueue'
+        except ValueError:
+            # No parallel kernel has run yet, so the threading layer is not chosen
+            workqueue = True
+        if workqueue:
+            with self._workqueue_lock:
+                warp_kernel(*args)
+        else:
+            warp_kernel(*args)
+
+
+    def build(self):
+        """Builds the lookup of the backend up front, so threads correcting tiles do not race to build it."""
+        if self.backend == 'numba':
+            # Compiles the kernel and starts its thread pool from this thread, as the TBB threading layer
+            # hangs at exit when its pool was started from a worker thread
+            self.run_kernel(np.zeros(self.shape, dtype=self.dtype), np.empty(self.shape, dtype=self.dtype))
+        else:
+            self.operator
+
+
+    def correct(self, im0: np.ndarray) -> np.ndarray:
+        """Corrects deformation of a single tile. Equivalent to correct_deformation, the original correction kept 
+        as reference in tests/test_deformation.py, with a float64 dtype, within rounding error with float32.
+
+        Args:
+            im0 (np.ndarray): Image array
+
+        Returns:
+            np.ndarray: Deformation corrected image
+        """
+        h, w = self.shape
+        im_warp = cv2.warpPerspective(im0, self.H, (im0.shape[1], im0.shape[0]))
+        im_warp = im_warp[WARP_CROP]
+
+        if self.backend == 'numba':
+            out = np.empty(self.shape, dtype=self.dtype)
+            self.run_kernel(np.ascontiguousarray(im_warp, dtype=self.dtype), out)
+            return out
+
+        im = self.operator.dot(np.ravel(im_warp).astype(self.dtype, copy=False))
+        return downsample_supersampled(np.reshape(im, (2 * h, 2 * w)))
+
+
+    def get_downsampled_maps(self, factor: int, raw_shape: tuple, small_shape: tuple) -> tuple:
+        """Remap coordinates of the correction at 1/factor resolution. The homography, the crop, the 
+        Bezier lookup and the supersampling are folded into one map from every pixel of the downsampled 
+        corrected tile to the downsampled raw tile.
+
+        Args:
+            factor (int): Downsampling factor
+            raw_shape (tuple): (rows, columns) of the raw tile
+            small_shape (tuple): (rows, columns) of the downsampled raw tile
+
+        Returns:
+            tuple: x and y float32 maps for cv2.remap
+        """
+        key = (factor, tuple(raw_shape), tuple(small_shape))
+        if key not in self._downsampled_maps:
+            h, w = self.shape
+            rows, cols = -(-h // factor), -(-w // factor)
+            # Centre of every downsampled pixel on the 2x supersampled grid
+            grid_y = (2 * factor * np.arange(rows) + factor - 0.5).astype(np.float32)
+            grid_x = (2 * factor * np.arange(cols) + factor - 0.5).astype(np.float32)
+            grid_x, grid_y = np.meshgrid(grid_x, grid_y)
+            pX_ = np.reshape(self.pX_, (2 * h, 2 * w)).astype(np.float32)
+            pY_ = np.reshape(self.pY_, (2 * h, 2 * w)).astype(np.float32)
+            x = cv2.remap(pX_, grid_x, grid_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            y = cv2.remap(pY_, grid_x, grid_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+            # Cropped warped tile to raw tile through the inverse homography
+            points = np.stack([x.ravel() + WARP_CROP[1].start, y.ravel() + WARP_CROP[0].start], axis=-1)
+            points = cv2.perspectiveTransform(points[np.newaxis].astype(np.float64), np.linalg.inv(self.H))[0]
+
+            # Raw tile to downsampled raw tile, with pixel centres at the centre of their area
+            scale_y, scale_x = raw_shape[0] / float(small_shape[0]), raw_shape[1] / float(small_shape[1])
+            map_x = ((points[:, 0] + 0.5) / scale_x - 0.5).reshape(rows, cols).astype(np.float32)
+            map_y = ((points[:, 1] + 0.5) / scale_y - 0.5).reshape(rows, cols).astype(np.float32)
+            self._downsampled_maps[key] = (map_x, map_y)
+        return self._downsampled_maps[key]
+
+
+    def correct_downsampled(self, small: np.ndarray, factor: int, raw_shape: tuple) -> np.ndarray:
+        """Corrects deformation of a tile downsampled by factor, for previews. Matches correct followed 
+        by downsampling to within interpolation error.
+
+        Args:
+            small (np.ndarray): Downsampled raw tile image array
+            factor (int): Downsampling factor
+            raw_shape (tuple): (rows, columns) of the raw tile
+
+        Returns:
+            np.ndarray: Corrected tile at 1/factor resolution
+        """
+        map_x, map_y = self.get_downsampled_maps(factor, raw_shape, small.shape[:2])
+        return cv2.remap(small.astype(self.dtype, copy=False), map_x, map_y, cv2.INTER_LINEAR,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+def get_deformation_cache_path(bezier_path: str, shape: tuple = TILE_SHAPE) -> str:
+    """Path of the cached deformation map stored next to the Bezier patch file. The name is keyed
+    by the content hash of the Bezier patch file and the grid size.
+
+    Args:
+        bezier_path (str): Bezier patch file path
+        shape (tuple, optional): (rows, columns) of the corrected tile. Defaults to TILE_SHAPE.
+
+    Returns:
+        str: Cache file path
+    """
+    with open(bezier_path, 'rb') as fp:
+        digest = hashlib.sha1(fp.read()).hexdigest()[:16]
+    return "{0}_deformation_{1}_{2}x{3}.npz".format(os.path.splitext(bezier_path)[0], digest, *shape)
+
+
+def load_deformation_map(bezier_path: str, shape: tuple = TILE_SHAPE) -> tuple:
+    """Loads the cached deformation map for a Bezier patch file, computing and caching it if missing.
+
+    Args:
+        bezier_path (str): Bezier patch file path
+        shape (tuple, optional): (rows, columns) of the corrected tile. Defaults to TILE_SHAPE.
+
+    Returns:
+        tuple: pX_ and pY_ deformation maps
+    """
+    cache_path = get_deformation_cache_path(bezier_path, shape)
+
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as data:
+                logging.info('Loading cached deformation map from {0}'.format(cache_path))
+                return data['pX_'], data['pY_']
+        except (IOError, OSError, KeyError, ValueError) as err:
+            logging.warning('Could not read cached deformation map {0}: {1}'.format(cache_path, err))
+
+    logging.info('Computing deformation map from {0}'.format(bezier_path))
+    kx, ky = joblib.load(bezier_path)
+    pX_, pY_ = get_deformation_map(shape[0], shape[1], kx, ky)
+    try:
+        np.savez(cache_path, pX_=pX_, pY_=pY_)
+    except (IOError, OSError) as err:
+        logging.warning('Could not cache deformation map to {0}: {1}'.format(cache_path, err))
+    return pX_, pY_
+
+
+def get_operator_cache_path(pX_: np.ndarray, pY_: np.ndarray, shape: tuple, dtype, cache_dir: str) -> str:
+    """Path of the cached deformation operator. The name is keyed by the content hash of the deformation 
+    map, the tile shape and the dtype of the weights, which are all the operator depends on.
+
+    Args:
+        pX_ (np.ndarray): Bezier x coordinates for every supersampled pixel
+        pY_ (np.ndarray): Bezier y coordinates for every supersampled pixel
+        shape (tuple): (rows, columns) of the warped tile
+        dtype (optional): dtype of the weights
+        cache_dir (str): Directory of the cache file, e.g. the directory of the Bezier patch file
+
+    Returns:
+        str: Cache file path
+    """
+    digest = hashlib.sha1()
+    for array in (pX_, pY_):
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return os.path.join(cache_dir, "deformation_operator_{0}_{1}x{2}_{3}.npz".format(
+        digest.hexdigest()[:16], shape[0], shape[1], np.dtype(dtype).name))
+
+
+def load_deformation_operator(pX_: np.ndarray, pY_: np.ndarray, shape: tuple = TILE_SHAPE, dtype=np.float32, 
+                              cache_dir: str = None) -> scipy.sparse.csr_matrix:
+    """Loads the cached deformation operator for a deformation map, building and caching it if missing.
+
+    Args:
+        pX_ (np.ndarray): Bezier x coordinates for every supersampled pixel
+        pY_ (np.ndarray): Bezier y coordinates for every supersampled pixel
+        shape (tuple, optional): (rows, columns) of the warped tile. Defaults to TILE_SHAPE.
+        dtype (optional): dtype of the weights. Defaults to np.float32.
+        cache_dir (str, optional): Directory of the cache file. If None, the operator is built without caching. 
+                                   Defaults to None.
+
+    Returns:
+        scipy.sparse.csr_matrix: Operator of shape (len(pX_), rows * columns)
+    """
+    if cache_dir is None:
+        return build_deformation_operator(pX_, pY_, shape, dtype)
+    cache_path = get_operator_cache_path(pX_, pY_, shape, dtype, cache_dir)
+
+    if os.path.exists(cache_path):
+        try:
+            operator = scipy.sparse.load_npz(cache_path).tocsr()
+            if operator.shape == (len(pX_), shape[0] * shape[1]) and operator.dtype == np.dtype(dtype):
+                logging.info('Loading cached deformation operator from {0}'.format(cache_path))
+                return operator
+            logging.warning('Cached deformation operator {0} does not match the deformation map'.format(cache_path))
+        except (IOError, OSError, KeyError, ValueError) as err:
+            logging.warning('Could not read cached deformation operator {0}: {1}'.format(cache_path, err))
+
+    operator = build_deformation_operator(pX_, pY_, shape, dtype)
+    try:
+        # Written next to the cache path and moved in place, so concurrent runs never read a partial file
+        with open(cache_path + '.tmp', 'wb') as fp:
+            scipy.sparse.save_npz(fp, operator)
+        os.replace(cache_path + '.tmp', cache_path)
+    except (IOError, OSError) as err:
+        logging.warning('Could not cache deformation operator to {0}: {1}'.format(cache_path, err))
+    return operator
+
+
+def load_deformation_corrector(bezier_path: str, H, shape: tuple = TILE_SHAPE, 
+                               dtype=np.float32, backend: str = 'sparse') -> DeformationCorrector:
+    """Creates the deformation corrector for a Bezier patch file using the cached deformation map.
+
+    Args:
+        bezier_path (str): Bezier patch file path
+        H (_type_): Homography information
+        shape (tuple, optional): (rows, columns) of the corrected tile. Defaults to TILE_SHAPE.
+        dtype (optional): Working dtype of the corrected tiles. Defaults to np.float32.
+        backend (str, optional): 'sparse' or 'numba'. Defaults to 'sparse'.
+
+    Returns:
+        DeformationCorrector: Deformation corrector for every tile of the run
+    """
+    pX_, pY_ = load_deformation_map(bezier_path, shape)
+    return DeformationCorrector(H, pX_, pY_, shape, dtype, backend)
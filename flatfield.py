@@ -0,0 +1,180 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Incremental accumulation of the average tiles used for flat-field correction. Tiles are added to
+a per-channel running sum and count, so memory does not grow with the number of tiles or sections.
+
+The average tiles can also be estimated from a subsample of the tile positions. Positions are drawn
+in rounds that take one position from every section, rotating through the grid positions between
+sections, and sampling stops once the running mean of every channel settles.
+"""
+
+# Standard library imports
+import logging
+
+# Third party imports
+import numpy as np
+
+# Local imports
+from tif_reader import prefetch
+from tile_stats import get_median
+
+
+TILE_SHAPE = (832, 832)
+
+
+class RunningMean(object):
+
+    def __init__(self, nchannels=4, shape=TILE_SHAPE):
+
+        self.shape = tuple(shape)
+        self.sum = np.zeros((nchannels,) + self.shape, dtype=np.float64)
+        self.count = np.zeros(nchannels, dtype=np.int64)
+
+
+    def add(self, channel: int, image: np.ndarray):
+        """Adds a tile to the running sum of a channel.
+
+        Args:
+            channel (int): Zero-indexed channel
+            image (np.ndarray): Tile image array
+        """
+        np.add(self.sum[channel], image, out=self.sum[channel])
+        self.count[channel] += 1
+
+
+    def merge(self, other):
+        """Adds the running sums of another accumulator, e.g. one returned by a worker.
+
+        Args:
+            other (RunningMean): Accumulator to merge
+
+        Returns:
+            RunningMean: self
+        """
+        self.sum += other.sum
+        self.count += other.count
+        return self
+
+
+    def mean(self, default: float = 1.0) -> list:
+        """Computes the mean tile of every channel.
+
+        Args:
+            default (float, optional): Value of channels without any tile. Defaults to 1.0.
+
+        Returns:
+            list: Mean tile for each channel
+        """
+        means = []
+        for total, count in zip(self.sum, self.count):
+            if count == 0:
+                means.append(np.full(self.shape, default))
+            else:
+                means.append(total / count)
+        return means
+
+
+    def get_change(self, previous: list) -> float:
+        """Largest per-pixel change of the mean tiles since a previous estimate, relative to the median
+        of each mean tile.
+
+        Args:
+            previous (list): Mean tile for each channel, None for channels without any tile
+
+        Returns:
+            float: Largest relative change over the channels with tiles, inf if a channel got its first tiles
+        """
+        change = 0.0
+        for total, count, before in zip(self.sum, self.count, previous):
+            if count == 0:
+                continue
+            if before is None:
+                return np.inf
+            mean = total / count
+            change = max(change, np.abs(mean - before).max() / max(np.median(mean), 1e-12))
+        return change
+
+
+    def snapshot(self) -> list:
+        return [total / count if count > 0 else None for total, count in zip(self.sum, self.count)]
+
+
+def get_sample_order(sections: list, seed: int = 0) -> list:
+    """Orders the positions of every section for sampling. Each round takes one position from every
+    section, and the sections start at different grid positions of a shuffled order, so any prefix
+    of the order is spread evenly over the sections and over the grid.
+
+    Args:
+        sections (list): For each section, a dict of its items by grid position
+        seed (int, optional): Seed of the shuffled orders. Defaults to 0.
+
+    Returns:
+        list: (section, grid position) pairs
+    """
+    rng = np.random.default_rng(seed)
+    grid = sorted(set(key for section in sections for key in section))
+    grid = [grid[i] for i in rng.permutation(len(grid))]
+    section_order = rng.permutation(len(sections))
+
+    order = []
+    for k in range(len(grid)):
+        for rank, s in enumerate(section_order):
+            key = grid[(rank + k) % len(grid)]
+            if key in sections[s]:
+                order.append((s, key))
+    return order
+
+
+def estimate_average_tiles(samples: list, read, nchannels: int = 4, median_thresh: float = 20.0,
+                           tolerance: float = 0.01, batch_size: int = 32, min_samples: int = 64,
+                           n_threads: int = 8) -> tuple:
+    """Estimates the average tile of every channel from positions sampled in order, until the running
+    means change by less than the tolerance over a batch of positions.
+
+    Args:
+        samples (list): Tile information of the channels of each position, in sampling order
+        read (callable): Reader returning the image of a tile
+        nchannels (int, optional): Number of channels. Defaults to 4.
+        median_thresh (float, optional): Tiles with a lower median are not averaged. Defaults to 20.0.
+        tolerance (float, optional): Largest per-pixel change of the mean tiles over a batch, relative to their
+                                     median, for the estimate to be converged. Defaults to 0.01.
+        batch_size (int, optional): Positions read between convergence checks. Defaults to 32.
+        min_samples (int, optional): Positions read before convergence is checked. Defaults to 64.
+        n_threads (int, optional): Threads reading ahead. Defaults to 8.
+
+    Returns:
+        tuple: RunningMean of the sampled tiles, and the number of positions and tiles read
+    """
+    def read_group(group):
+        images = []
+        for tile in group:
+            try:
+                images.append(read(tile))
+            except (IOError, OSError, RuntimeError) as err:
+                logging.info('Did not find image tile for channel {0} (zero-indexed)'.format(tile['channel'] - 1))
+                images.append(None)
+        return images
+
+    accumulator = RunningMean(nchannels)
+    previous = accumulator.snapshot()
+    positions = 0
+    tiles = 0
+    for group, images in prefetch(samples, read_group, depth=n_threads):
+        for tile, im in zip(group, images.result()):
+            if im is None:
+                continue
+            tiles += 1
+            if get_median(im) >= median_thresh:
+                accumulator.add(tile['channel'] - 1, im)
+        positions += 1
+
+        if positions >= min_samples and positions % batch_size == 0:
+            change = accumulator.get_change(previous)
+            previous = accumulator.snapshot()
+            logging.info('Average tiles changed by {0:.4f} after {1} positions'.format(change, positions))
+            if change < tolerance:
+                break
+    return accumulator, positions, tiles
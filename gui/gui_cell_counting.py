@@ -35,6 +35,7 @@ from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as Navigatio
 # Import custom libraries
 import run_tissuecyte_stitching_classic
 from cellAnalysis.cell_detection import createShardedPointAnnotation, readSectionTif
+from tif_reader import prefetch, read_stats
 import gui.gui_shared as gui_shared
 
 # Global formatting variables
@@ -482,17 +483,19 @@ class CountingTab(QWidget):
         # Detect cells for all sections
         start = time.time()
         cells = []
-        for i, img_file in enumerate(imgfiles):
+        # Sections are large, so only the next two are read ahead
+        for i, (img_file, image) in enumerate(prefetch(imgfiles, readSectionTif, depth=2)):
             print("\n" + str(i), img_file)
-            image = readSectionTif(img_file)
+            image = image.result()
             image[image < 0] = 0
-            c = gui_shared.get_cell_locations(img_file, index = i, 
+            c = gui_shared.get_cell_locations(image, index = i, 
                                               intensity_threshold = intensity_threshold, size_threshold = size_threshold,
                                               bg_threshold = bg_thresh, min_size = min_size, area_threshold = area_thresh, dilation_iter = dilation_iter, min_distance=min_dist)
             if c.size:
                 cells.append(c)
             #break
         end = time.time()
+        read_stats.log()
 
         # Adjust indices
         cell_locations = np.vstack(cells)
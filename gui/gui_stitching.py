@@ -33,6 +33,7 @@ from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as Navigatio
 
 # Import custom libraries
 import run_tissuecyte_stitching_classic
+import preview_stitching
 import gui.gui_shared as gui_shared
 
 # Global formatting variables
@@ -63,8 +64,6 @@ class StitchingTab(QWidget):
         corners1 = np.asarray([[33, 10], [796, 21], [30, 813], [793, 818]])
         corners2 = np.asarray([[20, 20], [776, 20], [20, 794], [776, 794]])
         self.H, _ = cv2.findHomography(corners1, corners2)
-        gridp = run_tissuecyte_stitching_classic.create_perfect_grid(42, 43, 4, 18)
-        gridp = gridp[20:794, 20:776]
         
         
         ###############################################################################
@@ -115,9 +114,8 @@ class StitchingTab(QWidget):
         # If the bezier patch file exists, load the file and update the button text.
         if os.path.exists(self.bezier_path):
             self.bezier_button.setText("Select Bezier patch file\n✅ " + self.bezier_path)
-            kx, ky = joblib.load(self.bezier_path)
-            # Double the size to preserve sampling , need to downsample later
-            self.pX_, self.pY_ = run_tissuecyte_stitching_classic.get_deformation_map(gridp.shape[0], gridp.shape[1], kx, ky)
+            # Double the size to preserve sampling , need to downsample later. Cached next to the Bezier file.
+            self.pX_, self.pY_ = run_tissuecyte_stitching_classic.load_deformation_map(self.bezier_path, run_tissuecyte_stitching_classic.TILE_SHAPE)
         # If the bezier patch file does not exist, set the bezier path to None and require user to upload.
         else:
             self.bezier_path = None  # Invalid path or missing file.
@@ -215,6 +213,11 @@ class StitchingTab(QWidget):
         self.num_processes_spinbox = QSpinBox(minimum=1, maximum=num_cpus, singleStep=1, value=max(num_cpus - 3, 1), alignment=Qt.AlignCenter)
         num_processes_title = "Num. processes"
         self.num_processes_title = QLabel(num_processes_title)
+        
+        # Scratch space for decoded tiles, off unless a size is set
+        self.tile_cache_spinbox = QDoubleSpinBox(minimum=0.0, maximum=100000.0, singleStep=10.0, value=0.0, alignment=Qt.AlignCenter)
+        tile_cache_title = "Tile cache (GB)"
+        self.tile_cache_title = QLabel(tile_cache_title)
        
         
         ################### SETUP UI LAYOUT ###################
@@ -269,6 +272,8 @@ class StitchingTab(QWidget):
         self.run_buttons_layout.addWidget(self.stitch_button, stretch=1)
         self.run_buttons_layout.addWidget(self.num_processes_spinbox) # Number of processes        
         self.run_buttons_layout.addWidget(self.num_processes_title)
+        self.run_buttons_layout.addWidget(self.tile_cache_spinbox) # Tile cache size
+        self.run_buttons_layout.addWidget(self.tile_cache_title)
         
         ######### ADD TO MAIN LAYOUT #########
         self.layout.addLayout(self.io_layout)
@@ -396,6 +401,7 @@ class StitchingTab(QWidget):
         self.preview_button.setEnabled(False)
         self.stitch_button.setEnabled(False)
         self.num_processes_spinbox.setEnabled(False)
+        self.tile_cache_spinbox.setEnabled(False)
         
         
     def _enable_buttons(self):
@@ -412,6 +418,7 @@ class StitchingTab(QWidget):
         self.preview_button.setEnabled(True)
         self.stitch_button.setEnabled(True)
         self.num_processes_spinbox.setEnabled(True)
+        self.tile_cache_spinbox.setEnabled(True)
         
         
     def _thread_stitching(self):
@@ -455,7 +462,8 @@ class StitchingTab(QWidget):
             os.mkdir(output_dir)
 
         print("Creating Stitching JSON for sections...")
-        mosaic_data, section_jsons = run_tissuecyte_stitching_classic.get_section_data(root_dir, n_threads, depth, sectionNum)
+        mosaic_data, section_jsons = run_tissuecyte_stitching_classic.get_section_data(root_dir, n_threads, depth, sectionNum, 
+                                                                                       os.path.join(output_dir, "tile_index"))
 
         channel_count = int(mosaic_data['channels'])
         print("Creating intermediate directories...")
@@ -476,22 +484,48 @@ class StitchingTab(QWidget):
                     os.mkdir(ch_dir)
 
         average_tiles = []
+        tile_cache = None
         if sectionNum == -1:
             avg_tiles_dir = os.path.join(output_dir, "avg_tiles")
+            # Like --tile_cache_gb, decoded tiles are only kept on scratch if a cache size is set
+            if self.tile_cache_spinbox.value() > 0:
+                tile_cache = run_tissuecyte_stitching_classic.TileCache(None, int(self.tile_cache_spinbox.value() * 1024**3))
             print("Generating average tiles...")
-            run_tissuecyte_stitching_classic.generate_avg_tiles(section_jsons, avg_tiles_dir, 
-                                                                n_threads, median_thresh=self.median_thresh_spinbox.value())
+            if not run_tissuecyte_stitching_classic.generate_avg_tiles(section_jsons, avg_tiles_dir, 
+                                                                       n_threads, median_thresh=self.median_thresh_spinbox.value(), 
+                                                                       tile_cache=tile_cache) and tile_cache is not None:
+                tile_cache.clear()
+                tile_cache = None
             for i in range(4):
                 average_tiles.append(run_tissuecyte_stitching_classic.load_average_tile(os.path.join(avg_tiles_dir,"avg_tile_" + str(i) + ".tif")))
         else:
             for i in range(4):
                 average_tiles.append(np.ones((832,832)))
+
+        # Only stitch sections that are new, changed or failed since the last run
+        manifest = run_tissuecyte_stitching_classic.StitchManifest(output_dir)
+        parameters = run_tissuecyte_stitching_classic.get_stitch_parameters(average_tiles, self.H, self.pX_, self.pY_, 
+                                                                            self.bg_thresh_spinbox.value(), 
+                                                                            save_undistorted=save_undistorted)
+        section_jsons = run_tissuecyte_stitching_classic.get_pending_sections(section_jsons, manifest, list(range(channel_count)), 
+                                                                              parameters, n_threads)
         print("Stitching...")
+        # Largest sections first, workers attach to the shared state instead of receiving copies
+        section_jsons = run_tissuecyte_stitching_classic.get_section_order(section_jsons)
+        n_workers = run_tissuecyte_stitching_classic.get_worker_count(section_jsons, channel_count, n_threads)
+        shared = run_tissuecyte_stitching_classic.publish_shared_state(average_tiles, self.H, self.pX_, self.pY_, 
+                                                                       cache_dir=os.path.dirname(os.path.abspath(self.bezier_path)))
         #Parallel(n_jobs=1, backend=joblib_backend)(delayed(stitch_section)(section_json,average_tiles, output_dir) for section_json in tqdm(section_jsons))
-        joblib.Parallel(n_jobs=n_threads, verbose=13)(
-            joblib.delayed(run_tissuecyte_stitching_classic.stitch_section)(
-                section_json, average_tiles, output_dir, self.H, self.pX_, self.pY_, 
-                self.bg_thresh_spinbox.value(), None, save_undistorted) for section_json in section_jsons)
+        joblib.Parallel(n_jobs=n_workers, batch_size=1, verbose=13)(
+            joblib.delayed(run_tissuecyte_stitching_classic.stitch_shared_section)(
+                section_json, shared, output_dir, 
+                self.bg_thresh_spinbox.value(), None, save_undistorted, None, 
+                run_tissuecyte_stitching_classic.get_tile_store(tile_cache, section_json), 
+                manifest, parameters) for section_json in section_jsons)
+        shared.close()
+        if tile_cache is not None:
+            tile_cache.log_stats()
+            tile_cache.clear()
         
         self._enable_buttons()
 
@@ -513,6 +547,7 @@ class StitchingTab(QWidget):
             self.idx = 0  # Section index to preview
             self.last_idx = -1  # Last section index previewed
             self.last_median_thresh = -1  # Last median threshold previewed
+            self.last_downsample = -1  # Last preview downsampling factor
             self.original_section = None  # Original previewed section
             self.current_section = None   # Current previewed section (with parameters applied)
             self.current_median_mask = None # Current median mask for the section
@@ -542,6 +577,12 @@ class StitchingTab(QWidget):
             depth_title = "Depth" + TITLE_SPACING
             self.depth_title = QLabel(depth_title)
             self.depth_spinbox = QSpinBox(minimum=0, maximum=65535, singleStep=1, value=1, alignment=Qt.AlignCenter)
+            # Preview downsampling factor
+            downsample_title = "Preview downsample" + TITLE_SPACING
+            self.downsample_title = QLabel(downsample_title)
+            self.downsample_combobox = QComboBox()
+            self.downsample_combobox.addItems(["2", "4", "8"])
+            self.downsample_combobox.setCurrentText("4")
             
             self.update()  # Update slider and spinbox values with parent values             
             
@@ -605,6 +646,8 @@ class StitchingTab(QWidget):
             self.prow_layout.addWidget(self.median_thresh_title, alignment=Qt.AlignLeft)
             self.prow_layout.addWidget(self.depth_spinbox)  # Depth
             self.prow_layout.addWidget(self.depth_title, alignment=Qt.AlignLeft)
+            self.prow_layout.addWidget(self.downsample_combobox)  # Preview downsampling
+            self.prow_layout.addWidget(self.downsample_title, alignment=Qt.AlignLeft)
             self.prow_layout.addStretch(1)
             
             # Combine with parameter layout
@@ -652,6 +695,7 @@ class StitchingTab(QWidget):
             self.bg_thresh_spinbox.setEnabled(False)
             self.median_thresh_spinbox.setEnabled(False)
             self.depth_spinbox.setEnabled(False)
+            self.downsample_combobox.setEnabled(False)
             self.section_slider.setEnabled(False)
             self.current_idx_spinbox.setEnabled(False)
             self.export_button.setEnabled(False)
@@ -667,6 +711,7 @@ class StitchingTab(QWidget):
             self.bg_thresh_spinbox.setEnabled(True)
             self.median_thresh_spinbox.setEnabled(True)
             self.depth_spinbox.setEnabled(True)
+            self.downsample_combobox.setEnabled(True)
             self.section_slider.setEnabled(True)
             self.current_idx_spinbox.setEnabled(True)
             self.export_button.setEnabled(True)
@@ -745,87 +790,50 @@ class StitchingTab(QWidget):
         
         def _generate_preview(self):
             """
-            Generate the selected section with the selected parameters.
+            Generate the selected section with the selected parameters. The section is stitched in memory at 
+            the selected downsampling, with its background and median masks in the same pass.
             """
             start = time.time()
             self._disable_buttons()
             
-            save_undistorted = self.parent.save_undistorted_checkbox.isChecked()
-            
-            # Temporary preview output directory
+            # Temporary preview directory for the tile index
             output_dir = "./temp/"
-            output_mask_dir = "./temp_mask/"
             if not os.path.isdir(output_dir):
                 os.mkdir(output_dir)
-            if not os.path.isdir(output_mask_dir):
-                os.mkdir(output_mask_dir)
             
             print("Getting section data...")
             mosaic_data, section_jsons = run_tissuecyte_stitching_classic.get_section_data(self.parent.input_path + "/", 
                                                                                            1, 
                                                                                            self.depth_spinbox.value(), 
-                                                                                           self.idx)
-            channel_count = int(mosaic_data['channels'])
-            print("Creating intermediate directories...")
-            for ch in range(channel_count):
-                ch_dir = os.path.join(output_dir, "stitched_ch{}".format(ch), "")
-                mask_ch_dir = os.path.join(output_mask_dir, "stitched_ch{}".format(ch), "")
-                # Main stitching output
-                if not os.path.isdir(ch_dir):
-                    os.mkdir(ch_dir)
-                # Median preview
-                if not os.path.isdir(mask_ch_dir):
-                    os.mkdir(mask_ch_dir)
-                    
-            # Check if preview image already exists
-            ch = 0
-            sample_path = os.path.join(output_dir, "stitched_ch{}".format(ch), section_jsons[0]['slice_fname']+"_{}.tif".format(ch))
-            sample_mask = os.path.join(output_mask_dir, "stitched_ch{}".format(ch), section_jsons[0]['slice_fname']+"_{}.tif".format(ch))
-            print("Checking if preview image already exists at " + sample_path + "...")
-            #sample_path = glob.glob(os.path.join(output_dir + "/stitched_ch0/*.tif"))[0]
-            if os.path.exists(sample_path):
-                print("Preview image exists! Skipping preview stitching.")
-                skip_stitching = True
-            else:
-                print("Preview image does not exist! Generating preview image...")
-                skip_stitching = False
+                                                                                           self.idx, 
+                                                                                           os.path.join(output_dir, "tile_index"))
                 
             # Setup placeholder average tiles
             average_tiles = []
             for i in range(4):
                 average_tiles.append(np.ones((832,832)))
                 
-            # Stitch and generate the preview image if it doesn't exist.
-            if not skip_stitching:
-                print("Stitching section...")
-                run_tissuecyte_stitching_classic.stitch_section(section_jsons[0], average_tiles, output_dir, 
-                                                                self.parent.H, self.parent.pX_, self.parent.pY_, 
-                                                                self.bg_thresh_spinbox.value(), ch, save_undistorted)
-                print("Stitching done.")
-                
-            # Redo median mask binary stitch if needed.
-            if self.last_median_thresh != self.median_thresh_spinbox.value() or self.last_idx != self.idx:
-                print("Stitching median mask preview...")
-                median_json = section_jsons[0].copy()
-                run_tissuecyte_stitching_classic.stitch_section(median_json, average_tiles, output_mask_dir, 
-                                                                self.parent.H, self.parent.pX_, self.parent.pY_, 
-                                                                self.bg_thresh_spinbox.value(), ch, save_undistorted, 
-                                                                self.median_thresh_spinbox.value())
-                self.current_median_mask = run_tissuecyte_stitching_classic.read_image(sample_mask).T
-                self.current_median_mask = np.flip(self.current_median_mask, axis=0)
-                self.current_median_mask = np.flip(self.current_median_mask, axis=1)
-                self.current_median_mask = np.squeeze(self.current_median_mask)
-                print("Median mask done.")
-                self.last_median_thresh = self.median_thresh_spinbox.value()
+            # Stitch the preview image and its masks at low resolution
+            ch = 0
+            downsample = int(self.downsample_combobox.currentText())
+            print("Stitching section preview at 1/{} resolution...".format(downsample))
+            section, mask, median_mask = preview_stitching.stitch_preview(section_jsons[0], average_tiles, 
+                                                                          self.parent.H, self.parent.pX_, self.parent.pY_, 
+                                                                          self.bg_thresh_spinbox.value(), ch, 
+                                                                          self.median_thresh_spinbox.value(), 
+                                                                          downsample, n_threads=os.cpu_count())
+            print("Stitching done.")
+            
+            # Orient the preview like the stitched sections
+            def orient(image):
+                image = np.flip(image.T, axis=0)
+                image = np.flip(image, axis=1)
+                return np.squeeze(image)
+            
+            self.current_median_mask = orient(median_mask)
+            self.last_median_thresh = self.median_thresh_spinbox.value()
             self.last_idx = self.idx
-            
-                
-            # Load the stitched image
-            print("Loading images into PyPlot...")
-            TEST_IMG = run_tissuecyte_stitching_classic.read_image(sample_path).T
-            TEST_IMG = np.flip(TEST_IMG, axis=0)
-            TEST_IMG = np.flip(TEST_IMG, axis=1)
-            TEST_IMG = np.squeeze(TEST_IMG)
+            TEST_IMG = orient(section)
             
             
             
@@ -833,14 +841,14 @@ class StitchingTab(QWidget):
             self.original_section = TEST_IMG
             self.current_section = self.original_section.copy()
             
-            # Generate threshold mask
-            self.current_mask = run_tissuecyte_stitching_classic.generate_mask(self.original_section, self.bg_thresh_spinbox.value())
+            # Background threshold mask
+            self.current_mask = orient(mask)
             
-            # Keep track of X and Y limits
+            # Keep track of X and Y limits, they are reset when the preview resolution changes
             x_limits = self.ax.get_xlim()
             y_limits = self.ax.get_ylim()
             self.ax.clear()
-            if x_limits != (0.0, 1.0) and y_limits != (0.0, 1.0):
+            if x_limits != (0.0, 1.0) and y_limits != (0.0, 1.0) and self.last_downsample == downsample:
                 self.ax.set_xlim(x_limits)
                 self.ax.set_ylim(y_limits)
                 
@@ -866,6 +874,7 @@ class StitchingTab(QWidget):
             self.ax.contour(self.current_median_mask, colors='green', alpha=0.5)
             #self.ax.set_title('PyQt Matplotlib Example')
             self.canvas.draw()
+            self.last_downsample = downsample
                         
             self._enable_buttons()
             end = time.time()
@@ -0,0 +1,157 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+OME-Zarr output for stitched sections. Every channel is a multiscale (z, y, x) image with one
+z plane per section, so workers can write their sections and pyramid levels independently and
+the volume can be opened in Neuroglancer while stitching is still running. The sections are
+oriented the same way tif_to_ome.py orients the stitched TIFFs.
+"""
+
+# Standard library imports
+import os
+import re
+import logging
+
+# Third party imports
+import cv2
+import numpy as np
+import zarr
+from numcodecs import Blosc
+
+
+def get_section_z(data: dict, depth: int = 1) -> int:
+    """Z index of a section in the volume, parsed from its slice name (<sample>-<section>_<layer>).
+
+    Args:
+        data (dict): Section data
+        depth (int, optional): Number of layers imaged per section. Defaults to 1.
+
+    Returns:
+        int: Zero-indexed plane of the section
+    """
+    match = re.search(r'-(\d+)_(\d+)$', data['slice_fname'])
+    if match is None:
+        raise ValueError('cannot parse section number from {0}'.format(data['slice_fname']))
+    section, layer = int(match.group(1)), int(match.group(2))
+    return (section - 1) * depth + layer - 1
+
+
+def orient_section(image: np.ndarray) -> np.ndarray:
+    """Orients a stitched section like tif_to_ome.readTifSection.
+
+    Args:
+        image (np.ndarray): Stitched section image
+
+    Returns:
+        np.ndarray: Oriented section image
+    """
+    return np.flip(np.flip(image.T, axis=0), axis=1)
+
+
+def downsample_section(image: np.ndarray) -> np.ndarray:
+    """Halves a section by averaging 2x2 blocks.
+
+    Args:
+        image (np.ndarray): Section image
+
+    Returns:
+        np.ndarray: Downsampled section image
+    """
+    h, w = max(image.shape[0] // 2, 1), max(image.shape[1] // 2, 1)
+    return cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA)
+
+
+class OmeZarrWriter(object):
+
+    def __init__(self, path, channels, nsections, dimensions, depth=1, levels=5, chunks=(1, 1024, 1024),
+                 compressor=None):
+
+        self.path = path
+        self.channels = list(channels)
+        self.nsections = nsections
+        self.depth = depth
+        # sections are transposed by orient_section
+        self.shape = (dimensions['column'], dimensions['row'])
+        self.levels = levels
+        self.chunks = tuple(chunks)
+        if compressor is None:
+            compressor = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+        self.compressor = compressor
+
+        # opened lazily inside the worker process
+        self._group = None
+
+
+    def get_level_shape(self, level: int) -> tuple:
+        h, w = self.shape
+        for _ in range(level):
+            h, w = max(h // 2, 1), max(w // 2, 1)
+        return (self.nsections, h, w)
+
+
+    def create(self):
+        """Creates the channel arrays, or grows the existing ones when new sections were added.
+        Called once by the main process before the sections are stitched.
+        """
+        root = zarr.open_group(self.path, mode='a')
+        for ch in self.channels:
+            group = root.require_group('ch{0}'.format(ch))
+            for level in range(self.levels):
+                shape = self.get_level_shape(level)
+                if str(level) in group:
+                    array = group[str(level)]
+                    if array.shape[1:] != shape[1:]:
+                        raise ValueError('{0} has sections of shape {1}, expected {2}'.format(
+                            self.path, array.shape[1:], shape[1:]))
+                    if array.shape[0] < shape[0]:
+                        array.resize(shape)
+                    continue
+                chunks = (1,) + tuple(min(c, s) for c, s in zip(self.chunks[1:], shape[1:]))
+                group.create_dataset(str(level), shape=shape, chunks=chunks, dtype=np.uint16,
+                                     compressor=self.compressor, fill_value=0,
+                                     dimension_separator='/')
+            group.attrs['multiscales'] = self.get_multiscales('ch{0}'.format(ch))
+        logging.info('Writing sections to {0}'.format(self.path))
+
+
+    def get_multiscales(self, name: str) -> list:
+        datasets = []
+        for level in range(self.levels):
+            scale = [1.0, float(2**level), float(2**level)]
+            datasets.append({'path': str(level),
+                             'coordinateTransformations': [{'type': 'scale', 'scale': scale}]})
+        axes = [{'name': axis, 'type': 'space'} for axis in ('z', 'y', 'x')]
+        return [{'version': '0.4', 'name': name, 'axes': axes, 'datasets': datasets}]
+
+
+    def write_section(self, data: dict, ch: int, image: np.ndarray):
+        """Writes a stitched section channel and its pyramid levels. Every plane is its own set of
+        chunks, so sections can be written concurrently from different processes.
+
+        Args:
+            data (dict): Section data
+            ch (int): Zero-indexed channel
+            image (np.ndarray): Stitched section image
+        """
+        z = get_section_z(data, self.depth)
+        if self._group is None:
+            self._group = zarr.open_group(self.path, mode='r+')
+        group = self._group['ch{0}'.format(ch)]
+
+        image = np.ascontiguousarray(orient_section(image))
+        for level in range(self.levels):
+            if level > 0:
+                image = downsample_section(image)
+            group[str(level)][z] = image
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_group'] = None
+        return state
+
+
+    def get_channel_path(self, ch: int) -> str:
+        return os.path.join(self.path, 'ch{0}'.format(ch))
@@ -0,0 +1,151 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Low resolution preview of a stitched section. Tiles are read at 1/factor resolution, corrected with
+the deformation folded into a single remap at that resolution, and stitched in memory together with
+their median threshold tiles, so the section image, its background mask and its median mask come out
+of one pass without writing the full resolution section.
+"""
+
+# Standard library imports
+import logging
+
+# Third party imports
+import cv2
+import numpy as np
+
+# Local imports
+from stitcher import Stitcher
+from tile import TileTable
+from deformation import DeformationCorrector
+from tif_reader import read_tif_downsampled
+from tile_pipeline import run_tile_pipeline
+from tile_stats import get_median
+from tissue_mask import generate_downsampled_mask
+
+
+def scale_bounds(bounds: dict, factor: int, shape: tuple) -> dict:
+    """Bounds of a tile in the preview image.
+
+    Args:
+        bounds (dict): Tile bounds in the full resolution section
+        factor (int): Downsampling factor
+        shape (tuple): (rows, columns) of the downsampled tile
+
+    Returns:
+        dict: Tile bounds in the downsampled section
+    """
+    row = bounds['row']['start'] // factor
+    col = bounds['column']['start'] // factor
+    return {'row': {'start': row, 'end': row + shape[0]},
+            'column': {'start': col, 'end': col + shape[1]}}
+
+
+def get_preview_dimensions(image_dimensions: dict, factor: int) -> dict:
+    # One extra pixel as the tile sizes round up
+    return {axis: -(-n // factor) + 1 for axis, n in image_dimensions.items()}
+
+
+def get_preview_tile(tile: dict, factor: int) -> dict:
+    """Tile information of a tile in the preview image.
+
+    Args:
+        tile (dict): Tile information
+        factor (int): Downsampling factor
+
+    Returns:
+        dict: Tile information with the bounds, size and margins of the downsampled tile
+    """
+    shape = (-(-tile['size']['row'] // factor), -(-tile['size']['column'] // factor))
+    tile = tile.copy()
+    tile.update(bounds=scale_bounds(tile['bounds'], factor, shape), size={'row': shape[0], 'column': shape[1]}, 
+                margins={'row': 0, 'column': 0})
+    return tile
+
+
+def process_preview_tile(image: np.ndarray, raw_shape: tuple, avg_tile: np.ndarray,
+                         deformation: DeformationCorrector, factor: int, thresh: int = 15,
+                         median_thresh: float = 20.0) -> np.ndarray:
+    """Corrects a downsampled tile and pairs it with its median threshold tile, like process_tile_group
+    with and without median_thresh.
+
+    Args:
+        image (np.ndarray): Downsampled raw tile, None if it could not be read
+        raw_shape (tuple): (rows, columns) of the full resolution raw tile
+        avg_tile (np.ndarray): Average tile of the channel, downsampled like the tile
+        deformation (DeformationCorrector): Deformation correction shared by every tile
+        factor (int): Downsampling factor
+        thresh (int, optional): Background threshold. Defaults to 15.
+        median_thresh (float, optional): Threshold for median value to binarize the tile. Defaults to 20.0.
+
+    Returns:
+        np.ndarray: Corrected image and median threshold tile stacked along the last axis, None if missing
+    """
+    if image is None:
+        return None
+
+    # Average tile brightness correction inside the tissue mask
+    image = image.astype(np.float32)
+    mask = generate_downsampled_mask(image, thresh, downsample=factor)
+    image[mask] = image[mask] * avg_tile[mask]
+    corrected = deformation.correct_downsampled(image, factor, raw_shape)
+
+    median = np.full(corrected.shape, get_median(corrected) >= median_thresh, dtype=corrected.dtype)
+    return np.stack([corrected, median], axis=-1)
+
+
+def stitch_preview(data: dict, avg_tiles: list, H, pX_, pY_, thresh: int = 15, ch: int = 0,
+                   median_thresh: float = 20.0, factor: int = 4, n_threads: int = 8) -> tuple:
+    """Stitches one channel of a section at 1/factor resolution in memory.
+
+    Args:
+        data (dict): Section data
+        avg_tiles (list): List of average tiles for each channel
+        H (_type_): Homography information
+        pX_ (_type_): _description_
+        pY_ (_type_): _description_
+        thresh (int, optional): Background threshold. Defaults to 15.
+        ch (int, optional): Zero-indexed channel to stitch. Defaults to 0.
+        median_thresh (float, optional): Threshold for median value to binarize the tiles of the median mask.
+                                         Defaults to 20.0.
+        factor (int, optional): Downsampling factor. Defaults to 4.
+        n_threads (int, optional): Threads reading the tiles, and threads correcting them. Defaults to 8.
+
+    Returns:
+        tuple: Section image, background mask and median mask at 1/factor resolution
+    """
+    tiles = [tile for tile in data['tiles'] if tile['channel'] == ch + 1]
+    deformation = DeformationCorrector(H, pX_, pY_)
+    avg_tile = np.asarray(avg_tiles[ch], dtype=np.float32)
+    small_avg = {}
+
+    def read(tile):
+        try:
+            return read_tif_downsampled(tile['path'], factor)
+        # If the tile is missing, leave the position empty
+        except (IOError, OSError, RuntimeError) as err:
+            logging.info('Did not find image tile {0}'.format(tile['path']))
+            return None, None
+
+    def process(tile, result):
+        image, raw_shape = result
+        tile_avg = None
+        if image is not None:
+            # The average tile is downsampled once for every tile shape, a race only repeats the resize
+            if image.shape not in small_avg:
+                small_avg[image.shape] = cv2.resize(avg_tile, (image.shape[1], image.shape[0]),
+                                                    interpolation=cv2.INTER_AREA)
+            tile_avg = small_avg[image.shape]
+        return process_preview_tile(image, raw_shape, tile_avg, deformation, factor, thresh, median_thresh)
+
+    # Tiles are read and corrected in thread pools and stitched in order
+    images = run_tile_pipeline(tiles, read, process, n_readers=n_threads, n_workers=n_threads)
+    # Every tile holds the section image and the median mask as two planes
+    table = TileTable.from_groups([[get_preview_tile(tile, factor)] for tile in tiles], [[0, 1]] * len(tiles))
+    stitcher = Stitcher(get_preview_dimensions(data['image_dimensions'], factor), table, images, [1, 2])
+    image, _ = stitcher.run()
+    section = image[:, :, 0]
+    mask = generate_downsampled_mask(section, thresh, downsample=factor)
+    return section, mask, image[:, :, 1] >= 0.5
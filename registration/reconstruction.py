@@ -22,6 +22,8 @@ from skimage.transform import resize
 from natsort import natsorted
 from joblib import Parallel, delayed
 
+from tif_reader import read_section_tif, read_section_level
+
 def readTifWrapper(i, file_name):
     """
     All images are being downscaled by 8 because CCF max template size is 10um. 
@@ -30,6 +32,10 @@ def readTifWrapper(i, file_name):
     i - index for parallel processing
     file_name - file name to open
     """
+    # Tiled sections store the 1/8 resolution level, which is read without decoding the full plane
+    im = read_section_level(str(file_name), 8)
+    if im is not None:
+        return [i, im.astype(np.float64)]
     image = readTifSection(str(file_name))
     #image = np.rot90(sitk.GetArrayFromImage(image))
     #im1 = resize(image,(image.shape[0]/20, image.shape[1]/20),preserve_range=True)
@@ -39,16 +45,9 @@ def readTifWrapper(i, file_name):
 
 def readTifSection( file_path):
     """
-    Read tif section image using SITK
+    Read tif section image through tifffile, which also decodes the tiled sections SITK misreads
     """
-    image = sitk.ReadImage(str(file_path))
-    image = sitk.GetArrayFromImage(image)
-    image[image<0] = 0
-    image = image.T
-    image = np.flip(image,axis=0)
-    image = np.flip(image,axis=1)
-    image  = np.squeeze(image)
-    return image
+    return read_section_tif(file_path)
 
 
 def get_stacked_data(img_array):
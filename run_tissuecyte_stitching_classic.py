@@ -12,10 +12,9 @@ Corrects deformation in individual images and stitches them into a large mosaic
 import sys
 import argparse
 import os
-import time
-import itertools
-import sys
+import json
 import logging
+import tempfile
 logging.getLogger().setLevel(logging.INFO)
 logging.captureWarnings(True)
 
@@ -23,156 +22,32 @@ logging.captureWarnings(True)
 import glob
 import joblib
 from joblib import Parallel, delayed
-from tqdm import tqdm
 from six import iteritems
 
 # Third party imports - image and array processing
 import cv2
 import SimpleITK as sitk
 import numpy as np
-import skimage
-from skimage.transform import resize
+import scipy.sparse
 import skimage.morphology
-from scipy.special import binom
 
 # Custom imports
 from stitcher import Stitcher
-from tile import Tile
-
-
-def bernstein(u, n: int, k: int) -> float:
-    """Bernstein polynomial for deformation mapping.
-
-    Args:
-        u (_type_): Input value
-        n (int): Top binomial coefficient
-        k (int): Bottom binomial coefficient
-
-    Returns:
-        float: Bernstein polynomial output
-    """
-    return binom(n, k) * u**k * (1 - u)**(n - k)
-
-
-def barray(u: np.ndarray, v: np.ndarray, n: int, m: int) -> np.ndarray:
-    """Generates a Bernstein polynomial matrix.
-
-    Args:
-        u (np.ndarray): _description_
-        v (np.ndarray): _description_
-        n (int): _description_
-        m (int): _description_
-
-    Returns:
-        np.ndarray: Output matrix
-    """
-    bmatrix = np.zeros((len(u), (n + 1) * (m + 1)))
-    for i in range(n + 1):
-        for j in range(m + 1):
-            bmatrix[:, i * (m + 1) + j] = bernstein(u, n, i) * bernstein(v, m, j)
-            #blist.append(bernstein(u,n,i)* bernstein(v,m,j))
-    return bmatrix
-
-
-def create_perfect_grid(nhs: int, nvs: int, lw: float, sw: float) -> np.ndarray:
-    """Generates a perfect grid image.
-
-    Args:
-        nhs (int): number of horizontal squares
-        nvs (int): number of vertical squares
-        lw (float): line width
-        sw (float): square width
-
-    Returns:
-        np.ndarray: Grid image
-    """
-    xs = 20
-    ys = 20
-    
-    im = np.zeros((2 * xs + nvs * sw + lw, 2 * ys + nhs * sw + lw))
-    # Generate horizontal lines
-    for i in range(nhs + 1):
-        cv2.line(im, (xs + i * sw, ys), (xs + i * sw, im.shape[0] - ys - int(lw / 2)), (255, 255, 255), thickness=lw)
-    # Generate vertical lines
-    for i in range(nvs + 1):
-        cv2.line(im, (xs, ys + i * sw), (im.shape[1] - xs - int(lw / 2), ys + i * sw), (255, 255, 255), thickness=lw) 
-    return im
-
-
-def get_deformation_map(width: int, height: int, kx, ky) -> tuple:
-    """Retrieves deformation map for image correction.
-
-    Args:
-        width (int): Width of map
-        height (int): Height of map
-        kx (_type_): Bezier patch parameters
-        ky (_type_): Bezier patch parameters
-
-    Returns:
-        tuple: _description_
-    """
-    px = []
-    py = []
-    for i in range(2 * width):
-        for j in range(2 * height):
-            px.append(j)
-            py.append(i)
-    px = np.asarray(px)
-    py = np.asarray(py)
-    px_ = np.asarray(px / (2 * float(height)))
-    py_ = np.asarray(py / (2 * float(width)))
-    
-    pX_ = np.matmul(barray(px_, py_, 4, 4), kx)
-    pY_ = np.matmul(barray(px_, py_, 4, 4), ky)
-    pX_ = pX_ * height
-    pY_ = pY_ * width
-    # Clip values
-    pX_[pX_ <= 0] = 0
-    pX_[pX_ >= height - 1] = height - 1
-    pY_[pY_ <= 0] = 0
-    pY_[pY_ >= width - 1] = width -1
-    
-    return pX_, pY_
-
-
-def correct_deformation(im0: np.ndarray, H, pX_, pY_) -> np.ndarray:
-    """_summary_
-
-    Args:
-        im0 (np.ndarray): Image array
-        H (_type_): Homography information
-        pX_ (_type_): _description_
-        pY_ (_type_): _description_
-
-    Returns:
-        np.ndarray: Deformation corrected image
-    """
-    im_warp = cv2.warpPerspective(im0, H, (im0.shape[1], im0.shape[0]))
-    im_warp = im_warp[20:794, 20:776]
-    h,w  = im_warp.shape
-    
-    im = np.zeros(pX_.shape).astype(np.float64)
-    x1 = np.floor(pX_).astype(int)
-    x2 = np.ceil(pX_).astype(int)
-    y1 = np.floor(pY_).astype(int)
-    y2 = np.ceil(pY_).astype(int)
-    
-    dx1 = pX_ - x1
-    dx2 = x2 - pX_
-    dy1 = pY_ - y1
-    dy2 = y2 - pY_
-    dx1[np.where(y1 == y2)] = 1
-    dy1[np.where(x1 == x2)] = 1
-    
-    im_warp1d = im_warp.ravel()
-    im = im_warp1d[y1 * w + x1] * dx1 * dy1 + \
-         im_warp1d[y1 * w + x2] * dx2 * dy1 + \
-         im_warp1d[y2 * w+ x1] * dy2 * dx1 + \
-         im_warp1d[y2 * w + x2] * dy2 * dx2
-    
-    im = np.reshape(im, (2 * h, 2 * w))
-    im = resize(im, (h, w), preserve_range=True)
-    return im
+from tile import TileTable
+from deformation import TILE_SHAPE, DeformationCorrector, load_deformation_map, load_deformation_operator
+from tile_cache import TileCache
+from flatfield import RunningMean, get_sample_order, estimate_average_tiles
+from stitch_manifest import StitchManifest, hash_arrays
+from ome_zarr_output import OmeZarrWriter, get_section_z
+from tif_writer import TiledTifWriter
+from tile_index import load_tile_index
+from tissue_mask import generate_tissue_mask
+from stitch_scheduler import SharedArrays, get_section_order, get_worker_count
+from tile_pipeline import run_tile_pipeline
+from tif_reader import read_tif, read_stats, prefetch
+from tile_registration import LayoutCache, register_tiles, apply_tile_positions
+from tile_preflight import run_preflight, write_report
+from tile_stats import compute_tile_stats, get_median, write_section_stats, merge_tile_stats
 
 
 def get_missing_tile_paths(missing_tiles) -> list:
@@ -203,11 +78,25 @@ def read_image(file_name: str) -> np.ndarray:
     Returns:
         np.ndarray: Image array
     """
-    image = sitk.ReadImage(str(file_name))
-    return sitk.GetArrayFromImage(image)
+    return read_tif(file_name)
     #return np.flipud(sitk.GetArrayFromImage(image)).T
 
 
+def read_tile(file_name: str, tile_store=None) -> np.ndarray:
+    """Reads a tile image, going through the section tile store if one is provided.
+
+    Args:
+        file_name (str): Input file path
+        tile_store (SectionTileStore, optional): Spill store for the decoded tiles of the section. Defaults to None.
+
+    Returns:
+        np.ndarray: Image array
+    """
+    if tile_store is None:
+        return read_image(file_name)
+    return tile_store.read(file_name, read_image)
+
+
 def write_output(imgarr: np.ndarray, path: str):
     """Writes image array to file.
 
@@ -221,11 +110,12 @@ def write_output(imgarr: np.ndarray, path: str):
     sitk.WriteImage(image, path)
 
 
-def normalize_image_by_median(image: np.ndarray) -> np.ndarray:
+def normalize_image_by_median(image: np.ndarray, dtype=np.float32) -> np.ndarray:
     """Normalizes image by median value.
 
     Args:
         image (np.ndarray): Input image array
+        dtype (optional): Working dtype of the normalized image. Defaults to np.float32.
 
     Returns:
         np.ndarray: Normalized image array
@@ -233,82 +123,186 @@ def normalize_image_by_median(image: np.ndarray) -> np.ndarray:
     median = np.median(image)
 
     if median != 0:
-        image = np.divide(median, image)
+        image = np.divide(median, image, dtype=dtype)
         image[np.isnan(image)] = 0
         image[np.isinf(image)] = 0
 
     return image
 
 
-def load_average_tile(path: str) -> np.ndarray:
+def load_average_tile(path: str, dtype=np.float32) -> np.ndarray:
     """Loads average tile from file and normalizes it by median.
 
     Args:
         path (str): File path
+        dtype (optional): Working dtype of the average tile. Defaults to np.float32.
 
     Returns:
         np.ndarray: Normalized average tile
     """
     tile = read_image(path)
-    return normalize_image_by_median(tile)
+    return normalize_image_by_median(tile, dtype)
 
 
-def get_section_avg(tiles: list, median_thresh: float = 20.0) -> list:
+def get_section_avg(tiles: list, median_thresh: float = 20.0, tile_store=None) -> list:
     """Calculates average tiles for each channel using each section.
 
     Args:
         tiles (list): Tile information
+        tile_store (SectionTileStore, optional): Spill store keeping the decoded tiles for stitching. Defaults to None.
 
     Returns:
         list: A list of average tiles for each channel
     """
     #logging.info("tiles:", tiles)
-    imlist = [[], [], [], []]
-    avg_tiles = []
-    for tile in tiles:
+    accumulator = RunningMean(4)
+    # Read the next tiles while the current one is accumulated
+    for tile, image in prefetch(tiles, lambda tile: read_tile(tile['path'], tile_store)):
         try:
-            im = read_image(tile['path'])
+            im = image.result()
             #im = cv2.resize(im, (832,832))
-            if np.median(im) >= median_thresh:
-                imlist[tile["channel"] - 1].append(im)
+            if get_median(im) >= median_thresh:
+                accumulator.add(tile["channel"] - 1, im)
         except(IOError, OSError, RuntimeError) as err:
             logging.info('Did not find image tile for channel {0} (zero-indexed)'.format(tile["channel"] - 1))
+    if tile_store is not None:
+        tile_store.close()
     
-    for i in range(0, 4):
-        if len(imlist[i]) == 0:
-            imlist[i].append(np.ones((832, 832)))
-    
-    avg_tiles.append(np.mean(imlist[0], axis=0))
-    avg_tiles.append(np.mean(imlist[1], axis=0))
-    avg_tiles.append(np.mean(imlist[2], axis=0))
-    avg_tiles.append(np.mean(imlist[3], axis=0))
-    return avg_tiles
+    # Channels without any tile above the median threshold are not corrected
+    return accumulator.mean(default=1.0)
+
+
+def get_sections_avg_sum(sections: list, median_thresh: float = 20.0) -> RunningMean:
+    """Accumulates the average tiles of several sections into a single running sum.
 
+    Args:
+        sections (list): Pairs of tile information and tile store for each section
+
+    Returns:
+        RunningMean: Sum and count of the section average tiles for each channel
+    """
+    accumulator = RunningMean(4)
+    for tiles, tile_store in sections:
+        for ch, avg_tile in enumerate(get_section_avg(tiles, median_thresh, tile_store)):
+            accumulator.add(ch, avg_tile)
+    return accumulator
+
+
+def avg_tiles_exist(avg_tiles_dir: str, median_thresh: float, tolerance: float = None) -> bool:
+    """Checks whether average tiles were already generated with the same median threshold and sampling.
+
+    Args:
+        avg_tiles_dir (str): File path for average tiles
+        median_thresh (float): Median threshold used to select the tiles
+        tolerance (float, optional): Convergence tolerance of sampled average tiles, None if every tile 
+                                     was read. Defaults to None.
+
+    Returns:
+        bool: True if all average tiles exist and are up to date
+    """
+    settings_path = os.path.join(avg_tiles_dir, "avg_tiles.json")
+    if not os.path.exists(settings_path):
+        return False
+    with open(settings_path) as fp:
+        settings = json.load(fp)
+    if settings.get('median_thresh') != median_thresh or settings.get('tolerance') != tolerance:
+        return False
+    return all(os.path.exists(os.path.join(avg_tiles_dir, "avg_tile_" + str(i) + ".tif")) for i in range(4))
 
-def generate_avg_tiles(section_jsons: list, avg_tiles_dir: str, n_threads: int, median_thresh: float = 20.0):
+
+def sample_avg_tiles(section_jsons: list, median_thresh: float = 20.0, tolerance: float = 0.01, 
+                     n_threads: int = 8) -> tuple:
+    """Estimates the average tiles from tile positions sampled across the sections and the mosaic grid, 
+    reading positions until the estimate converges.
+
+    Args:
+        section_jsons (list): Data for each section
+        median_thresh (float, optional): Median threshold used to select the tiles. Defaults to 20.0.
+        tolerance (float, optional): Largest per-pixel change of the average tiles over a batch of positions, 
+                                     relative to their median, to stop sampling. Defaults to 0.01.
+        n_threads (int, optional): Threads reading ahead. Defaults to 8.
+
+    Returns:
+        tuple: Average tile for each channel and the sampling record
+    """
+    # Positions are keyed by their place in the mosaic grid, the same in every section and layer
+    sections = []
+    for section_json in section_jsons:
+        mosaic_data = section_json['mosaic_parameters']
+        ntiles = int(mosaic_data['mrows']) * int(mosaic_data['mcolumns'])
+        sections.append({group[0]['index'] % ntiles: group for group in group_tiles_by_position(section_json['tiles'])})
+    samples = [sections[s][key] for s, key in get_sample_order(sections)]
+
+    accumulator, positions, tiles = estimate_average_tiles(samples, lambda tile: read_tile(tile['path']), 4, 
+                                                           median_thresh, tolerance, n_threads=n_threads)
+    total = sum(len(section_json['tiles']) for section_json in section_jsons)
+    logging.info('Estimated average tiles from {0} of {1} tiles ({2:.1%}) at {3} positions'.format(
+        tiles, total, tiles / max(total, 1), positions))
+    return accumulator.mean(default=1.0), {'tiles_read': tiles, 'tiles_total': total, 'positions_read': positions}
+
+
+def generate_avg_tiles(section_jsons: list, avg_tiles_dir: str, n_threads: int, median_thresh: float = 20.0, 
+                       tile_cache: TileCache = None, regenerate: bool = False, tolerance: float = None) -> bool:
     """Generates average tiles for each channel.
 
     Args:
         section_jsons (list): Data for each section
         avg_tiles_dir (str): File path for average tiles
         n_threads (int): Number of threads to run the section averaging
+        tile_cache (TileCache, optional): Keeps decoded tiles so stitching does not read them again. Defaults to None.
+        regenerate (bool, optional): Regenerate the average tiles even if they already exist. Defaults to False.
+        tolerance (float, optional): If provided, the average tiles are estimated from sampled tile positions until 
+                                     they change by less than this tolerance, instead of reading every tile. 
+                                     Defaults to None.
+
+    Returns:
+        bool: True if the average tiles were generated, False if existing ones are reused
     """
-    always_regenerate = True
-    if not os.path.isdir(avg_tiles_dir) or always_regenerate:
-        os.mkdir(avg_tiles_dir)
+    if regenerate or not avg_tiles_exist(avg_tiles_dir, median_thresh, tolerance):
+        os.makedirs(avg_tiles_dir, exist_ok=True)
         logging.info('Generating average tiles...')
+        settings = {'median_thresh': median_thresh}
+
+        if tolerance is not None:
+            avg_tiles, sampling = sample_avg_tiles(section_jsons, median_thresh, tolerance, 
+                                                   joblib.effective_n_jobs(n_threads))
+            settings.update(tolerance=tolerance, **sampling)
+        else:
+            # Each worker reduces an interleaved share of the sections into one running sum
+            sections = [(section_json['tiles'], get_tile_store(tile_cache, section_json)) for section_json in section_jsons]
+            n_chunks = max(1, min(len(sections), joblib.effective_n_jobs(n_threads)))
+            partial_sums = Parallel(n_jobs=n_threads, verbose=13)(delayed(get_sections_avg_sum)(sections[i::n_chunks], median_thresh) 
+                                                                  for i in range(n_chunks))
+            accumulator = RunningMean(4)
+            for partial_sum in partial_sums:
+                accumulator.merge(partial_sum)
+            avg_tiles = accumulator.mean(default=1.0)
 
-        imlist = Parallel(n_jobs=n_threads, verbose=13)(delayed(get_section_avg)(section_json['tiles'], median_thresh) 
-                                                        for section_json in section_jsons)
-        imlist = np.asarray(imlist)
-        
-        avg_tiles = np.mean(imlist, axis=0)
         for i, im in enumerate(avg_tiles):
             image = sitk.GetImageFromArray(im)
             image = sitk.Cast(image, sitk.sitkFloat32)
             sitk.WriteImage(image, os.path.join(avg_tiles_dir, "avg_tile_" + str(i) + ".tif"))
+        with open(os.path.join(avg_tiles_dir, "avg_tiles.json"), 'w') as fp:
+            json.dump(settings, fp)
+        return True
     else:
         logging.info('Average tiles already exist. Skipping generation...')
+        return False
+
+
+def get_tile_store(tile_cache: TileCache, section_json: dict):
+    """Returns the spill store of a section if a tile cache is used.
+
+    Args:
+        tile_cache (TileCache): Tile cache, or None if tiles are not cached
+        section_json (dict): Section data
+
+    Returns:
+        SectionTileStore: Spill store of the section, or None
+    """
+    if tile_cache is None:
+        return None
+    return tile_cache.section_store(section_json)
 
 
 def preprocess(img: np.ndarray, min_val: float = None, max_val: float = 400) -> np.ndarray:
@@ -333,7 +327,8 @@ def preprocess(img: np.ndarray, min_val: float = None, max_val: float = 400) ->
 
 
 def generate_mask(im: np.array, thresh: int = 15, 
-                  gauss_kernel: int = 55, min_size: int = 64, area_threshold: int = 64) -> np.ndarray:
+                  gauss_kernel: int = 55, min_size: int = 64, area_threshold: int = 64, 
+                  downsample: int = 4) -> np.ndarray:
     """Generates mask used to determine which pixels to apply average tile brightness correction to. 
 
     Args:
@@ -342,10 +337,15 @@ def generate_mask(im: np.array, thresh: int = 15,
         gauss_kernel (int, optional): How big the Gaussian kernel is. Defaults to 55.
         min_size (int, optional): The minimum size of a speck for it to not be removed. Defaults to 64.
         area_threshold (int, optional): The minimum size of a hole for it not to be filled in. Defaults to 64.
+        downsample (int, optional): Generate the mask at 1/downsample resolution. Set to 1 to generate it 
+                                    at full resolution. Defaults to 4.
 
     Returns:
         np.ndarray: _description_
     """
+    if downsample > 1:
+        return generate_tissue_mask(im, thresh, gauss_kernel, min_size, area_threshold, downsample)
+
     y, x = im.shape
     # Settings
     min_size = max(min_size, 
@@ -369,85 +369,217 @@ def generate_mask(im: np.array, thresh: int = 15,
     return mask
 
 
-def generate_tiles(tiles: list, avg_tiles: list, 
-                   H, pX_, pY_, thresh: int = 15, ch: int = None, 
-                   save_undistorted: bool = False, median_thresh: float = None):
-    """Generate the images for the tiles and applies processing on them.
+def correct_tile(im: np.ndarray, avg_tile: np.ndarray, deformation: DeformationCorrector, 
+                 thresh: int = 15, mask: np.ndarray = None) -> np.ndarray:
+    """Applies the average tile brightness correction inside the tissue mask and corrects deformation.
+
+    Args:
+        im (np.ndarray): Tile image array
+        avg_tile (np.ndarray): Average tile of the channel
+        deformation (DeformationCorrector): Deformation correction shared by every tile
+        thresh (int, optional): Background threshold used to generate the mask. Defaults to 15.
+        mask (np.ndarray, optional): Tissue mask to use instead of generating one from the tile. Defaults to None.
+
+    Returns:
+        np.ndarray: Corrected tile image array
+    """
+    # Settings to generate mask
+    if mask is None:
+        mask = generate_mask(im, thresh=thresh)
+
+    # Apply mask to image
+    im_masked = np.where(mask, im.copy(), 0)
+    im_masked = np.multiply(im_masked, avg_tile)
+    im[mask != 0] = im_masked[mask != 0]
+
+    # Original stitching, comment the last 4 lines and uncomment the below to use
+    #im = np.multiply(im, avg_tile)
+    
+    # Correct deformation
+    return deformation.correct(im)
+
+
+def group_tiles_by_position(tiles: list) -> list:
+    """Groups the channel tiles of each mosaic position, keeping the placement order. The tiles of every 
+    layer of a merged section are grouped by their position in the first layer.
 
     Args:
         tiles (list): Tile information
-        avg_tiles (list): List of average tiles
-        output_dir (str): Where to save the undistorted tiles
-        H (_type_): Homography information
-        pX_ (_type_): _description_
-        pY_ (_type_): _description_
-        ch (int, optional): Which channel to generate for. If a channel is provided, only generates for that channel, 
-                            otherwise generates for all of them if None. Defaults to None.
-        save_undistorted (bool, optional): If True, saves the images without distortion correction. Defaults to False.
-        median_thresh (float, optional): Threshold for median value to binarize image. Defaults to None.
 
-    Yields:
-        Iterator[list]: Processed tile objects
-    """    
-    # Remove irrelevant channels if a specific channel is provided
+    Returns:
+        list: Lists of tile information sharing the same position
+    """
+    groups = {}
+    for tile in tiles:
+        groups.setdefault(tile.get('position', tile['index']), []).append(tile)
+    return list(groups.values())
+
+
+def get_tile_groups(tiles: list, ch: int = None) -> list:
+    """Groups the tiles of a section by position, keeping only one channel if a channel is provided.
+
+    Args:
+        tiles (list): Tile information
+        ch (int, optional): Zero-indexed channel to keep. Defaults to None.
+
+    Returns:
+        list: Lists of tile information sharing the same position, in placement order
+    """
     if ch is not None:
-        new_tiles = []
-        for t in tiles:
-            if t['channel'] == ch + 1:
-                new_tiles.append(t)
-        tiles = new_tiles
-    
-    for tile_params in tiles:
-        tile = tile_params.copy()
+        tiles = [t for t in tiles if t['channel'] == ch + 1]
+    return group_tiles_by_position(tiles)
+
+
+def read_tile_group(group: list, tile_store=None) -> list:
+    """Reads the channel tiles of a mosaic position.
+
+    Args:
+        group (list): Tile information of the channels of a position
+        tile_store (SectionTileStore, optional): Spill store with tiles decoded by a previous pass. Defaults to None.
+
+    Returns:
+        list: Image array of each channel, None for tiles that could not be read
+    """
+    images = []
+    for tile in group:
         try:
-            im = read_image(tile['path'])
-            #im = cv2.resize(im, (832,832))
-            
-            ###### PROCESSING ######
-            y, x = im.shape
+            images.append(read_tile(tile['path'], tile_store))
+        # If the tile is missing, leave the channel empty
+        except (IOError, OSError, RuntimeError) as err:
+            logging.info('Did not find image tile {0}'.format(tile['path']))
+            images.append(None)
+    return images
 
-            # Settings to generate mask
-            mask = generate_mask(im, thresh=thresh)
 
-            # Apply mask to image
-            im_masked = np.where(mask, im.copy(), 0)
-            im_masked = np.multiply(im_masked, avg_tiles[tile['channel'] - 1])
-            im[mask != 0] = im_masked[mask != 0]
+def process_tile_group(group: list, images: list, avg_tiles: list, deformation: DeformationCorrector, 
+                       thresh: int = 15, save_undistorted: bool = False, median_thresh: float = None, 
+                       mask_channel: int = None, dtype=np.float32, stats: list = None) -> np.ndarray:
+    """Processes the channel tiles of a mosaic position into a single multi-channel image.
 
-            # Original stitching, comment the last 4 lines and uncomment the below to use
-            #im = np.multiply(im, avg_tiles[tile['channel'] - 1])
-            
-            # Correct deformation
-            im_corrected = correct_deformation(im, H, pX_, pY_)
-            tile['image'] = im_corrected
+    Args:
+        group (list): Tile information of the channels of a position
+        images (list): Image array of each channel, as returned by read_tile_group
+        avg_tiles (list): List of average tiles
+        deformation (DeformationCorrector): Deformation correction shared by every tile
+        thresh (int, optional): Background threshold. Defaults to 15.
+        save_undistorted (bool, optional): If True, saves the images without distortion correction. Defaults to False.
+        median_thresh (float, optional): Threshold for median value to binarize image. Defaults to None.
+        mask_channel (int, optional): Zero-indexed channel whose tissue mask is shared by all channels of a position. 
+                                      If None, every channel uses its own mask. Defaults to None.
+        dtype (optional): Working dtype of the processed tiles. Defaults to np.float32.
+        stats (list, optional): Collects the quality control statistics of every raw tile. Defaults to None.
+
+    Returns:
+        np.ndarray: Processed channels stacked along the last axis, in the planes of TileTable.from_groups, 
+                    or None if none of them could be read
+    """
+    corrected = [None] * len(group)
+    masks = {}
+
+    # Process the signal channel first so its mask can be shared
+    order = sorted(range(len(group)), key=lambda i: group[i]['channel'] - 1 != mask_channel)
+    for i in order:
+        tile = group[i]
+        im = images[i]
+        if im is None:
+            continue
+        try:
+            ###### PROCESSING ######
+            layer = tile.get('layer', 0)
+            if mask_channel is not None and tile['channel'] - 1 == mask_channel:
+                masks[layer] = generate_mask(im, thresh=thresh)
+            tile_mask = masks[layer] if layer in masks else generate_mask(im, thresh=thresh)
+            # Statistics of the raw tile, before it is corrected in place
+            if stats is not None:
+                stats.append(dict(index=tile['index'], layer=layer, channel=tile['channel'] - 1, path=tile['path'], 
+                                  row=tile['bounds']['row']['start'], column=tile['bounds']['column']['start'], 
+                                  **compute_tile_stats(im, tile_mask)))
+            im_corrected = correct_tile(im, avg_tiles[tile['channel'] - 1], deformation, thresh, tile_mask)
             if save_undistorted:
                 undistorted_tile_path = os.path.join(undistorted_dir, 
                                                      "ch{}".format(tile['channel'] - 1), 
                                                      os.path.split(tile['path'])[1])
                 write_output(np.ascontiguousarray(im_corrected), undistorted_tile_path)
-            tile['is_missing'] = False
             
-        # If the tile is missing, set the image to None and is_missing to True
+        # If the tile cannot be processed, leave the channel empty
         except (IOError, OSError, RuntimeError) as err:
-            tile['image'] = None
-            tile['is_missing'] = True
-            
+            logging.info('Did not find image tile {0}'.format(tile['path']))
+            im_corrected = None
+        
         # Binarize tile image if median thresh is provided for visualization purposes in preview
-        if median_thresh is not None:
-            tile_median = np.median(tile['image'])
+        if median_thresh is not None and im_corrected is not None:
+            tile_median = np.median(im_corrected)
             if tile_median >= median_thresh:
-                tile['image'] = np.ones(tile['image'].shape)
+                im_corrected = np.ones(im_corrected.shape, dtype=dtype)
             else:
-                tile['image'] = np.zeros(tile['image'].shape)
-        
-        # Decrement channel by 1 to make it zero-indexed and yield the tile object
-        tile['channel'] = tile['channel'] - 1
-        tile_obj = Tile(**tile)
-        del tile
-        yield tile_obj
+                im_corrected = np.zeros(im_corrected.shape, dtype=dtype)
+        corrected[i] = im_corrected
+    
+    # Stack the channels in their original order, the position is missing if none of them were read
+    if all(im is None for im in corrected):
+        return None
+    shape = next(im.shape for im in corrected if im is not None)
+    return np.stack([im if im is not None else np.zeros(shape, dtype=dtype) for im in corrected], axis=-1)
+
+
+def generate_tiles(tiles: list, avg_tiles: list, 
+                   H, pX_, pY_, thresh: int = 15, ch: int = None, 
+                   save_undistorted: bool = False, median_thresh: float = None, tile_store=None, 
+                   mask_channel: int = None, dtype=np.float32, n_workers: int = 1, stats: list = None, 
+                   deformation_backend: str = 'sparse', deformation: DeformationCorrector = None):
+    """Generate the images for the tiles and applies processing on them. The channels of a mosaic position 
+    are processed together and yielded as a single multi-channel image, in the order of get_tile_groups.
+
+    Args:
+        tiles (list): Tile information
+        avg_tiles (list): List of average tiles
+        output_dir (str): Where to save the undistorted tiles
+        H (_type_): Homography information
+        pX_ (_type_): _description_
+        pY_ (_type_): _description_
+        ch (int, optional): Which channel to generate for. If a channel is provided, only generates for that channel, 
+                            otherwise generates for all of them if None. Defaults to None.
+        save_undistorted (bool, optional): If True, saves the images without distortion correction. Defaults to False.
+        median_thresh (float, optional): Threshold for median value to binarize image. Defaults to None.
+        tile_store (SectionTileStore, optional): Spill store with tiles decoded by a previous pass. Defaults to None.
+        mask_channel (int, optional): Zero-indexed channel whose tissue mask is shared by all channels of a position. 
+                                      If None, every channel uses its own mask. Defaults to None.
+        dtype (optional): Working dtype of the processed tiles. Defaults to np.float32.
+        n_workers (int, optional): Threads processing the tiles of the section. If more than 1, tiles are read 
+                                   and processed ahead in thread pools and yielded in placement order. Defaults to 1.
+        stats (list, optional): Collects the quality control statistics of every raw tile. Defaults to None.
+        deformation_backend (str, optional): 'sparse' or 'numba' deformation correction. Defaults to 'sparse'.
+        deformation (DeformationCorrector, optional): Deformation correction built for the section. If None, 
+                                                      one is built from H, pX_ and pY_. Defaults to None.
+
+    Yields:
+        Iterator[np.ndarray]: Processed image of each position, None for missing positions
+    """    
+    # Build the deformation lookup once and reuse it for every tile
+    if deformation is None:
+        deformation = DeformationCorrector(H, pX_, pY_, dtype=dtype, backend=deformation_backend)
+    # Remove irrelevant channels if a specific channel is provided
+    groups = get_tile_groups(tiles, ch)
+
+    read = lambda group: read_tile_group(group, tile_store)
+    process = lambda group, images: process_tile_group(group, images, avg_tiles, deformation, thresh, save_undistorted, 
+                                                       median_thresh, mask_channel, dtype, stats)
+    if n_workers > 1:
+        # Built up front so the workers do not race to build it
+        deformation.build()
+        for image in run_tile_pipeline(groups, read, process, n_workers=n_workers):
+            yield image
+    else:
+        # Read the next positions while the current one is processed
+        for group, images in prefetch(groups, read):
+            yield process(group, images.result())
 
+    if tile_store is not None:
+        tile_store.close()
 
-def create_section_json(sno: int, sectionName: str, mosaic_data: list, depth: int = 0):
+
+def create_section_json(sno: int, sectionName: str, mosaic_data: list, depth: int = 0, index_dir: str = None, 
+                        tile_index: dict = None):
     """Creates a JSON object for storing section information.
 
     Args:
@@ -455,6 +587,8 @@ def create_section_json(sno: int, sectionName: str, mosaic_data: list, depth: in
         sectionName (str): Name of the section
         mosaic_data (list): Mosaic data information
         depth (int, optional): _description_. Defaults to 0.
+        index_dir (str, optional): Directory the tile index of the section is persisted in. Defaults to None.
+        tile_index (dict, optional): Tile index of the section, loaded from index_dir if None. Defaults to None.
 
     Returns:
         _type_: Section JSON data
@@ -477,12 +611,14 @@ def create_section_json(sno: int, sectionName: str, mosaic_data: list, depth: in
     section_json = {}
     section_json["mosaic_parameters"] = mosaic_data
     tiles = []
+    # List the section directory once instead of globbing every position
+    if tile_index is None:
+        tile_index = load_tile_index(sectionName, index_dir)
     for ncol in range(mcolumns):
         for nrow in range(mrows):
             index = index_ + (ncol) * mrows + nrow
             #index = sno*mrows*mcolumns + (ncol)*mrows+nrow
-            tile_paths = glob.glob(f'{sectionName}/*-{index}_*.tif')
-            #print(f'{sectionName}/*-{index}_*.tif', tile_paths, sectionName, index)
+            tile_paths = tile_index.get(index, {})
             if len(tile_paths) == 0:
                 continue
             bounds = {}
@@ -500,13 +636,13 @@ def create_section_json(sno: int, sectionName: str, mosaic_data: list, depth: in
                 col["end"] = col["start"] + size["column"]
             bounds["row"] = row
             bounds["column"] = col
-            for ch, path in enumerate(tile_paths):
+            for ch in sorted(tile_paths):
                 tile_data = {}
-                tile_data["path"] = path
+                tile_data["path"] = os.path.join(sectionName, tile_paths[ch])
                 tile_data["bounds"] = bounds
                 tile_data["margins"]= margins
                 tile_data["size"] = size
-                tile_data["channel"] = ch + 1
+                tile_data["channel"] = ch
                 tile_data["index"] = index
                 tiles.append(tile_data)
         #index_ = index_ + mrows*mcolumns*int(mosaic_data["layers"])
@@ -514,10 +650,99 @@ def create_section_json(sno: int, sectionName: str, mosaic_data: list, depth: in
         section_json["tiles"] = tiles
         section_json['slice_fname'] = os.path.split(sectionName)[-1] + "_" + str(depth + 1)
         section_json["image_dimensions"] = image_dimensions
+    section_json["section_name"] = os.path.split(sectionName)[-1]
+    section_json["layer"] = depth
     return section_json
 
 
-def get_section_data(root_dir: str, n_threads: int, depth: int = 1, sectionNum: int = -1):
+def create_section_jsons(sno: int, sectionName: str, mosaic_data: list, depth: int = 1, index_dir: str = None) -> list:
+    """Creates the JSON objects of every layer of a section from a single listing of its directory.
+
+    Args:
+        sno (int): Section index number
+        sectionName (str): Name of the section
+        mosaic_data (list): Mosaic data information
+        depth (int, optional): Number of layers. Defaults to 1.
+        index_dir (str, optional): Directory the tile index of the section is persisted in. Defaults to None.
+
+    Returns:
+        list: Section JSON data of each layer
+    """
+    tile_index = load_tile_index(sectionName, index_dir)
+    return [create_section_json(sno, sectionName, mosaic_data, d, tile_index=tile_index) for d in range(depth)]
+
+
+def merge_section_layers(layer_jsons: list) -> dict:
+    """Merges the layers of a section into one section whose output planes are the channels of every layer. 
+    The layers share the stage positions, so they are stitched together with the same blend geometry.
+
+    Args:
+        layer_jsons (list): Section JSON data of each layer
+
+    Returns:
+        dict: Section data with the layers under 'layers', or the section data itself for a single layer
+    """
+    if len(layer_jsons) == 1:
+        return layer_jsons[0]
+
+    first = layer_jsons[0]
+    nchannels = len(first['channels'])
+    ntiles = int(first['mosaic_parameters']['mrows']) * int(first['mosaic_parameters']['mcolumns'])
+    data = {key: value for key, value in first.items() if key not in ('tiles', 'layer')}
+    data['slice_fname'] = first['section_name']
+    data['layers'] = layer_jsons
+    data['tiles'] = []
+    for i, layer in enumerate(layer_jsons):
+        for tile in layer['tiles']:
+            tile = tile.copy()
+            tile['layer'] = i
+            # the output plane of the tile, and the index of its position in the first layer
+            tile['plane'] = i * nchannels + tile['channel'] - 1
+            tile['position'] = tile['index'] - (layer['layer'] - first['layer']) * ntiles
+            data['tiles'].append(tile)
+    return data
+
+
+def group_section_layers(section_jsons: list) -> list:
+    """Groups the layers of every section, keeping the order in which the sections first appear.
+
+    Args:
+        section_jsons (list): Section JSON data of every layer of every section
+
+    Returns:
+        list: Section JSON data of the layers of each section, ordered by layer
+    """
+    sections = {}
+    for section_json in section_jsons:
+        sections.setdefault(section_json['section_name'], []).append(section_json)
+    return [sorted(layers, key=lambda layer: layer['layer']) for layers in sections.values()]
+
+
+def get_section_dirs(root_dir: str, mosaic_data: dict, sectionNum: int = -1) -> dict:
+    """Finds the section directories of the sample. The tile indices continue across sections, so the section 
+    number is taken from the directory name (<sample>-<section>) rather than the listing order.
+
+    Args:
+        root_dir (str): Input directory
+        mosaic_data (dict): Mosaic data information
+        sectionNum (int, optional): Which specific section number to find. If set to -1, finds all sections. 
+                                    Defaults to -1.
+
+    Returns:
+        dict: Directory of each section index number
+    """
+    if sectionNum != -1:
+        return {sectionNum: os.path.join(root_dir, "{}-{:04d}".format(mosaic_data["Sample ID"], sectionNum + 1))}
+
+    sectionNames = {}
+    for sectionName in glob.glob(root_dir + mosaic_data["Sample ID"] + "*"):
+        suffix = os.path.basename(sectionName).rsplit("-", 1)[-1]
+        if os.path.isdir(sectionName) and suffix.isdigit():
+            sectionNames[int(suffix) - 1] = sectionName
+    return sectionNames
+
+
+def get_section_data(root_dir: str, n_threads: int, depth: int = 1, sectionNum: int = -1, index_dir: str = None):
     """Retrieve and generate section data from root input directory.
 
     Args:
@@ -526,6 +751,7 @@ def get_section_data(root_dir: str, n_threads: int, depth: int = 1, sectionNum:
         depth (int, optional): _description_. Defaults to 1.
         sectionNum (int, optional): Which specific section number to generate information for. 
                                     If set to -1, generates for all sections. Defaults to -1.
+        index_dir (str, optional): Directory the tile index of every section is persisted in. Defaults to None.
 
     Returns:
         _type_: Section data
@@ -544,29 +770,284 @@ def get_section_data(root_dir: str, n_threads: int, depth: int = 1, sectionNum:
             k,v = line.rstrip("\n").split(":",1)
             mosaic_data[k]=v
 
-    sectionNames = glob.glob(root_dir + mosaic_data["Sample ID"] + "*")
-    section_jsons_list = []
-    
     # If a specific section number is provided, generate the section data for that section only
+    sectionNames = get_section_dirs(root_dir, mosaic_data, sectionNum)
     if sectionNum != -1:
-        sectionName = os.path.join(root_dir, "{}-{:04d}".format(mosaic_data["Sample ID"], sectionNum + 1))
-        section_jsons = [create_section_json(sectionNum, sectionName, mosaic_data)]
+        section_jsons = [create_section_json(sectionNum, sectionNames[sectionNum], mosaic_data, index_dir=index_dir)]
         return mosaic_data, section_jsons
     
-    # Otherwise, generate section data for all sections
-    for d in range(depth):
-        section_jsons = Parallel(n_jobs=n_threads)(delayed(create_section_json)(sno, sectionName, mosaic_data, d) 
-                                                   for sno,sectionName in enumerate(sectionNames))
-        section_jsons_list.append(section_jsons)
-    section_jsons = list(itertools.chain.from_iterable(section_jsons_list))
+    # Otherwise, generate section data for all sections, listing each section directory once for every layer
+    section_jsons_list = Parallel(n_jobs=n_threads)(delayed(create_section_jsons)(sno, sectionNames[sno], mosaic_data, depth, 
+                                                                                  index_dir) 
+                                                    for sno in sorted(sectionNames))
+    section_jsons = [layers[d] for d in range(depth) for layers in section_jsons_list]
 
     return mosaic_data, section_jsons
 
 
+def get_layout_key(data: dict, thresh: int, channel: int) -> dict:
+    # The solved positions depend on the tiles of the registered channel and the background threshold
+    return {'channel': channel, 'thresh': thresh, 'inputs': StitchManifest.get_inputs(data, channel)}
+
+
+def is_registration_tile(tile: dict, channel: int) -> bool:
+    # The layers of a merged section share the stage positions, which are registered on the first layer
+    return tile['channel'] - 1 == channel and tile.get('layer', 0) == 0
+
+
+def spill_images(images, scratch_dir: str = None) -> list:
+    """Writes the processed images of a section to an anonymous scratch file and maps them back, so they 
+    can be stitched after every tile was seen without holding them in memory or processing them again.
+
+    Args:
+        images (iterable): Processed image of each position, None for missing positions
+        scratch_dir (str, optional): Directory for the scratch file. Defaults to the system temp directory.
+
+    Returns:
+        list: Read-only memory-mapped image of each position, None for missing positions
+    """
+    entries = []
+    offset = 0
+    with tempfile.TemporaryFile(dir=scratch_dir) as scratch:
+        for image in images:
+            if image is None:
+                entries.append(None)
+                continue
+            image = np.ascontiguousarray(image)
+            scratch.write(image.data)
+            entries.append((offset, image.shape, image.dtype))
+            offset += image.nbytes
+        if offset == 0:
+            return entries
+        scratch.flush()
+        # The mapping stays valid once the file is closed and removed
+        buffer = np.memmap(scratch, dtype=np.uint8, mode='r', shape=(offset,))
+    return [None if entry is None else np.ndarray(entry[1], dtype=entry[2], buffer=buffer, offset=entry[0]) 
+            for entry in entries]
+
+
+def refine_stitched_tile_positions(data: dict, groups: list, images, output_dir: str, thresh: int = 15, 
+                                   channel: int = 0, scratch_dir: str = None) -> tuple:
+    """Refines the tile positions of a section like refine_tile_positions, from the tiles processed for 
+    stitching. The processed tiles are spilled to scratch while the positions are solved, so every tile is 
+    read and corrected once.
+
+    Args:
+        data (dict): Section data
+        groups (list): Tile information of every position, as returned by get_tile_groups
+        images (iterable): Processed image of every position, as yielded by generate_tiles
+        output_dir (str): Output directory the layout cache is kept in
+        thresh (int, optional): Background threshold. Defaults to 15.
+        channel (int, optional): Zero-indexed channel registered. Defaults to 0.
+        scratch_dir (str, optional): Directory for the scratch file of the processed tiles. Defaults to None.
+
+    Returns:
+        tuple: Section data with the refined tile bounds, and the processed image of every position
+    """
+    cache = LayoutCache(output_dir)
+    key = get_layout_key(data, thresh, channel)
+    positions = cache.load(data, key)
+    if positions is None:
+        images = spill_images(images, scratch_dir)
+        tiles = []
+        planes = []
+        for group, image in zip(groups, images):
+            for i, tile in enumerate(group):
+                if is_registration_tile(tile, channel):
+                    tiles.append(tile)
+                    planes.append(image[:, :, i] if image is not None else None)
+        positions = register_tiles(tiles, planes)
+        cache.save(data, key, positions)
+    return apply_tile_positions(data, positions), images
+
+
+def refine_tile_positions(data: dict, avg_tiles: list, H, pX_, pY_, output_dir: str, thresh: int = 15, 
+                          channel: int = 0, tile_store=None, dtype=np.float32, 
+                          deformation_backend: str = 'sparse', deformation: DeformationCorrector = None) -> dict:
+    """Refines the tile positions of a section from the overlaps of one channel. The solved positions are 
+    cached per section and solved again only when the tiles of the channel change.
+
+    Args:
+        data (dict): Section data
+        avg_tiles (list): List of average tiles for each channel
+        H (_type_): Homography information
+        pX_ (_type_): _description_
+        pY_ (_type_): _description_
+        output_dir (str): Output directory the layout cache is kept in
+        thresh (int, optional): Background threshold. Defaults to 15.
+        channel (int, optional): Zero-indexed channel registered. Defaults to 0.
+        tile_store (SectionTileStore, optional): Spill store for the decoded tiles of the section. Defaults to None.
+        dtype (optional): Working dtype of the tile processing. Defaults to np.float32.
+        deformation_backend (str, optional): 'sparse' or 'numba' deformation correction. Defaults to 'sparse'.
+        deformation (DeformationCorrector, optional): Deformation correction built for the section. If None, 
+                                                      one is built from H, pX_ and pY_. Defaults to None.
+
+    Returns:
+        dict: Section data with the refined tile bounds
+    """
+    cache = LayoutCache(output_dir)
+    key = get_layout_key(data, thresh, channel)
+    positions = cache.load(data, key)
+    if positions is None:
+        tiles = [tile for tile in data['tiles'] if is_registration_tile(tile, channel)]
+        if deformation is None:
+            deformation = DeformationCorrector(H, pX_, pY_, dtype=dtype, backend=deformation_backend)
+        # Built up front so the reader threads do not race to build it
+        deformation.build()
+
+        def read(tile):
+            try:
+                im = read_tile(tile['path'], tile_store)
+            except (IOError, OSError, RuntimeError):
+                return None
+            return correct_tile(im.astype(dtype), avg_tiles[channel], deformation, thresh)
+
+        images = (future.result() for _, future in prefetch(tiles, read))
+        positions = register_tiles(tiles, images)
+        cache.save(data, key, positions)
+    return apply_tile_positions(data, positions)
+
+
+def get_stitch_parameters(avg_tiles: list, H, pX_, pY_, thresh: int = 15, median_thresh=None, 
+                          mask_channel: int = None, output_format: str = 'tif', dtype=np.float32, 
+                          refine_positions: bool = False, projection: str = None, compression: str = None, 
+                          deformation_backend: str = 'sparse', save_undistorted: bool = False, 
+                          tile_stats: bool = False) -> dict:
+    """Fingerprint of everything besides the input tiles that affects a stitched section.
+
+    Args:
+        avg_tiles (list): List of average tiles for each channel
+        H (_type_): Homography information
+        pX_ (_type_): _description_
+        pY_ (_type_): _description_
+        thresh (int, optional): Background threshold. Defaults to 15.
+        median_thresh (float, optional): Threshold for median value to binarize image. Defaults to None.
+        mask_channel (int, optional): Zero-indexed channel whose tissue mask is shared by all channels. Defaults to None.
+        output_format (str, optional): 'tif', 'tiled-tif' or 'ome-zarr'. Defaults to 'tif'.
+        dtype (optional): Working dtype of the tile processing. Defaults to np.float32.
+        refine_positions (bool, optional): Whether the tile positions are refined from their overlaps. Defaults to False.
+        projection (str, optional): Projection written across the layers of a section. Defaults to None.
+        compression (str, optional): Compression of the tiled TIFF files. Defaults to None.
+        deformation_backend (str, optional): Backend of the deformation correction. Defaults to 'sparse'.
+        save_undistorted (bool, optional): Whether the tiles are also saved without distortion correction. Defaults to False.
+        tile_stats (bool, optional): Whether the quality control statistics of the tiles are written. Defaults to False.
+
+    Returns:
+        dict: Stitching parameters recorded in the run manifest
+    """
+    return {'thresh': thresh, 
+            'median_thresh': median_thresh, 
+            'mask_channel': mask_channel, 
+            'output_format': output_format, 
+            'dtype': np.dtype(dtype).name, 
+            'refine_positions': refine_positions, 
+            'projection': projection, 
+            'compression': compression, 
+            'deformation_backend': deformation_backend, 
+            'save_undistorted': save_undistorted, 
+            'tile_stats': tile_stats, 
+            'average_tiles': hash_arrays(*avg_tiles), 
+            'deformation': hash_arrays(H, pX_, pY_)}
+
+
+def get_pending_sections(section_jsons: list, manifest: StitchManifest, channels: list, parameters: dict, 
+                         n_threads: int) -> list:
+    """Filters out the sections that were already stitched with the same inputs and parameters.
+
+    Args:
+        section_jsons (list): Data for each section
+        manifest (StitchManifest): Run manifest of the output directory
+        channels (list): Zero-indexed channels to stitch
+        parameters (dict): Stitching parameters
+        n_threads (int): Number of threads checking the input tiles
+
+    Returns:
+        list: Data for each section that is new, changed or failed
+    """
+    needs_stitching = Parallel(n_jobs=n_threads, prefer='threads')(delayed(manifest.needs_stitching)(section_json, channels, parameters) 
+                                                                   for section_json in section_jsons)
+    pending = [section_json for section_json, pending in zip(section_jsons, needs_stitching) if pending]
+    logging.info('{0} of {1} sections need stitching'.format(len(pending), len(section_jsons)))
+    return pending
+
+
+def project_layers(image: np.ndarray, channel: int, nchannels: int, nlayers: int, projection: str = 'max') -> np.ndarray:
+    """Projects a channel across the layers stitched into the planes of a section image.
+
+    Args:
+        image (np.ndarray): Section image with nchannels planes for each layer
+        channel (int): Plane of the channel within a layer
+        nchannels (int): Planes of each layer
+        nlayers (int): Number of layers
+        projection (str, optional): 'max' for the maximum intensity or 'mean' for the mean. Defaults to 'max'.
+
+    Returns:
+        np.ndarray: Projected plane
+    """
+    planes = (image[:,:,i * nchannels + channel] for i in range(nlayers))
+    if projection == 'max':
+        projected = np.array(next(planes))
+        for plane in planes:
+            np.maximum(projected, plane, out=projected)
+        return projected
+    if projection == 'mean':
+        projected = np.zeros(image.shape[:2], dtype=np.float32)
+        for plane in planes:
+            projected += plane
+        projected /= nlayers
+        return np.rint(projected).astype(image.dtype)
+    raise ValueError('unknown projection: {0}'.format(projection))
+
+
+def publish_shared_state(avg_tiles: list, H, pX_, pY_, directory: str = None, dtype=np.float32, 
+                         cache_dir: str = None) -> SharedArrays:
+    """Publishes the read-only state of every section once, for the workers to memory-map. The deformation 
+    lookup operator is loaded from its cache, or built, here once for the run instead of by every section.
+
+    Args:
+        avg_tiles (list): List of average tiles for each channel
+        H (_type_): Homography information
+        pX_ (_type_): _description_
+        pY_ (_type_): _description_
+        directory (str, optional): Directory for the shared files. Defaults to the system temp directory.
+        dtype (optional): Working dtype of the tile processing. Defaults to np.float32.
+        cache_dir (str, optional): Directory the deformation operator is cached in, e.g. the directory of the 
+                                   Bezier patch file. If None, it is built without caching. Defaults to None.
+
+    Returns:
+        SharedArrays: Shared average tiles, homography, deformation map and deformation operator
+    """
+    operator = load_deformation_operator(pX_, pY_, TILE_SHAPE, dtype, cache_dir)
+    return SharedArrays({'average_tiles': np.stack(avg_tiles), 'H': H, 'pX_': pX_, 'pY_': pY_, 
+                         'operator_data': operator.data, 'operator_indices': operator.indices, 
+                         'operator_indptr': operator.indptr, 'operator_shape': np.asarray(operator.shape)}, directory)
+
+
+def stitch_shared_section(data: dict, shared: SharedArrays, output_dir: str, *args, **kwargs):
+    """Stitches a section with the average tiles and deformation map attached from the shared state. 
+    The remaining arguments are passed to stitch_section.
+
+    Args:
+        data (dict): Section data
+        shared (SharedArrays): State published by publish_shared_state
+        output_dir (str): Output directory to save stitched images
+    """
+    operator = scipy.sparse.csr_matrix((shared['operator_data'], shared['operator_indices'], shared['operator_indptr']), 
+                                       shape=tuple(shared['operator_shape']))
+    return stitch_section(data, shared['average_tiles'], output_dir, shared['H'], shared['pX_'], shared['pY_'], 
+                          *args, operator=operator, **kwargs)
+
+
 def stitch_section(data: dict, avg_tiles: list, output_dir: str, H, pX_, pY_, 
                    thresh: int = 15, ch: int = None, 
-                   save_undistorted: bool = False, median_thresh=None):
-    """Stitches the tiles together to create a complete section.
+                   save_undistorted: bool = False, median_thresh=None, tile_store=None, 
+                   manifest: StitchManifest = None, parameters: dict = None, mask_channel: int = None, 
+                   canvas: str = 'memory', scratch_dir: str = None, zarr_writer: OmeZarrWriter = None, 
+                   dtype=np.float32, n_workers: int = 1, refine_positions: bool = False, tile_stats: bool = False, 
+                   projection: str = None, tif_writer: TiledTifWriter = None, deformation_backend: str = 'sparse', 
+                   operator: scipy.sparse.csr_matrix = None):
+    """Stitches the tiles together to create a complete section. The layers of a section merged by 
+    merge_section_layers are stitched together and written as separate sections.
 
     Args:
         data (dict): Section data
@@ -577,35 +1058,105 @@ def stitch_section(data: dict, avg_tiles: list, output_dir: str, H, pX_, pY_,
         pY_ (_type_): _description_
         ch (int, optional): Which channel to stitch for. If None is provided, stitch all channels. Defaults to None.
         save_undistorted (bool, optional): Whether or not to save without distortion correction. Defaults to False.
+        tile_store (SectionTileStore, optional): Spill store with tiles decoded while generating average tiles. Defaults to None.
+        manifest (StitchManifest, optional): Run manifest to record the stitched channels in. Defaults to None.
+        parameters (dict, optional): Stitching parameters recorded in the manifest. Defaults to None.
+        mask_channel (int, optional): Zero-indexed channel whose tissue mask is shared by all channels. Defaults to None.
+        canvas (str, optional): 'memory' to hold the section image in RAM or 'memmap' to back it with a scratch file 
+                                so resident memory stays bounded. Defaults to 'memory'.
+        scratch_dir (str, optional): Directory for the memmap scratch files. Defaults to the system temp directory.
+        zarr_writer (OmeZarrWriter, optional): Writes the section into an OME-Zarr volume instead of 
+                                               one TIFF per channel. Defaults to None.
+        dtype (optional): Working dtype of the tile processing and blending. Defaults to np.float32.
+        n_workers (int, optional): Threads reading and processing the tiles of the section. Defaults to 1.
+        refine_positions (bool, optional): If True, the tile positions are refined from the overlaps of the mask 
+                                           channel, or the first channel, before stitching. Defaults to False.
+        tile_stats (bool, optional): If True, the quality control statistics of the tiles are written to 
+                                     <output_dir>/tile_stats. Defaults to False.
+        projection (str, optional): 'max' or 'mean' to also write the projection of the layers of a merged section 
+                                    to stitched_ch<channel>_<projection>. Defaults to None.
+        tif_writer (TiledTifWriter, optional): Writes the sections as tiled, compressed TIFF files with reduced 
+                                               resolution levels. Defaults to None.
+        deformation_backend (str, optional): 'sparse' to correct deformation with a sparse operator or 'numba' 
+                                             with a compiled parallel kernel. Defaults to 'sparse'.
+        operator (scipy.sparse.csr_matrix, optional): Deformation lookup operator built once for the run. If None, 
+                                                      it is built for the section. Defaults to None.
+    """
+    write = write_output if tif_writer is None else tif_writer.write
+    channels = list(range(len(data['channels']))) if ch is None else [ch]
+    layers = data.get('layers', [data])
+    # One deformation correction for the position refinement and the stitching of the section
+    deformation = DeformationCorrector(H, pX_, pY_, dtype=dtype, backend=deformation_backend, operator=operator)
+
+    # Input state is taken before reading so tiles changing during the run are stitched again
+    if manifest is not None:
+        inputs = {(i, c): manifest.get_inputs(layer, c) for i, layer in enumerate(layers) for c in channels}
+
+    try:
+        stats = [] if tile_stats else None
+        registration_channel = mask_channel if mask_channel is not None else 0
+        # Positions are registered on the tiles processed for stitching, unless the registered channel 
+        # is not stitched as is and has to be read and corrected in a separate pass
+        separate_registration = refine_positions and (ch not in (None, registration_channel) or median_thresh is not None)
+        if separate_registration:
+            data = refine_tile_positions(data, avg_tiles, H, pX_, pY_, output_dir, thresh, registration_channel, 
+                                         tile_store, dtype, deformation_backend, deformation)
+        images = generate_tiles(data['tiles'], avg_tiles, H, pX_, pY_, thresh, ch, save_undistorted, median_thresh, tile_store, 
+                                mask_channel, dtype, n_workers, stats, deformation_backend, deformation)
+        if refine_positions and not separate_registration:
+            data, images = refine_stitched_tile_positions(data, get_tile_groups(data['tiles'], ch), images, output_dir, 
+                                                          thresh, registration_channel, scratch_dir)
+        table = TileTable.from_groups(get_tile_groups(data['tiles'], ch))
+        # Only the requested channels are allocated in the section image, one plane per channel of every layer
+        nchannels = len(data['channels'])
+        planes = [i * nchannels + c + 1 for i in range(len(layers)) for c in channels]
+        stitcher = Stitcher(data['image_dimensions'], table, images, planes, canvas, scratch_dir, dtype)
+        image, missing = stitcher.run()
+        del images
+        missing_tile_paths = get_missing_tile_paths(missing)
+
+        for i, layer in enumerate(layers):
+            for j, ch in enumerate(channels):
+                plane = image[:,:,i * len(channels) + j]
+                if zarr_writer is not None:
+                    slice_path = zarr_writer.get_channel_path(ch)
+                    zarr_writer.write_section(layer, ch, plane)
+                else:
+                    slice_path = os.path.join(output_dir, "stitched_ch{}".format(ch), layer['slice_fname'] + "_{}.tif".format(ch))
+                    print(slice_path)
+                    write(np.ascontiguousarray(plane), slice_path)
+                if manifest is not None:
+                    manifest.record(layer, ch, inputs[(i, ch)], parameters, slice_path)
+            if stats is not None:
+                write_section_stats([dict(section=layer['slice_fname'], **row) for row in stats if row['layer'] == i], 
+                                    output_dir, layer['slice_fname'])
+
+        if projection is not None and len(layers) > 1:
+            for j, ch in enumerate(channels):
+                projection_dir = os.path.join(output_dir, "stitched_ch{}_{}".format(ch, projection))
+                os.makedirs(projection_dir, exist_ok=True)
+                write(project_layers(image, j, len(channels), len(layers), projection), 
+                      os.path.join(projection_dir, data['section_name'] + "_{}.tif".format(ch)))
+        read_stats.log()
+    except Exception:
+        if manifest is not None:
+            for i, layer in enumerate(layers):
+                for c in channels:
+                    if not manifest.is_stitched(layer, c, parameters):
+                        manifest.record(layer, c, inputs[(i, c)], parameters, status='failed')
+        raise
+    """
+    # Writing temp median mask for preview
+    print("Writing mask files for preview...")
+    mask_tiles = generate_tiles(data['tiles'], avg_tiles, H, pX_, pY_, thresh, ch, save_undistorted, 
+                                median_thresh=20.0)
+    mask_path = os.path.join(output_dir, "stitched_ch{}".format(ch), data['slice_fname'] + "_{}_median_mask.tif".format(ch))
+    mask_stitcher = Stitcher(data['image_dimensions'], mask_tiles, data['channels'])
+    mask, mask_missing = mask_stitcher.run()
+    del mask_tiles
+    missing_mask_paths = get_missing_tile_paths(mask_missing)
+    write_output(np.ascontiguousarray(mask[:,:,ch]), mask_path)
     """
-    
-    tiles = generate_tiles(data['tiles'], avg_tiles, H, pX_, pY_, thresh, ch, save_undistorted, median_thresh)
-    stitcher = Stitcher(data['image_dimensions'], tiles, data['channels'])
-    image, missing = stitcher.run()
-    del tiles
-    missing_tile_paths = get_missing_tile_paths(missing)
-
-    if ch is None:
-        for ch in range(image.shape[2]):
-            slice_path = os.path.join(output_dir, "stitched_ch{}".format(ch), data['slice_fname'] + "_{}.tif".format(ch))
-            print(slice_path)
-            write_output(np.ascontiguousarray(image[:,:,ch]), slice_path)
-    else:
-        slice_path = os.path.join(output_dir, "stitched_ch{}".format(ch), data['slice_fname'] + "_{}.tif".format(ch))
-        print(slice_path)
-        write_output(np.ascontiguousarray(image[:,:,ch]), slice_path)
-        """
-        # Writing temp median mask for preview
-        print("Writing mask files for preview...")
-        mask_tiles = generate_tiles(data['tiles'], avg_tiles, H, pX_, pY_, thresh, ch, save_undistorted, 
-                                    median_thresh=20.0)
-        mask_path = os.path.join(output_dir, "stitched_ch{}".format(ch), data['slice_fname'] + "_{}_median_mask.tif".format(ch))
-        mask_stitcher = Stitcher(data['image_dimensions'], mask_tiles, data['channels'])
-        mask, mask_missing = mask_stitcher.run()
-        del mask_tiles
-        missing_mask_paths = get_missing_tile_paths(mask_missing)
-        write_output(np.ascontiguousarray(mask[:,:,ch]), mask_path)
-        """
        
 
 if __name__ == '__main__':
@@ -620,13 +1171,9 @@ if __name__ == '__main__':
     corners1 = np.asarray([[33, 10], [796, 21], [30, 813], [793, 818]])
     corners2 = np.asarray([[20, 20], [776, 20], [20, 794], [776, 794]])
     H, _ = cv2.findHomography(corners1, corners2)
-    gridp = create_perfect_grid(42, 43, 4, 18)
-    gridp = gridp[20:794, 20:776]
-
-    kx, ky = joblib.load("bezier16x.pkl")
 
-    # Double the size to preserve sampling, need to downsample later
-    pX_, pY_ = get_deformation_map(gridp.shape[0], gridp.shape[1], kx, ky)
+    # Double the size to preserve sampling, need to downsample later. Cached next to the Bezier file.
+    pX_, pY_ = load_deformation_map("bezier16x.pkl", TILE_SHAPE)
 
 
     # Run main
@@ -637,6 +1184,25 @@ if __name__ == '__main__':
     parser.add_argument('--depth', default = 1, type=int)
     parser.add_argument('--sectionNum', default = -1, type=int)
     parser.add_argument('--save_undistorted', default=False, type=bool)
+    parser.add_argument('--tile_cache_dir', default=None, type=str)
+    parser.add_argument('--tile_cache_gb', default=0, type=float)
+    parser.add_argument('--regenerate_avg_tiles', action='store_true')
+    parser.add_argument('--avg_tile_tolerance', default=None, type=float)
+    parser.add_argument('--restitch_all', action='store_true')
+    parser.add_argument('--mask_channel', default=None, type=int)
+    parser.add_argument('--canvas', default='memory', choices=['memory', 'memmap'], type=str)
+    parser.add_argument('--scratch_dir', default=None, type=str)
+    parser.add_argument('--output_format', default='tif', choices=['tif', 'tiled-tif', 'ome-zarr'], type=str)
+    parser.add_argument('--tif_compression', default='zlib', choices=['zlib', 'zstd'], type=str)
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float64'], type=str)
+    parser.add_argument('--deformation_backend', default='sparse', choices=['sparse', 'numba'], type=str)
+    parser.add_argument('--max_workers', default=n_threads, type=int)
+    parser.add_argument('--tile_workers', default=1, type=int)
+    parser.add_argument('--memory_gb', default=None, type=float)
+    parser.add_argument('--refine_positions', action='store_true')
+    parser.add_argument('--abort_on_missing', action='store_true')
+    parser.add_argument('--tile_stats', action='store_true')
+    parser.add_argument('--projection', default=None, choices=['max', 'mean'], type=str)
     args = parser.parse_args()
     channel = None
     thresh = 15
@@ -651,7 +1217,8 @@ if __name__ == '__main__':
         os.mkdir(output_dir)
 
     print("Creating stitching JSON for sections")
-    mosaic_data, section_jsons = get_section_data(root_dir, n_threads, depth, sectionNum)
+    mosaic_data, section_jsons = get_section_data(root_dir, n_threads, depth, sectionNum, 
+                                                  os.path.join(output_dir, "tile_index"))
 
     channel_count = int(mosaic_data['channels'])
     print("Creating intermediate directories")
@@ -673,17 +1240,97 @@ if __name__ == '__main__':
 
     # Generate average tiles if all sections are being stitched
     average_tiles = []
+    tile_cache = None
     if sectionNum == -1:
         avg_tiles_dir = os.path.join(output_dir,"avg_tiles")
+        # With --tile_cache_gb, keep decoded tiles on local scratch so stitching does not read them again, 
+        # unless only a sample of the tiles is read
+        if args.tile_cache_gb > 0 and args.avg_tile_tolerance is None:
+            tile_cache = TileCache(args.tile_cache_dir, int(args.tile_cache_gb * 1024**3))
         print("Generating average tiles")
-        generate_avg_tiles(section_jsons, avg_tiles_dir, n_threads, median_thresh)
+        if not generate_avg_tiles(section_jsons, avg_tiles_dir, n_threads, median_thresh, tile_cache, 
+                                  args.regenerate_avg_tiles, args.avg_tile_tolerance) and tile_cache is not None:
+            tile_cache.clear()
+            tile_cache = None
         for i in range(4):
-            average_tiles.append(load_average_tile(os.path.join(avg_tiles_dir,"avg_tile_"+str(i)+".tif")))
+            average_tiles.append(load_average_tile(os.path.join(avg_tiles_dir,"avg_tile_"+str(i)+".tif"), args.dtype))
     # Otherwise, use placeholder average tiles that do not apply any correction.
     else:
         for i in range(4):
-            average_tiles.append(np.ones((832,832)))
+            average_tiles.append(np.ones((832,832), dtype=args.dtype))
+
+    # Only stitch sections that are new, changed or failed since the last run
+    manifest = StitchManifest(output_dir)
+    parameters = get_stitch_parameters(average_tiles, H, pX_, pY_, thresh, mask_channel=args.mask_channel, 
+                                       output_format=args.output_format, dtype=args.dtype, 
+                                       refine_positions=args.refine_positions, projection=args.projection, 
+                                       compression=args.tif_compression if args.output_format == 'tiled-tif' else None, 
+                                       deformation_backend=args.deformation_backend, save_undistorted=save_undistorted, 
+                                       tile_stats=args.tile_stats)
+
+    # Sections are written into one volume with a plane per section and layer
+    zarr_writer = None
+    if args.output_format == 'ome-zarr':
+        nsections = max(get_section_z(section_json, depth) for section_json in section_jsons) + 1
+        zarr_writer = OmeZarrWriter(os.path.join(output_dir, "stitched.ome.zarr"), 
+                                    range(channel_count) if channel is None else [channel], 
+                                    nsections, section_jsons[0]['image_dimensions'], depth)
+        zarr_writer.create()
+    tif_writer = None
+    if args.output_format == 'tiled-tif':
+        tif_writer = TiledTifWriter(compression=args.tif_compression)
+    pending = section_jsons
+    if not args.restitch_all:
+        channels = list(range(channel_count)) if channel is None else [channel]
+        pending = get_pending_sections(section_jsons, manifest, channels, parameters, n_threads)
+    # The layers of a section are stitched together, all of them if any layer is pending
+    pending_names = set(section_json['slice_fname'] for section_json in pending)
+    section_jsons = [merge_section_layers(layers) for layers in group_section_layers(section_jsons) 
+                     if any(layer['slice_fname'] in pending_names for layer in layers)]
+    # Check the tiles of the pending sections against the Mosaic grid before they are stitched, a resumed 
+    # run does not scan the sections that are already stitched
+    print("Checking input tiles")
+    if sectionNum == -1 and "sections" in mosaic_data:
+        expected_sections = list(range(int(mosaic_data["sections"])))
+    else:
+        expected_sections = None
+    section_dirs = get_section_dirs(root_dir, mosaic_data, sectionNum)
+    pending_sections = set(section_json['section_name'] for section_json in section_jsons)
+    report = run_preflight(section_dirs, mosaic_data, depth, os.path.join(output_dir, "tile_index"), n_threads, 
+                           expected_sections, [sno for sno, section_dir in section_dirs.items() 
+                                               if os.path.basename(os.path.normpath(section_dir)) in pending_sections])
+    report_path = os.path.join(output_dir, "preflight_report.json")
+    write_report(report, report_path)
+    if len(report['problems']) > 0 or len(report['missing_sections']) > 0:
+        print("{0} missing or corrupt tiles and {1} missing sections, see {2}".format(
+            len(report['problems']), len(report['missing_sections']), report_path))
+        if args.abort_on_missing:
+            sys.exit(1)
+
     print("Stitching sections...")
+    # Largest sections first, workers attach to the shared state instead of receiving copies
+    section_jsons = get_section_order(section_jsons)
+    n_workers = get_worker_count(section_jsons, channel_count if channel is None else 1, 
+                                 args.max_workers, args.memory_gb, args.canvas, args.tile_workers)
+    shared = publish_shared_state(average_tiles, H, pX_, pY_, args.scratch_dir, args.dtype, 
+                                  os.path.dirname(os.path.abspath("bezier16x.pkl")))
     #Parallel(n_jobs=1, backend=joblib_backend)(delayed(stitch_section)(section_json,average_tiles, output_dir) for section_json in tqdm(section_jsons))
-    Parallel(n_jobs=n_threads, verbose=13)(delayed(stitch_section)(section_json, average_tiles, output_dir, 
-                                                                   H, pX_, pY_, thresh, channel, save_undistorted) for section_json in section_jsons)
+    Parallel(n_jobs=n_workers, batch_size=1, verbose=13)(delayed(stitch_shared_section)(section_json, shared, output_dir, 
+                                                                                        thresh, channel, save_undistorted, None, 
+                                                                                        get_tile_store(tile_cache, section_json), 
+                                                                                        manifest, parameters, args.mask_channel, 
+                                                                                        args.canvas, args.scratch_dir, zarr_writer, 
+                                                                                        np.dtype(args.dtype), 
+                                                                                        n_workers=args.tile_workers, 
+                                                                                        refine_positions=args.refine_positions, 
+                                                                                        tile_stats=args.tile_stats, 
+                                                                                        projection=args.projection, 
+                                                                                        tif_writer=tif_writer, 
+                                                                                        deformation_backend=args.deformation_backend) 
+                                                         for section_json in section_jsons)
+    shared.close()
+    if args.tile_stats:
+        merge_tile_stats(output_dir)
+    if tile_cache is not None:
+        tile_cache.log_stats()
+        tile_cache.clear()
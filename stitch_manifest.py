@@ -0,0 +1,178 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Run manifest for incremental stitching. Every stitched section and channel records the size and
+modification time of its input tiles, the stitching parameters and a checksum of its output, so a
+re-run only stitches the sections that are new, changed or did not finish.
+"""
+
+# Standard library imports
+import os
+import json
+import hashlib
+import logging
+
+# Third party imports
+import numpy as np
+
+
+def hash_arrays(*arrays) -> str:
+    """Content hash of a set of arrays, used to fingerprint stitching inputs like the average tiles.
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def hash_file(path: str, chunk_size: int = 16 * 1024**2) -> str:
+    """Content hash of a file.
+
+    Args:
+        path (str): File path
+        chunk_size (int, optional): Bytes read at a time. Defaults to 16 MB.
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_file_state(path: str):
+    """Size and modification time of a file.
+
+    Args:
+        path (str): File path
+
+    Returns:
+        list: Modification time (ns) and size, or None if the file does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class StitchManifest(object):
+
+    def __init__(self, output_dir):
+
+        self.manifest_dir = os.path.join(output_dir, 'manifest')
+        if not os.path.isdir(self.manifest_dir):
+            os.makedirs(self.manifest_dir)
+
+
+    def get_path(self, data: dict) -> str:
+        return os.path.join(self.manifest_dir, data['slice_fname'] + '.json')
+
+
+    def load(self, data: dict) -> dict:
+        path = self.get_path(data)
+        if not os.path.exists(path):
+            return {'channels': {}}
+        try:
+            with open(path) as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError) as err:
+            logging.warning('Could not read manifest {0}: {1}'.format(path, err))
+            return {'channels': {}}
+
+
+    def save(self, data: dict, record: dict):
+        # write then rename so an interrupted run never leaves a truncated manifest
+        path = self.get_path(data)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(record, fp, indent=1)
+        os.replace(path + '.tmp', path)
+
+
+    @staticmethod
+    def get_inputs(data: dict, ch: int) -> dict:
+        """Size and modification time of every input tile of a channel.
+
+        Args:
+            data (dict): Section data
+            ch (int): Zero-indexed channel
+
+        Returns:
+            dict: File state for each tile path
+        """
+        return {tile['path']: get_file_state(tile['path']) for tile in data['tiles'] if tile['channel'] - 1 == ch}
+
+
+    def is_stitched(self, data: dict, ch: int, parameters: dict, record: dict = None) -> bool:
+        """Checks whether a section channel was stitched from the current inputs and parameters and
+        its output is untouched.
+
+        Args:
+            data (dict): Section data
+            ch (int): Zero-indexed channel
+            parameters (dict): Stitching parameters
+            record (dict, optional): Manifest record of the section, loaded if not provided. Defaults to None.
+
+        Returns:
+            bool: True if the channel does not need to be stitched again
+        """
+        if record is None:
+            record = self.load(data)
+
+        entry = record['channels'].get(str(ch))
+        if entry is None or entry.get('status') != 'done':
+            return False
+        if entry['parameters'] != parameters:
+            return False
+        if 'output_state' in entry:
+            if get_file_state(entry['output']) != entry['output_state']:
+                return False
+        elif entry['output'] is not None and not os.path.exists(entry['output']):
+            # outputs written into a shared volume are only checked for existence
+            return False
+        return entry['inputs'] == self.get_inputs(data, ch)
+
+
+    def needs_stitching(self, data: dict, channels: list, parameters: dict) -> bool:
+        """Checks whether any of the requested channels of a section is new, changed or failed.
+
+        Args:
+            data (dict): Section data
+            channels (list): Zero-indexed channels to stitch
+            parameters (dict): Stitching parameters
+
+        Returns:
+            bool: True if the section has to be stitched
+        """
+        record = self.load(data)
+        return not all(self.is_stitched(data, ch, parameters, record) for ch in channels)
+
+
+    def record(self, data: dict, ch: int, inputs: dict, parameters: dict, output_path: str = None, status: str = 'done'):
+        """Records the result of stitching a section channel.
+
+        Args:
+            data (dict): Section data
+            ch (int): Zero-indexed channel
+            inputs (dict): File state of the input tiles, taken before they were read
+            parameters (dict): Stitching parameters
+            output_path (str, optional): Stitched output file. Defaults to None.
+            status (str, optional): 'done' or 'failed'. Defaults to 'done'.
+        """
+        entry = {'status': status, 'inputs': inputs, 'parameters': parameters, 'output': output_path}
+        if output_path is not None and status == 'done' and os.path.isfile(output_path):
+            entry['output_state'] = get_file_state(output_path)
+            entry['checksum'] = hash_file(output_path)
+
+        record = self.load(data)
+        record['channels'][str(ch)] = entry
+        self.save(data, record)
@@ -0,0 +1,114 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Scheduling of the section stitching workers. The read-only state every section needs (average
+tiles, homography and deformation map) is published once as memory-mapped .npy files that the
+workers attach to instead of receiving a pickled copy with every section. Sections are handed out
+largest first so the run does not end waiting on one big section, and the number of workers is
+capped separately from the memory budget.
+"""
+
+# Standard library imports
+import os
+import shutil
+import logging
+import tempfile
+
+# Third party imports
+import joblib
+import numpy as np
+
+
+class SharedArrays(object):
+
+    def __init__(self, arrays, directory=None):
+
+        self.directory = tempfile.mkdtemp(prefix='shared_arrays_', dir=directory)
+        self.paths = {}
+        for name, array in arrays.items():
+            path = os.path.join(self.directory, name + '.npy')
+            np.save(path, np.asarray(array))
+            self.paths[name] = path
+
+        # memory-mapped lazily in every process, only the paths are pickled
+        self._arrays = None
+
+
+    def __getitem__(self, name):
+        if self._arrays is None:
+            self._arrays = {name: np.load(path, mmap_mode='r') for name, path in self.paths.items()}
+        return self._arrays[name]
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+
+    def close(self):
+        self._arrays = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def estimate_section_bytes(data: dict, nchannels: int, canvas: str = 'memory') -> int:
+    """Estimates the peak memory of stitching a section.
+
+    Args:
+        data (dict): Section data
+        nchannels (int): Number of channels stitched together
+        canvas (str, optional): Canvas backend of the section image. Defaults to 'memory'.
+
+    Returns:
+        int: Estimated bytes
+    """
+    pixels = data['image_dimensions']['row'] * data['image_dimensions']['column']
+    # the layers of a merged section are stitched into one image
+    nchannels *= len(data.get('layers', [data]))
+    # one uint16 plane is copied out for writing
+    nbytes = pixels * 2
+    if canvas == 'memory':
+        # uint16 section image and int8 stitched indicator
+        nbytes += pixels * nchannels * 3
+    return nbytes
+
+
+def get_section_order(section_jsons: list) -> list:
+    """Orders the sections largest first, so the last sections to finish are the short ones.
+
+    Args:
+        section_jsons (list): Data for each section
+
+    Returns:
+        list: Data for each section, largest first
+    """
+    return sorted(section_jsons, key=lambda data: len(data['tiles']), reverse=True)
+
+
+def get_worker_count(section_jsons: list, nchannels: int, max_workers: int = -3, memory_gb: float = None,
+                     canvas: str = 'memory', tile_workers: int = 1) -> int:
+    """Number of stitching workers, capped by max_workers and by the memory budget.
+
+    Args:
+        section_jsons (list): Data for each section
+        nchannels (int): Number of channels stitched together
+        max_workers (int, optional): Worker cap, negative values count back from the number of CPUs
+                                     like joblib. Defaults to -3.
+        memory_gb (float, optional): Memory budget for all workers. If None, only max_workers applies.
+                                     Defaults to None.
+        canvas (str, optional): Canvas backend of the section image. Defaults to 'memory'.
+        tile_workers (int, optional): Threads each worker processes the tiles of its section with, which
+                                      share the worker cap. Defaults to 1.
+
+    Returns:
+        int: Number of workers
+    """
+    workers = joblib.effective_n_jobs(max_workers) // max(1, tile_workers)
+    if memory_gb is not None and len(section_jsons) > 0:
+        section_bytes = max(estimate_section_bytes(data, nchannels, canvas) for data in section_jsons)
+        workers = min(workers, int(memory_gb * 1024**3 // section_bytes))
+    workers = max(1, min(workers, len(section_jsons)))
+    logging.info('Stitching {0} sections with {1} workers'.format(len(section_jsons), workers))
+    return workers
@@ -4,142 +4,219 @@ Code provided from Allen Institute
 
 
 import logging
+import tempfile
 import operator as op
-from collections import defaultdict
-from six.moves import reduce
+from collections import OrderedDict
 
 import numpy as np
 
 class Stitcher(object):
 
 
-    def __init__(self, image_dimensions, tiles, channels):
+    def __init__(self, image_dimensions, table, images, channels, canvas='memory', scratch_dir=None, dtype=np.float32):
         
         logging.info('image_dimensions: {0}'.format(image_dimensions))
         self.image_dimensions = image_dimensions
 
+        # 'memory' keeps the section image in RAM, 'memmap' backs it with a scratch file
+        self.canvas = canvas
+        self.scratch_dir = scratch_dir
 
-        self.tiles = tiles
+        # working dtype of the blend
+        self.dtype = dtype
+
+
+        # tile positions, and the image of each position in table order (None if missing)
+        self.table = table
+        self.images = images
         self.channels = channels
 
+        # channels are one-indexed, tiles are zero-indexed. Only these channels are allocated.
+        self.channel_index = {channel - 1: i for i, channel in enumerate(channels)}
+
+        self.blend_masks = BlendMaskCache()
+
 
     def run(self, cb=np.array):
 
-        slice_image, stitched_indicator = initialize_images(self.image_dimensions, len(self.channels))
+        slice_image, stitched_indicator = initialize_images(self.image_dimensions, len(self.channels), 
+                                                            self.canvas, self.scratch_dir)
         missing_tiles = {}
 
-        for tile in self.tiles:
+        regions = self.table.get_regions()
+        for i, image in enumerate(self.images):
             
-            if tile.is_missing:
+            channels = [self.channel_index[channel] for channel in self.table.get_channels(i).tolist()]
+            if image is None:
 
-                missing_tiles[tile.index] = tile.get_missing_path()
-                tile.initialize_image()
+                self.table.records['missing'][i] = True
+                missing_tiles[int(self.table.records['index'][i])] = self.table.get_missing_path(i)
+                logging.info('initializing tile image to 0')
+                image = np.zeros(self.table.get_shape(i) + (len(channels),), dtype=slice_image.dtype)
 
             else:
-                tile.trim_self()
+                image = self.table.trim(i, image)
 
-            self.stitch(slice_image, stitched_indicator, tile, cb)
+            self.stitch(slice_image, stitched_indicator, regions[i], channels, image, cb)
 
         return slice_image, missing_tiles
 
 
-    def stitch(self, slice_image, stitched_indicator, tile, cb=np.array):
+    def stitch(self, slice_image, stitched_indicator, region, channels, image, cb=np.array):
 
-        region = tile.get_image_region()
-  
-        current_region = slice_image[region[0], region[1], region[2]]
-        indicator_region = stitched_indicator[region[0], region[1], region[2]]
+        images = image.reshape(image.shape[:2] + (len(channels),))
 
-        stup = (tile.size['row'], tile.size['column'])
-        blend = get_blend(indicator_region, stup, cb)
-        blend = make_blended_tile(blend, tile.image, current_region)
+        # every plane is blended against what was stitched in that plane, as a channel or layer missing 
+        # at a neighbouring position leaves its overlap empty. Planes stitched alike share one blend mask.
+        shared_indicator = stitched_indicator[region[0], region[1], channels[0]]
+        shared_blend = self.blend_masks.get(shared_indicator)
         #logging.info('obtained blend')
 
-        slice_image[region[0], region[1], region[2]] = blend
-        stitched_indicator[region[0], region[1], region[2]] = 1
-        #logging.info('updated image region with tile data')
+        for i, channel in enumerate(channels):
+            current_region = slice_image[region[0], region[1], channel]
+            image = images[:, :, i]
 
+            indicator_region = stitched_indicator[region[0], region[1], channel]
+            if i == 0 or np.array_equal(indicator_region, shared_indicator):
+                indicator_region = shared_indicator
+                mask, strips = shared_blend
+            else:
+                mask, strips = self.blend_masks.get(indicator_region)
+
+            # only the overlap strips are blended, the rest of the tile is copied as is
+            blended = [blend_strip(mask[strip], indicator_region[strip], image[strip], current_region[strip], cb, 
+                                   self.dtype) 
+                       for strip in strips]
+            current_region[...] = image
+            for strip, blend in zip(strips, blended):
+                current_region[strip] = blend
+
+        for channel in channels:
+            stitched_indicator[region[0], region[1], channel] = 1
+        #logging.info('updated image region with tile data')
 
-def initialize_image(dimensions, nchannels, dtype, order='C'):
-    return np.zeros((dimensions['row'], dimensions['column'], nchannels), dtype=dtype, order=order)
 
+class BlendMaskCache(object):
+    '''Caches blend weight masks by overlap pattern. The mosaic is a regular grid, 
+    so the same few overlap geometries repeat across tile positions.
+    '''
 
-def initialize_images(dimensions, nchannels):
-    return initialize_image(dimensions, nchannels, np.uint16), initialize_image(dimensions, nchannels, np.int8)
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.masks = OrderedDict()
 
 
-def make_blended_tile(blend, tile, current_region):
-    return np.multiply((1 - blend), tile) + np.multiply(blend, current_region)
+    def get(self, indicator):
 
+        points = get_indicator_bound_points(indicator)
+        key = (indicator.shape, points)
 
-def get_indicator_bound_point(indicator, lg, axis):
-    '''Finds the index of first change in a binary mask 
-    along a specified axis in a specified direction
-    '''
+        if key in self.masks:
+            self.masks.move_to_end(key)
+            return self.masks[key]
 
-    delta = np.diff(indicator, axis=axis)
-    points = np.where(lg(delta, 0))
-    del delta
+        self.masks[key] = get_blend_mask(indicator.shape, points)
+        if len(self.masks) > self.max_size:
+            self.masks.popitem(last=False)
+        return self.masks[key]
 
-    points = np.unique(points[axis])
-    size = indicator.shape[axis]
-    points = points[lg(points, size / 2.0)]
-    
-    if len(points) > 0:
-        return points[-1]
-    return None
 
+def initialize_image(dimensions, nchannels, dtype, order='C', canvas='memory', scratch_dir=None):
 
-def blend_component_from_point(point, mesh, lg):
-    '''Obtains a normalized component of the blend, which describes depth of 
-    overlap along a specified axis in a specified direction
-    '''
+    shape = (dimensions['row'], dimensions['column'], nchannels)
 
-    # this has the effect that the shallowest part of the blend 
-    # is always 0 - symmetric with the deepest after normalization.
-    blend = point - mesh + 1 
-    blend[lg(blend, 0)] = 0
+    if canvas == 'memory':
+        return np.zeros(shape, dtype=dtype, order=order)
+    if canvas == 'memmap':
+        # the anonymous scratch file goes away once the array is released
+        return np.memmap(tempfile.TemporaryFile(dir=scratch_dir), dtype=dtype, mode='w+', shape=shape, order=order)
+    raise ValueError('unknown canvas backend: {0}'.format(canvas))
 
-    blend = np.fabs(blend)
-    mx = np.amax(blend)
-    mx = mx if mx > 0.0 else 1.0
 
-    return blend / mx
+def initialize_images(dimensions, nchannels, canvas='memory', scratch_dir=None):
+    return initialize_image(dimensions, nchannels, np.uint16, canvas=canvas, scratch_dir=scratch_dir), \
+        initialize_image(dimensions, nchannels, np.int8, canvas=canvas, scratch_dir=scratch_dir)
 
 
-def get_blend_component(indicator, lg, axis, meshes):
-    '''
+def blend_strip(mask, indicator, tile, current, cb=np.array, dtype=np.float32):
+    '''Blends a strip of a tile into the current image in the working dtype
     '''
 
-    point = get_indicator_bound_point(indicator, lg, axis)
-    if point is None:
-        return []
+    blend = cb(np.multiply(mask, indicator, dtype=dtype))
+    current = current.astype(dtype)
+    tile = tile.astype(dtype, copy=False)
 
-    return [blend_component_from_point(point, meshes[axis], lg)]
+    # (1 - blend) * tile + blend * current
+    current -= tile
+    current *= blend
+    current += tile
+    return current
 
 
-def get_overall_blend(indicator, meshes):
-    '''
+def get_indicator_bound_points(indicator):
+    '''Finds the bound point of the indicator for each direction and axis, 
+    in the order used by get_blend_mask
     '''
 
-    blends = []
-
+    points = []
     for lg in (op.lt, op.gt):
         for axis in (0, 1):
-            blends.extend(get_blend_component(indicator, lg, axis, meshes))
+            # same as lg(np.diff(indicator, axis=axis), 0) without the subtraction
+            if axis == 0:
+                delta = lg(indicator[1:], indicator[:-1])
+            else:
+                delta = lg(indicator[:, 1:], indicator[:, :-1])
+            changes = np.flatnonzero(np.any(delta, axis=1 - axis))
+            del delta
 
-    if len(blends) == 0:
-        return np.zeros_like(indicator)
-    return reduce(np.maximum, blends)
+            changes = changes[lg(changes, indicator.shape[axis] / 2.0)]
+            points.append(int(changes[-1]) if len(changes) > 0 else None)
+    return tuple(points)
 
 
-def get_blend(indicator_region, stup, cb=np.array):
+def get_blend_mask(shape, points):
+    '''Builds the float32 blend weight mask for a set of bound points along with 
+    the strips of the tile where it is nonzero
     '''
+
+    mask = np.zeros(shape, dtype=np.float32)
+    profiles = [np.zeros(shape[0], dtype=np.float32), np.zeros(shape[1], dtype=np.float32)]
+
+    for (lg, axis), point in zip([(op.lt, 0), (op.lt, 1), (op.gt, 0), (op.gt, 1)], points):
+        if point is None:
+            continue
+        component = blend_component_from_point(point, np.arange(shape[axis]), lg)
+        np.maximum(profiles[axis], component, out=profiles[axis])
+
+    np.maximum(mask, profiles[0][:, np.newaxis], out=mask)
+    np.maximum(mask, profiles[1][np.newaxis, :], out=mask)
+
+    strips = [(rows, slice(None)) for rows in get_nonzero_ranges(profiles[0])] + \
+             [(slice(None), cols) for cols in get_nonzero_ranges(profiles[1])]
+    return mask, strips
+
+
+def get_nonzero_ranges(profile):
+    '''Contiguous ranges where a 1D profile is nonzero, as slices
     '''
 
-    meshes = np.meshgrid(*map(np.arange, stup), indexing='ij')
-    blend = get_overall_blend(indicator_region, meshes)
+    nonzero = np.concatenate([[False], profile > 0, [False]])
+    edges = np.flatnonzero(np.diff(nonzero.astype(np.int8)))
+    return [slice(int(start), int(end)) for start, end in zip(edges[::2], edges[1::2])]
 
-    return cb(np.multiply(blend, indicator_region))
 
-        
+def blend_component_from_point(point, mesh, lg):
+    '''Obtains a normalized component of the blend, which describes depth of 
+    overlap along a specified axis in a specified direction
+    '''
+
+    # this has the effect that the shallowest part of the blend 
+    # is always 0 - symmetric with the deepest after normalization.
+    blend = point - mesh + 1 
+    blend[lg(blend, 0)] = 0
+
+    blend = np.fabs(blend)
+    mx = np.amax(blend)
+    mx = mx if mx > 0.0 else 1.0
+
+    return blend / mx
@@ -0,0 +1,14 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Test setup. The stitching modules are flat top-level modules, so the repository root is put on
+the import path.
+"""
+
+# Standard library imports
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,148 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Equivalence of the deformation correction backends with the original correct_deformation on fixed tiles.
+The numba backend is only tested when numba is installed.
+"""
+
+# Standard library imports
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party imports
+import cv2
+import joblib
+import numpy as np
+import pytest
+from skimage.transform import resize
+
+# Local imports
+from deformation import TILE_SHAPE, DeformationCorrector, build_deformation_operator, get_deformation_map, \
+    load_deformation_operator
+
+BEZIER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bezier16x.pkl')
+
+
+def correct_deformation(im0: np.ndarray, H, pX_, pY_) -> np.ndarray:
+    """The deformation correction of the stitching script before the lookup was cached, as reference."""
+    im_warp = cv2.warpPerspective(im0, H, (im0.shape[1], im0.shape[0]))
+    im_warp = im_warp[20:794, 20:776]
+    h,w  = im_warp.shape
+
+    x1 = np.floor(pX_).astype(int)
+    x2 = np.ceil(pX_).astype(int)
+    y1 = np.floor(pY_).astype(int)
+    y2 = np.ceil(pY_).astype(int)
+
+    dx1 = pX_ - x1
+    dx2 = x2 - pX_
+    dy1 = pY_ - y1
+    dy2 = y2 - pY_
+    dx1[np.where(y1 == y2)] = 1
+    dy1[np.where(x1 == x2)] = 1
+
+    im_warp1d = im_warp.ravel()
+    im = im_warp1d[y1 * w + x1] * dx1 * dy1 + \
+         im_warp1d[y1 * w + x2] * dx2 * dy1 + \
+         im_warp1d[y2 * w+ x1] * dy2 * dx1 + \
+         im_warp1d[y2 * w + x2] * dy2 * dx2
+
+    im = np.reshape(im, (2 * h, 2 * w))
+    im = resize(im, (h, w), preserve_range=True)
+    return im
+
+
+def to_uint16(image: np.ndarray) -> np.ndarray:
+    # Written sections are clipped and truncated to uint16
+    return np.clip(image, 0, 65535).astype(np.uint16).astype(np.int64)
+
+
+@pytest.fixture
+def numba():
+    return pytest.importorskip('numba')
+
+
+@pytest.fixture(scope='module')
+def deformation():
+    corners1 = np.asarray([[33, 10], [796, 21], [30, 813], [793, 818]])
+    corners2 = np.asarray([[20, 20], [776, 20], [20, 794], [776, 794]])
+    H, _ = cv2.findHomography(corners1, corners2)
+    kx, ky = joblib.load(BEZIER_PATH)
+    pX_, pY_ = get_deformation_map(TILE_SHAPE[0], TILE_SHAPE[1], kx, ky)
+    return H, pX_, pY_
+
+
+@pytest.fixture(scope='module')
+def tiles():
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[0:832, 0:832]
+    smooth = 1000 + 800 * np.sin(cols / 40.0) * np.cos(rows / 55.0) + rng.normal(0, 20, (832, 832))
+    return {'noise': rng.integers(0, 4096, (832, 832)).astype(np.uint16),
+            'smooth': np.clip(smooth, 0, 65535).astype(np.uint16),
+            'constant': np.full((832, 832), 500, dtype=np.uint16),
+            'empty': np.zeros((832, 832), dtype=np.uint16)}
+
+
+@pytest.mark.parametrize('name', ['noise', 'smooth', 'constant', 'empty'])
+def test_sparse_matches_correct_deformation(deformation, tiles, name):
+    H, pX_, pY_ = deformation
+    tile = tiles[name].astype(np.float64)
+    expected = correct_deformation(tile, H, pX_, pY_)
+    actual = DeformationCorrector(H, pX_, pY_, dtype=np.float64, backend='sparse').correct(tile)
+
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-6)
+    assert np.abs(to_uint16(actual) - to_uint16(expected)).max() <= 1
+
+
+@pytest.mark.parametrize('name', ['noise', 'smooth', 'constant', 'empty'])
+def test_numba_matches_correct_deformation(numba, deformation, tiles, name):
+    H, pX_, pY_ = deformation
+    tile = tiles[name].astype(np.float64)
+    expected = correct_deformation(tile, H, pX_, pY_)
+    actual = DeformationCorrector(H, pX_, pY_, dtype=np.float64, backend='numba').correct(tile)
+
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-6)
+    assert np.abs(to_uint16(actual) - to_uint16(expected)).max() <= 1
+
+
+@pytest.mark.parametrize('name', ['noise', 'smooth', 'constant', 'empty'])
+def test_numba_matches_sparse_float32(numba, deformation, tiles, name):
+    H, pX_, pY_ = deformation
+    tile = tiles[name].astype(np.float32)
+    expected = DeformationCorrector(H, pX_, pY_, dtype=np.float32).correct(tile)
+    actual = DeformationCorrector(H, pX_, pY_, dtype=np.float32, backend='numba').correct(tile)
+
+    assert actual.dtype == np.float32
+    assert np.abs(to_uint16(actual) - to_uint16(expected)).max() <= 1
+
+
+def test_numba_threads(numba, deformation, tiles):
+    H, pX_, pY_ = deformation
+    corrector = DeformationCorrector(H, pX_, pY_, dtype=np.float32, backend='numba')
+    corrector.build()
+    images = [tiles[name].astype(np.float32) for name in ('noise', 'smooth', 'constant', 'empty')] * 2
+    expected = [corrector.correct(image) for image in images]
+
+    # Every thread corrects into its own scratch buffers
+    with ThreadPoolExecutor(4) as pool:
+        actual = list(pool.map(corrector.correct, images))
+    for a, e in zip(actual, expected):
+        np.testing.assert_array_equal(a, e)
+
+
+def test_operator_cache(deformation, tmp_path):
+    _, pX_, pY_ = deformation
+    expected = build_deformation_operator(pX_, pY_, TILE_SHAPE, np.float32)
+    built = load_deformation_operator(pX_, pY_, TILE_SHAPE, np.float32, str(tmp_path))
+    assert len(list(tmp_path.glob('deformation_operator_*_float32.npz'))) == 1
+
+    # The second load reads the cached operator back instead of building it
+    loaded = load_deformation_operator(pX_, pY_, TILE_SHAPE, np.float32, str(tmp_path))
+    for operator in (built, loaded):
+        assert operator.dtype == np.float32
+        assert (operator != expected).nnz == 0
+    assert load_deformation_operator(pX_, pY_, TILE_SHAPE, np.float64, str(tmp_path)).dtype == np.float64
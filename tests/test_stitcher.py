@@ -0,0 +1,49 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Stitching the planes of a position together matches stitching every plane on its own, also when a
+plane is absent at some positions.
+"""
+
+# Third party imports
+import numpy as np
+
+# Local imports
+from stitcher import Stitcher
+from tile import TileTable
+
+TILE_SHAPE = (40, 50)
+DIMENSIONS = {'row': 80, 'column': 90}
+
+
+def get_tile(index: int, row: int, column: int) -> dict:
+    return {'index': index, 'channel': 1, 
+            'bounds': {'row': {'start': row, 'end': row + TILE_SHAPE[0]}, 
+                       'column': {'start': column, 'end': column + TILE_SHAPE[1]}}, 
+            'margins': {'row': 0, 'column': 0}, 'size': {'row': TILE_SHAPE[0], 'column': TILE_SHAPE[1]}}
+
+
+def stitch(tiles: list, planes: list, images: list, nplanes: int) -> np.ndarray:
+    table = TileTable.from_groups([[tile] for tile in tiles], planes)
+    image, _ = Stitcher(DIMENSIONS, table, images, list(range(1, nplanes + 1))).run()
+    return np.asarray(image)
+
+
+def test_planes_absent_at_a_neighbour():
+    # 2x2 grid overlapping by 10 pixels, the second plane is absent at the first two positions
+    tiles = [get_tile(0, 0, 0), get_tile(1, 0, 40), get_tile(2, 30, 0), get_tile(3, 30, 40)]
+    planes = [[0], [0], [0, 1], [0, 1]]
+    rng = np.random.default_rng(0)
+    images = [rng.integers(100, 1000, TILE_SHAPE + (len(p),)).astype(np.float32) for p in planes]
+    image = stitch(tiles, planes, images, 2)
+
+    for plane in range(2):
+        present = [i for i, p in enumerate(planes) if plane in p]
+        expected = stitch([tiles[i] for i in present], [[0]] * len(present), 
+                          [images[i][:, :, planes[i].index(plane)][:, :, np.newaxis] for i in present], 1)
+        np.testing.assert_array_equal(image[:, :, plane], expected[:, :, 0])
+
+    # The overlap of the second plane with the empty positions above is not darkened
+    assert image[30:40, 5:45, 1].min() >= 100
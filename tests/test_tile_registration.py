@@ -0,0 +1,114 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Neighbour pairs found through the grid cells of get_neighbour_pairs, checked against comparing every
+pair of tiles, and recovery of known tile shifts from synthetic overlaps.
+"""
+
+# Third party imports
+import cv2
+import numpy as np
+import pytest
+
+# Local imports
+from tile_registration import estimate_pair_offset, get_neighbour_pairs, get_overlap_windows, register_tiles, \
+    solve_layout
+
+TILE_SHAPE = (774, 756)
+
+
+def get_all_neighbour_pairs(positions: dict, shape: tuple, min_overlap: int = 8) -> list:
+    """Reference pairing comparing every pair of tiles."""
+    indices = sorted(positions)
+    pairs = []
+    for i, a in enumerate(indices):
+        for b in indices[i + 1:]:
+            overlap = [n - abs(positions[b][axis] - positions[a][axis]) for axis, n in enumerate(shape)]
+            if min(overlap) >= min_overlap and any(o >= n // 2 for o, n in zip(overlap, shape)):
+                pairs.append((a, b))
+    return pairs
+
+
+def get_mosaic_positions(rows: int, columns: int, seed: int, jitter: int = 60) -> dict:
+    """Snake ordered mosaic with the overlaps of create_section_json and random stage drift."""
+    rng = np.random.default_rng(seed)
+    positions = {}
+    for ncol in range(columns):
+        for nrow in range(rows):
+            row = nrow if ncol % 2 == 0 else rows - nrow - 1
+            drift = rng.integers(-jitter, jitter + 1, 2)
+            positions[ncol * rows + nrow] = (int(row * (TILE_SHAPE[0] - 43) + ncol * 5 + drift[0]),
+                                             int(ncol * (TILE_SHAPE[1] - 25) - row * 3 + drift[1]))
+    return positions
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_neighbour_pairs_match_all_pairs(seed):
+    positions = get_mosaic_positions(7, 9, seed)
+    assert get_neighbour_pairs(positions, TILE_SHAPE) == get_all_neighbour_pairs(positions, TILE_SHAPE)
+
+
+def test_neighbour_pairs_scattered_positions():
+    # Positions off the grid, with negative starts and tiles overlapping diagonally
+    rng = np.random.default_rng(3)
+    positions = {int(i): tuple(int(v) for v in p) for i, p in enumerate(rng.integers(-2000, 4000, (80, 2)))}
+    assert get_neighbour_pairs(positions, TILE_SHAPE) == get_all_neighbour_pairs(positions, TILE_SHAPE)
+
+
+def test_neighbour_pairs_grid():
+    positions = get_mosaic_positions(2, 2, 0, jitter=0)
+    assert get_neighbour_pairs(positions, TILE_SHAPE) == [(0, 1), (0, 3), (1, 2), (2, 3)]
+
+
+def get_scene(seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return cv2.GaussianBlur(rng.random((2000, 2000)).astype(np.float32), (0, 0), 4) * 4000 + 300
+
+
+def get_tile_info(index: int, row: int, column: int) -> dict:
+    return {'index': index, 'channel': 1, 
+            'bounds': {'row': {'start': row, 'end': row + TILE_SHAPE[0]}, 
+                       'column': {'start': column, 'end': column + TILE_SHAPE[1]}}}
+
+
+def crop(scene: np.ndarray, row: int, column: int) -> np.ndarray:
+    return scene[row:row + TILE_SHAPE[0], column:column + TILE_SHAPE[1]].copy()
+
+
+@pytest.mark.parametrize('shift', [(0, 0), (3, -4), (-6, 2)])
+def test_estimate_pair_offset(shift):
+    scene = get_scene()
+    nominal = (-5, 731)
+    offset = (nominal[0] + shift[0], nominal[1] + shift[1])
+    windows = get_overlap_windows(nominal, TILE_SHAPE, 10)
+    a = crop(scene, 100, 100)
+    b = crop(scene, 100 + offset[0], 100 + offset[1])
+
+    measured, peak = estimate_pair_offset(a[windows[0]], b[windows[1]], nominal, windows)
+    assert measured == offset
+    assert peak > 0.9
+
+
+def test_register_tiles_recovers_shift():
+    # Tile 1 is shifted from its nominal position right of tile 0, tile 2 below tile 0 is empty. The shift 
+    # is split between both tiles of the pair, even so every tile moves by whole pixels.
+    scene = get_scene(1)
+    tiles = [get_tile_info(0, 0, 0), get_tile_info(1, 0, 731), get_tile_info(2, 749, 0)]
+    shift = (4, -6)
+    images = [crop(scene, 100, 100), crop(scene, 100 + shift[0], 100 + 731 + shift[1]), 
+              np.full(TILE_SHAPE, 500, dtype=np.float32)]
+    positions = register_tiles(tiles, images)
+
+    assert (positions[1][0] - positions[0][0], positions[1][1] - positions[0][1]) == (shift[0], 731 + shift[1])
+    assert positions[2] == (749, 0)
+
+
+def test_solve_layout_keeps_unmeasured_tiles():
+    positions = {0: (0, 0), 1: (0, 731), 2: (749, 0), 3: (749, 731)}
+    layout = solve_layout(positions, [(0, 1, (2, 735), 0.9)])
+
+    assert (layout[1][0] - layout[0][0], layout[1][1] - layout[0][1]) == (2, 735)
+    assert layout[2] == positions[2]
+    assert layout[3] == positions[3]
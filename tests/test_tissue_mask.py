@@ -0,0 +1,78 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Accuracy of the tissue masks generated on a downsampled tile, measured by their IoU with the masks
+generate_mask computes at full resolution.
+"""
+
+# Third party imports
+import cv2
+import numpy as np
+import pytest
+
+# Local imports
+from run_tissuecyte_stitching_classic import generate_mask
+
+TILE_SHAPE = (832, 832)
+
+
+def make_tile(tissue: np.ndarray, seed: int) -> np.ndarray:
+    """Tile with a dim noisy background, brighter tissue and sparse bright cells, like the acquisitions."""
+    rng = np.random.default_rng(seed)
+    im = cv2.GaussianBlur(rng.random(TILE_SHAPE), (0, 0), 6) * 20 + 5
+    im = im + tissue * 150
+    ys, xs = rng.integers(0, TILE_SHAPE[0], (2, 300))
+    im[ys, xs] += rng.uniform(500, 5000, len(ys))
+    im = cv2.GaussianBlur(im, (0, 0), 1.0) * 3
+    return np.clip(im, 0, 65535).astype(np.uint16)
+
+
+def get_tissue(name: str) -> np.ndarray:
+    rows, cols = np.mgrid[0:TILE_SHAPE[0], 0:TILE_SHAPE[1]]
+    if name == 'edge':
+        # Section boundary curving through the tile
+        return (cols < 400 + 120 * np.sin(rows / 90.0)).astype(np.float64)
+    if name == 'corner':
+        return ((rows - 832) ** 2 + (cols - 832) ** 2 < 350 ** 2).astype(np.float64)
+    if name == 'holes':
+        # Disk with ventricle-like holes and debris specks outside it
+        tissue = (rows - 416) ** 2 + (cols - 416) ** 2 < 330 ** 2
+        for r, c, radius in [(300, 350, 40), (500, 480, 25), (420, 250, 15)]:
+            tissue &= (rows - r) ** 2 + (cols - c) ** 2 >= radius ** 2
+        for r, c in [(40, 40), (60, 780), (790, 60)]:
+            tissue |= (rows - r) ** 2 + (cols - c) ** 2 < 6 ** 2
+        return tissue.astype(np.float64)
+    if name == 'full':
+        return np.ones(TILE_SHAPE)
+    return np.zeros(TILE_SHAPE)
+
+
+def iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.logical_or(a, b).sum()
+    return np.logical_and(a, b).sum() / float(union) if union > 0 else 1.0
+
+
+@pytest.mark.parametrize('name', ['edge', 'corner', 'holes', 'full'])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_downsampled_mask_iou(name, seed):
+    im = make_tile(get_tissue(name), seed)
+    expected = generate_mask(im.copy(), downsample=1)
+    actual = generate_mask(im.copy(), downsample=4)
+
+    assert actual.shape == expected.shape
+    assert actual.dtype == bool
+    assert iou(actual, expected) >= 0.95
+
+
+def test_downsampled_mask_mean_iou():
+    scores = [iou(generate_mask(im.copy(), downsample=4), generate_mask(im.copy(), downsample=1))
+              for im in [make_tile(get_tissue(name), seed) for name in ('edge', 'corner', 'holes') for seed in range(3)]]
+    assert np.mean(scores) >= 0.98
+
+
+def test_downsampled_mask_background():
+    # IoU is not meaningful on near empty masks, compare the masked fraction of the tile instead
+    im = make_tile(get_tissue('background'), 0)
+    assert abs(generate_mask(im.copy(), downsample=4).mean() - generate_mask(im.copy(), downsample=1).mean()) < 0.01
@@ -0,0 +1,377 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Shared TIFF reader for tiles and stitched sections. Reads go through tifffile when it is installed
+and decodes faster than SimpleITK, and a bounded prefetch queue reads the next files in background
+threads while the current one is processed, so high latency storage overlaps with compute. Read
+throughput is tracked per process and can be reported in MB/s.
+"""
+
+# Standard library imports
+import os
+import time
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party imports
+import cv2
+import numpy as np
+import SimpleITK as sitk
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+def read_tif_sitk(path: str) -> np.ndarray:
+    image = sitk.ReadImage(str(path))
+    return sitk.GetArrayFromImage(image)
+
+
+def read_tif_tifffile(path: str) -> np.ndarray:
+    return tifffile.imread(str(path))
+
+
+class ReadStats(object):
+
+    def __init__(self):
+
+        self.files = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+
+    def add(self, nbytes: int, seconds: float):
+        with self._lock:
+            self.files += 1
+            self.nbytes += nbytes
+            self.seconds += seconds
+
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.nbytes / 1024**2 / self.seconds if self.seconds > 0 else 0.0
+
+
+    def log(self):
+        logging.info('Read {0} files, {1:.1f} MB at {2:.1f} MB/s'.format(self.files, self.nbytes / 1024**2,
+                                                                        self.mb_per_s))
+
+
+# Per-process read statistics and backends chosen by select_backend for every directory and extension
+read_stats = ReadStats()
+_backends = {}
+_backend_lock = threading.Lock()
+
+
+def time_read(read, path: str, repeats: int = 3) -> tuple:
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        image = read(path)
+        seconds.append(time.perf_counter() - start)
+    return image, min(seconds)
+
+
+def get_backend_key(path: str) -> tuple:
+    """Files sharing a directory and extension are written by the same step, e.g. the raw tiles of
+    a section or the stitched sections of a channel, so they share a layout and a backend.
+
+    Args:
+        path (str): TIFF file path
+
+    Returns:
+        tuple: Directory and lower case extension of the file
+    """
+    path = str(path)
+    return os.path.dirname(os.path.abspath(path)), os.path.splitext(path)[1].lower()
+
+
+def select_backend(path: str) -> str:
+    """Picks the faster of SimpleITK and tifffile for a file. Both are timed on cached reads of the
+    same file. If they return different images, tifffile is used, as SimpleITK misreads some layouts
+    like tiled BigTIFF files without raising an error.
+
+    Args:
+        path (str): Sample TIFF file
+
+    Returns:
+        str: 'tifffile' or 'sitk'
+    """
+    if tifffile is None:
+        return 'sitk'
+
+    image, sitk_seconds = time_read(read_tif_sitk, path)
+    try:
+        other, tifffile_seconds = time_read(read_tif_tifffile, path)
+    except Exception as err:
+        logging.info('tifffile cannot read {0}: {1}'.format(path, err))
+        return 'sitk'
+
+    if other.shape != image.shape or other.dtype != image.dtype or not np.array_equal(other, image):
+        logging.info('SimpleITK and tifffile read {0} differently, reading it with tifffile'.format(path))
+        return 'tifffile'
+    backend = 'tifffile' if tifffile_seconds < sitk_seconds else 'sitk'
+    logging.info('Reading TIFF files with {0} (sitk {1:.1f} ms, tifffile {2:.1f} ms)'.format(
+        backend, sitk_seconds * 1000, tifffile_seconds * 1000))
+    return backend
+
+
+def read_tif(path: str, backend: str = None) -> np.ndarray:
+    """Reads a TIFF file into an array, like sitk.GetArrayFromImage(sitk.ReadImage(path)).
+
+    Args:
+        path (str): TIFF file path
+        backend (str, optional): 'sitk' or 'tifffile'. If None, the faster one is selected on the first read
+                                 in every directory, for each file extension. Defaults to None.
+
+    Returns:
+        np.ndarray: Image array
+    """
+    if backend is None:
+        # Selected once for every directory and extension, without probing the files read after it
+        key = get_backend_key(path)
+        with _backend_lock:
+            if key not in _backends:
+                _backends[key] = select_backend(path)
+            backend = _backends[key]
+
+    start = time.perf_counter()
+    if backend == 'tifffile':
+        image = read_tif_tifffile(path)
+    else:
+        image = read_tif_sitk(path)
+    read_stats.add(image.nbytes, time.perf_counter() - start)
+    return image
+
+
+def get_pyramid_levels(path: str) -> list:
+    """Lists the resolution levels stored in a TIFF file, as pyramid series levels or SubIFDs.
+
+    Args:
+        path (str): TIFF file path
+
+    Returns:
+        list: (rows, columns) of every level, full resolution first, with the tifffile.imread keywords reading it
+    """
+    with tifffile.TiffFile(str(path)) as tif:
+        series = tif.series[0]
+        if series.is_pyramidal:
+            return [(level.shape[-2:], {'level': i}) for i, level in enumerate(series.levels)]
+        page = tif.pages[0]
+        subifds = page.pages or []
+        return [(page.shape[:2], {})] + [(subifd.shape[:2], {'subifd': i}) for i, subifd in enumerate(subifds)]
+
+
+def read_tif_downsampled(path: str, factor: int) -> tuple:
+    """Reads a TIFF file at 1/factor resolution. The coarsest stored level at or above the requested
+    resolution is decoded when the file has reduced resolution levels, otherwise the full image is read,
+    and the rest of the reduction is an area average.
+
+    Args:
+        path (str): TIFF file path
+        factor (int): Downsampling factor
+
+    Returns:
+        tuple: Downsampled image array and (rows, columns) of the full resolution image
+    """
+    image = None
+    if tifffile is not None and factor > 1:
+        try:
+            levels = get_pyramid_levels(path)
+            shape = tuple(levels[0][0])
+            level_shape, kwargs = [level for level in levels if shape[0] / float(level[0][0]) <= factor][-1]
+            if len(kwargs) > 0:
+                start = time.perf_counter()
+                image = np.squeeze(tifffile.imread(str(path), **kwargs))
+                read_stats.add(image.nbytes, time.perf_counter() - start)
+        except Exception as err:
+            logging.info('Cannot read the resolution levels of {0}: {1}'.format(path, err))
+    if image is None:
+        image = read_tif(path)
+        shape = image.shape[:2]
+
+    size = (max(shape[1] // factor, 1), max(shape[0] // factor, 1))
+    if (image.shape[1], image.shape[0]) != size:
+        image = cv2.resize(image.astype(np.float32), size, interpolation=cv2.INTER_AREA)
+    return image, shape
+
+
+def read_tif_region(path: str, rows: tuple, columns: tuple, level: int = 0) -> np.ndarray:
+    """Reads a region of a TIFF file. Only the tiles or strips intersecting the region are read and
+    decoded, so a corner of a tiled section costs a few tiles instead of the full plane.
+
+    Args:
+        path (str): TIFF file path
+        rows (tuple): (start, end) rows of the region
+        columns (tuple): (start, end) columns of the region
+        level (int, optional): Resolution level, 0 for full resolution. Defaults to 0.
+
+    Returns:
+        np.ndarray: Image array of the region
+    """
+    if tifffile is None:
+        image = read_tif(path)
+        return image[rows[0]:rows[1], columns[0]:columns[1]]
+
+    start = time.perf_counter()
+    with tifffile.TiffFile(str(path)) as tif:
+        page = tif.series[0].levels[level].pages[0]
+        shape = page.shape[:2]
+        r0, r1 = max(rows[0], 0), min(rows[1], shape[0])
+        c0, c1 = max(columns[0], 0), min(columns[1], shape[1])
+        region = np.zeros((max(r1 - r0, 0), max(c1 - c0, 0)), dtype=page.dtype)
+        if region.size == 0:
+            return region
+        if page.samplesperpixel != 1 or len(page.dataoffsets) == 1:
+            image = np.squeeze(page.asarray())
+            region[:] = image[r0:r1, c0:c1]
+            read_stats.add(region.nbytes, time.perf_counter() - start)
+            return region
+
+        # Tiles are (rows, columns) chunks in row major order, strips span every column
+        chunk_rows, chunk_cols = page.chunks[0], page.chunks[1] if page.is_tiled else shape[1]
+        ncols = -(-shape[1] // chunk_cols)
+        fh = tif.filehandle
+        for i in range(r0 // chunk_rows, (r1 - 1) // chunk_rows + 1):
+            for j in range(c0 // chunk_cols, (c1 - 1) // chunk_cols + 1):
+                index = i * ncols + j
+                with fh.lock:
+                    fh.seek(page.dataoffsets[index])
+                    data = fh.read(page.databytecounts[index])
+                segment = page.decode(data, index)[0]
+                segment = segment.reshape(segment.shape[-3], segment.shape[-2])
+                # Edge tiles are decoded padded to the full tile size
+                top, left = i * chunk_rows, j * chunk_cols
+                tr0, tr1 = max(r0, top), min(r1, top + segment.shape[0], shape[0])
+                tc0, tc1 = max(c0, left), min(c1, left + segment.shape[1], shape[1])
+                region[tr0 - r0:tr1 - r0, tc0 - c0:tc1 - c0] = segment[tr0 - top:tr1 - top, tc0 - left:tc1 - left]
+    read_stats.add(region.nbytes, time.perf_counter() - start)
+    return region
+
+
+def get_level_factor(path: str, factor: int) -> int:
+    """Finds the stored resolution level of a TIFF file downsampled by exactly the given factor.
+
+    Args:
+        path (str): TIFF file path
+        factor (int): Downsampling factor
+
+    Returns:
+        int: Index of the level, or None if the file has no such level
+    """
+    if tifffile is None:
+        return None
+    try:
+        levels = get_pyramid_levels(path)
+    except Exception as err:
+        logging.info('Cannot read the resolution levels of {0}: {1}'.format(path, err))
+        return None
+    shape = levels[0][0]
+    for i, (level_shape, kwargs) in enumerate(levels):
+        if 'subifd' in kwargs:
+            # SubIFDs outside of a pyramid series cannot be selected by level
+            break
+        if all(abs(n / float(factor) - m) < 1 for n, m in zip(shape, level_shape)):
+            return i
+    return None
+
+
+def orient_section(image: np.ndarray) -> np.ndarray:
+    image[image < 0] = 0
+    image = image.T
+    image = np.flip(image, axis=0)
+    image = np.flip(image, axis=1)
+    image = np.squeeze(image)
+    return image
+
+
+def read_section_tif(path: str) -> np.ndarray:
+    """Reads a stitched section and orients it for registration and cell counting.
+
+    Args:
+        path (str): Section TIFF file path
+
+    Returns:
+        np.ndarray: Oriented section image
+    """
+    # SimpleITK cannot decode the tiled sections written by TiledTifWriter
+    return orient_section(read_tif(path, 'tifffile' if tifffile is not None else None))
+
+
+def read_section_region(path: str, rows: tuple, columns: tuple) -> np.ndarray:
+    """Reads a region of a stitched section, in the coordinates of the oriented section.
+
+    Args:
+        path (str): Section TIFF file path
+        rows (tuple): (start, end) rows of the region in the oriented section
+        columns (tuple): (start, end) columns of the region in the oriented section
+
+    Returns:
+        np.ndarray: Oriented image of the region
+    """
+    # The oriented section is the transposed file flipped along both axes
+    if tifffile is not None:
+        with tifffile.TiffFile(str(path)) as tif:
+            nrows, ncols = tif.series[0].shape[-2:]
+    else:
+        nrows, ncols = read_tif(path).shape[:2]
+    rows, columns = [max(rows[0], 0), min(rows[1], ncols)], [max(columns[0], 0), min(columns[1], nrows)]
+    region = read_tif_region(path, (nrows - columns[1], nrows - columns[0]), (ncols - rows[1], ncols - rows[0]))
+    return orient_section(region)
+
+
+def read_section_level(path: str, factor: int) -> np.ndarray:
+    """Reads the stored reduced resolution level of a stitched section downsampled by the given factor.
+
+    Args:
+        path (str): Section TIFF file path
+        factor (int): Downsampling factor
+
+    Returns:
+        np.ndarray: Oriented section image at 1/factor resolution, or None if the file has no such level
+    """
+    level = get_level_factor(path, factor)
+    if level is None:
+        return None
+    start = time.perf_counter()
+    image = np.squeeze(tifffile.imread(str(path), level=level))
+    read_stats.add(image.nbytes, time.perf_counter() - start)
+    return orient_section(image)
+
+
+def prefetch(items, read=read_tif, depth: int = 4, n_threads: int = None):
+    """Reads the next items in background threads while the current one is processed.
+
+    Args:
+        items (iterable): Items to read, e.g. file paths
+        read (callable, optional): Reader called on each item. Defaults to read_tif.
+        depth (int, optional): Number of items read ahead. Defaults to 4.
+        n_threads (int, optional): Reader threads. Defaults to depth.
+
+    Yields:
+        Iterator[tuple]: Each item with the future of its read, whose result() returns the data or raises the read error
+    """
+    items = iter(items)
+    pending = collections.deque()
+    with ThreadPoolExecutor(n_threads or max(depth, 1)) as readers:
+        try:
+            for item in items:
+                pending.append((item, readers.submit(read, item)))
+                if len(pending) > depth:
+                    break
+
+            while pending:
+                item, future = pending.popleft()
+                for next_item in items:
+                    pending.append((next_item, readers.submit(read, next_item)))
+                    break
+                yield item, future
+        finally:
+            for _, future in pending:
+                future.cancel()
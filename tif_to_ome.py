@@ -36,6 +36,8 @@ from ome_zarr.io import parse_url
 from numcodecs import Blosc
 import dask.array as da
 
+from tif_reader import read_section_tif
+
 
 def arg_parser():
     parser = argparse.ArgumentParser(description='tif images to ome-zarr format')
@@ -74,16 +76,9 @@ def readTifWrapper(i, zarr_file, file_name):
 
 def readTifSection( file_path):
     """
-    Read tif section image using SITK
+    Read tif section image through tifffile, which also decodes the tiled sections SITK misreads
     """
-    image = sitk.ReadImage(str(file_path))
-    image = sitk.GetArrayFromImage(image)
-    image[image<0] = 0
-    image = image.T
-    image = np.flip(image,axis=0)
-    image = np.flip(image,axis=1)
-    image  = np.squeeze(image)
-    return image
+    return read_section_tif(file_path)
 
 def main():
     try:
@@ -0,0 +1,95 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Tiled, compressed BigTIFF output for stitched sections. A section is written as 512x512 tiles with
+deflate or zstd compression, followed by reduced resolution copies of it in SubIFDs, each half the
+size of the previous one, so readers can decode a region or a low resolution level of the section
+without decoding the full plane.
+"""
+
+# Standard library imports
+import os
+
+# Third party imports
+import cv2
+import numpy as np
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+
+COMPRESSIONS = ('zlib', 'zstd')
+
+
+def get_level_shapes(shape: tuple, tile: tuple) -> list:
+    """Shapes of the resolution levels of an image, halving until a level fits in one tile.
+
+    Args:
+        shape (tuple): (rows, columns) of the full resolution image
+        tile (tuple): (rows, columns) of a tile
+
+    Returns:
+        list: (rows, columns) of every level, full resolution first
+    """
+    shapes = [tuple(shape)]
+    while shapes[-1][0] > tile[0] or shapes[-1][1] > tile[1]:
+        factor = 2 ** len(shapes)
+        shapes.append((max(int(round(shape[0] / float(factor))), 1), max(int(round(shape[1] / float(factor))), 1)))
+    return shapes
+
+
+def to_uint16(image: np.ndarray) -> np.ndarray:
+    """Clips an image to the uint16 range and casts it, without modifying the input array.
+
+    Args:
+        image (np.ndarray): Image array
+
+    Returns:
+        np.ndarray: uint16 image array
+    """
+    if image.dtype == np.uint16:
+        return image
+    return np.clip(image, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+
+class TiledTifWriter(object):
+
+    def __init__(self, tile=(512, 512), compression='zlib'):
+
+        if tifffile is None:
+            raise ImportError('tifffile is required to write tiled TIFF files')
+        if compression not in COMPRESSIONS:
+            raise ValueError('compression must be one of {0}'.format(COMPRESSIONS))
+        if compression == 'zstd' and imagecodecs is None:
+            raise ImportError('imagecodecs is required to write zstd compressed TIFF files')
+        self.tile = tuple(tile)
+        self.compression = compression
+
+
+    def write(self, image: np.ndarray, path: str):
+        """Writes a section with its reduced resolution levels. The file is written next to the output
+        path and moved in place, so readers never see a partial file.
+
+        Args:
+            image (np.ndarray): Section image array
+            path (str): Output file path
+        """
+        image = to_uint16(np.squeeze(image))
+        shapes = get_level_shapes(image.shape, self.tile)
+        options = dict(tile=self.tile, compression=self.compression)
+
+        with tifffile.TiffWriter(path + '.tmp', bigtiff=True) as tif:
+            tif.write(image, subifds=len(shapes) - 1, **options)
+            level = image
+            for shape in shapes[1:]:
+                # Every level is an area average of the previous one
+                level = cv2.resize(level, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+                tif.write(level, subfiletype=1, **options)
+        os.replace(path + '.tmp', path)
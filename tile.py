@@ -8,90 +8,89 @@ import logging
 import numpy as np
 
 
-class Tile(object):
+# Record of a tile position in a TileTable
+TILE_DTYPE = np.dtype([('index', np.int64), 
+                       ('row_start', np.int32), ('row_end', np.int32), 
+                       ('column_start', np.int32), ('column_end', np.int32), 
+                       ('margin_row', np.int32), ('margin_column', np.int32), 
+                       ('size_row', np.int32), ('size_column', np.int32), 
+                       ('missing', np.bool_)])
 
-    def __init__(self, index, image, is_missing, bounds, channel, size, margins, *args, **kwargs):
 
-        # identifier
-        self.index = index
+class TileTable(object):
+    '''Structure-of-arrays table of the tile positions of a section. Every position is a record of 
+    a structured array, and the channels of all positions are one flat array split by offsets, so 
+    the table pickles as three arrays.
+    '''
 
-        # actual image data
-        self.image = image
-        self.is_missing = is_missing
+    __slots__ = ('records', 'channels', 'offsets')
 
-        # parameters related to the position of the tile within a larger image
-        self.bounds = bounds
-        self.channel = channel
 
-        # parameters related to the valid portion of the tile
-        self.size = size
-        self.margins = margins
-        """
-        logging.info('tile {index} on channel {channel} starts at ({0}, {1})'.format(self.bounds['row']['start'], 
-                                                                                     self.bounds['column']['start'], 
-                                                                                     index=self.index, 
-                                                                                     channel=self.channel))
-        """
+    def __init__(self, records, channels, offsets):
 
+        self.records = records
+        self.channels = channels
+        self.offsets = offsets
 
-    def trim_self(self):
-        self.image = self.trim(self.image)
 
-    
-    def trim(self, image):
-        #logging.info('trimming with margins ({row}, {column})'.format(**self.margins))
+    @classmethod
+    def from_groups(cls, groups, planes=None):
+        '''Builds the table from the tile information of each position, as returned by 
+        group_tiles_by_position. The planes of a position default to the plane of each tile, 
+        or its zero-indexed channel.
+        '''
 
-        return image[self.margins['row']: self.margins['row'] + self.size['row'], 
-                     self.margins['column']: self.margins['column'] + self.size['column']]
+        records = np.zeros(len(groups), dtype=TILE_DTYPE)
+        channels = []
+        offsets = [0]
+        for i, group in enumerate(groups):
+            tile = group[0]
+            bounds = tile['bounds']
+            records[i] = (tile['index'], 
+                          bounds['row']['start'], bounds['row']['end'], 
+                          bounds['column']['start'], bounds['column']['end'], 
+                          tile['margins']['row'], tile['margins']['column'], 
+                          tile['size']['row'], tile['size']['column'], False)
+            if planes is None:
+                channels.extend(t.get('plane', t['channel'] - 1) for t in group)
+            else:
+                channels.extend(planes[i])
+            offsets.append(len(channels))
+        return cls(records, np.asarray(channels, dtype=np.int32), np.asarray(offsets, dtype=np.int64))
 
 
-    def average_tile_is_untrimmed(self, average_tile):
-        return average_tile.shape[0] > self.image.shape[0] \
-            or average_tile.shape[1] > self.image.shape[1]
+    def __len__(self):
+        return len(self.records)
 
 
-    def apply_average_tile(self, average_tile):
+    def get_channels(self, i):
+        return self.channels[self.offsets[i]:self.offsets[i + 1]]
 
-        if average_tile is None:
-            #logging.info('no average tile found for tile with index {index} on channel {channel}'.format(**self.__dict__))
-            return self.image
 
-        if self.average_tile_is_untrimmed(average_tile):
-            logging.info('trimming average tile')
-            average_tile = self.trim(average_tile)
+    def get_regions(self):
+        # slices of every position, converted from the columns at once
+        columns = [self.records[name].tolist() for name in ('row_start', 'row_end', 'column_start', 'column_end')]
+        return [(slice(r0, r1), slice(c0, c1)) for r0, r1, c0, c1 in zip(*columns)]
 
-        #logging.info('applying flatfield correction to tile with index {index} on channel {channel}'.format(**self.__dict__))
-        return np.multiply(self.image, average_tile)
 
-    
-    def apply_average_tile_to_self(self, average_tile):
-        self.image = self.apply_average_tile(average_tile)
+    def get_shape(self, i):
+        record = self.records[i]
+        return int(record['size_row']), int(record['size_column'])
 
 
-    def get_image_region(self):
-        
-        row = self.bounds['row']
-        col = self.bounds['column']
+    def trim(self, i, image):
+        record = self.records[i]
+        row, col = int(record['margin_row']), int(record['margin_column'])
+        return image[row: row + int(record['size_row']), col: col + int(record['size_column'])]
 
-        return [slice(int(row['start']), int(row['end'])), 
-                slice(int(col['start']), int(col['end'])), 
-                int(self.channel)]
 
+    def get_missing_path(self, i):
 
-    def get_missing_path(self):
-
-        row = self.bounds['row']
-        col = self.bounds['column']
-        
-        path = [row['start'], col['start'], 
-                row['end'], col['start'], 
-                row['end'], col['end'], 
-                row['start'], col['end']]
+        record = self.records[i]
+        path = [int(record['row_start']), int(record['column_start']), 
+                int(record['row_end']), int(record['column_start']), 
+                int(record['row_end']), int(record['column_end']), 
+                int(record['row_start']), int(record['column_end'])]
 
         logging.info('missing tile starts at: ({0}, {1})'.format(*path))
         return path
-
-
-    def initialize_image(self):
-        logging.info('initializing tile image to 0')
-        self.image = np.zeros((self.size['row'], self.size['column']))
@@ -0,0 +1,234 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Spill store for decoded tiles. Every tile is read once while generating the average tiles and
+again while stitching, so the first pass keeps the decoded pixels in a memory-mapped uint16
+scratch file per section and the second pass reads them back instead of hitting the acquisition
+storage again.
+"""
+
+# Standard library imports
+import os
+import json
+import shutil
+import logging
+import tempfile
+import threading
+
+# Third party imports
+import numpy as np
+
+
+TILE_SHAPE = (832, 832)
+
+
+def get_file_signature(path: str) -> list:
+    """Signature used to detect that a tile changed on disk since it was cached.
+
+    Args:
+        path (str): Tile file path
+
+    Returns:
+        list: Modification time (ns) and size of the file
+    """
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class SectionTileStore(object):
+
+    def __init__(self, directory, name, capacity, tile_shape=TILE_SHAPE, dtype=np.uint16):
+
+        self.data_path = os.path.join(directory, name + '.dat')
+        self.index_path = os.path.join(directory, name + '.json')
+        self.capacity = capacity
+        self.tile_shape = tuple(tile_shape)
+        self.dtype = np.dtype(dtype)
+
+        # opened lazily inside the worker process, reads may come from several threads
+        self._index = None
+        self._data = None
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    @property
+    def tile_nbytes(self):
+        return int(np.prod(self.tile_shape)) * self.dtype.itemsize
+
+
+    def _open(self):
+        if self._index is not None:
+            return
+
+        self._index = {'tiles': {}, 'hits': 0, 'misses': 0, 'bytes_saved': 0}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as fp:
+                self._index = json.load(fp)
+
+        mode = 'r+' if os.path.exists(self.data_path) else 'w+'
+        self._data = np.memmap(self.data_path, dtype=self.dtype, mode=mode,
+                               shape=(self.capacity,) + self.tile_shape)
+
+
+    def read(self, path: str, reader) -> np.ndarray:
+        """Reads a tile from the store, decoding it with reader and storing it on a miss.
+
+        Args:
+            path (str): Tile file path
+            reader (callable): Function decoding a tile file path into an array
+
+        Returns:
+            np.ndarray: Tile image array
+        """
+        signature = get_file_signature(path)
+        with self._lock:
+            self._open()
+            entry = self._index['tiles'].get(path)
+            if entry is not None and entry['signature'] == signature:
+                self._index['hits'] += 1
+                self._index['bytes_saved'] += self.tile_nbytes
+                return np.array(self._data[entry['slot']])
+
+        # decode outside the lock so several tiles can be read at once
+        im = reader(path)
+
+        with self._lock:
+            self._index['misses'] += 1
+            if im.shape == self.tile_shape and im.dtype == self.dtype:
+                slot = entry['slot'] if entry is not None else len(self._index['tiles'])
+                if slot < self.capacity:
+                    self._data[slot] = im
+                    self._index['tiles'][path] = {'slot': slot, 'signature': signature}
+        return im
+
+
+    def close(self):
+        if self._index is None:
+            return
+
+        self._data.flush()
+        with open(self.index_path, 'w') as fp:
+            json.dump(self._index, fp)
+        self._index = None
+        self._data = None
+
+
+class LayerTileStores(object):
+    """Spill stores of the layers of a merged section, each tile is read through the store of its layer.
+    """
+
+    def __init__(self, stores):
+
+        # store of each tile path
+        self.stores = stores
+
+
+    def read(self, path: str, reader) -> np.ndarray:
+        store = self.stores.get(path)
+        if store is None:
+            return reader(path)
+        return store.read(path, reader)
+
+
+    def close(self):
+        for store in {id(store): store for store in self.stores.values() if store is not None}.values():
+            store.close()
+
+
+class TileCache(object):
+
+    def __init__(self, cache_dir=None, max_bytes=None, tile_shape=TILE_SHAPE, dtype=np.uint16):
+
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix='tile_cache_')
+        elif not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+
+        # scratch space handed out to section stores so far, never more than half the free space
+        free_bytes = shutil.disk_usage(cache_dir).free // 2
+        self.max_bytes = free_bytes if max_bytes is None else min(max_bytes, free_bytes)
+        logging.info('Tile cache in {0} limited to {1:.1f} GB'.format(cache_dir, self.max_bytes / 1024.0**3))
+        self.reserved_bytes = 0
+
+        self.tile_shape = tuple(tile_shape)
+        self.dtype = dtype
+        self.stores = {}
+
+
+    def section_store(self, section_json: dict):
+        """Returns the spill store of a section, or None once the scratch budget is used up. A section merged 
+        from several layers reads through the stores of its layers.
+
+        Args:
+            section_json (dict): Section data
+
+        Returns:
+            SectionTileStore: Spill store for the tiles of the section
+        """
+        if 'layers' in section_json:
+            stores = {}
+            for layer in section_json['layers']:
+                store = self.section_store(layer)
+                stores.update({tile['path']: store for tile in layer['tiles']})
+            return LayerTileStores(stores)
+
+        name = section_json['slice_fname']
+        if name in self.stores:
+            return self.stores[name]
+
+        store = SectionTileStore(self.cache_dir, name, len(section_json['tiles']), self.tile_shape, self.dtype)
+        nbytes = store.capacity * store.tile_nbytes
+        if self.reserved_bytes + nbytes > self.max_bytes:
+            logging.info('Tile cache budget reached, not caching tiles of {0}'.format(name))
+            store = None
+        else:
+            self.reserved_bytes += nbytes
+
+        self.stores[name] = store
+        return store
+
+
+    def stats(self) -> dict:
+        """Aggregates the hit rate and bytes saved over every section store.
+
+        Returns:
+            dict: Cache counters
+        """
+        stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+        for store in self.stores.values():
+            if store is None or not os.path.exists(store.index_path):
+                continue
+            with open(store.index_path) as fp:
+                index = json.load(fp)
+            for key in stats:
+                stats[key] += index[key]
+
+        reads = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / reads if reads > 0 else 0.0
+        return stats
+
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info('Tile cache: {0} hits, {1} misses, hit rate {2:.1%}, {3:.1f} MB saved'.format(
+            stats['hits'], stats['misses'], stats['hit_rate'], stats['bytes_saved'] / 1024**2))
+
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.stores = {}
+        self.reserved_bytes = 0
@@ -0,0 +1,87 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Index of the tiles in a section directory. The directory is listed once and the tile index and
+channel are parsed from the file names (<sample>-<index>_<channel>.tif) instead of globbing every
+mosaic position. The index is persisted with the modification time of the directory, so re-runs
+and previews do not list the directory again until files are added or removed.
+"""
+
+# Standard library imports
+import os
+import re
+import json
+import logging
+
+
+TILE_NAME_PATTERN = re.compile(r'-(\d+)_(\d+)\.tif$')
+
+
+def scan_section_dir(section_dir: str) -> dict:
+    """Lists a section directory once and groups the tile files by index and channel.
+
+    Args:
+        section_dir (str): Section directory
+
+    Returns:
+        dict: File name of every channel of every tile index
+    """
+    tiles = {}
+    with os.scandir(section_dir) as entries:
+        for entry in entries:
+            match = TILE_NAME_PATTERN.search(entry.name)
+            if match is None:
+                continue
+            index, channel = int(match.group(1)), int(match.group(2))
+            tiles.setdefault(index, {})[channel] = entry.name
+    return tiles
+
+
+def get_tile_index_path(section_dir: str, index_dir: str) -> str:
+    return os.path.join(index_dir, os.path.basename(os.path.normpath(section_dir)) + '.json')
+
+
+def load_tile_index(section_dir: str, index_dir: str = None) -> dict:
+    """Loads the persisted tile index of a section directory, scanning the directory if the index is
+    missing or the directory changed since it was written.
+
+    Args:
+        section_dir (str): Section directory
+        index_dir (str, optional): Directory the index is persisted in. If None, the index is not persisted.
+                                   Defaults to None.
+
+    Returns:
+        dict: File name of every channel of every tile index
+    """
+    if not os.path.isdir(section_dir):
+        return {}
+    state = os.stat(section_dir).st_mtime_ns
+
+    index_path = None
+    if index_dir is not None:
+        index_path = get_tile_index_path(section_dir, index_dir)
+        try:
+            with open(index_path) as fp:
+                record = json.load(fp)
+            if record['directory'] == os.path.abspath(section_dir) and record['state'] == state:
+                return {int(index): {int(ch): name for ch, name in channels.items()}
+                        for index, channels in record['tiles'].items()}
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+
+    tiles = scan_section_dir(section_dir)
+
+    if index_path is not None:
+        # write then rename so concurrent readers never see a truncated index
+        record = {'directory': os.path.abspath(section_dir), 'state': state, 'tiles': tiles}
+        tmp_path = '{0}.{1}.tmp'.format(index_path, os.getpid())
+        try:
+            os.makedirs(index_dir, exist_ok=True)
+            with open(tmp_path, 'w') as fp:
+                json.dump(record, fp)
+            os.replace(tmp_path, index_path)
+        except (IOError, OSError) as err:
+            logging.warning('Could not save tile index {0}: {1}'.format(index_path, err))
+    return tiles
@@ -0,0 +1,61 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Producer/consumer pipeline for the tiles of a single section. Tiles are read and decoded in one
+thread pool and masked and deformation corrected in another, while the results are handed to the
+stitcher in placement order. The heavy steps run in OpenCV and scipy, which release the GIL, so a
+single section scales with the number of cores.
+"""
+
+# Standard library imports
+import os
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_tile_pipeline(items, read, process, n_readers: int = 4, n_workers: int = None, lookahead: int = None):
+    """Reads and processes items in thread pools and yields the results in the order of the items.
+
+    Args:
+        items (iterable): Items to process, e.g. the tile groups of a section
+        read (callable): I/O step, called as read(item)
+        process (callable): Compute step, called as process(item, read(item))
+        n_readers (int, optional): Threads reading items. Defaults to 4.
+        n_workers (int, optional): Threads processing items. Defaults to the number of CPUs.
+        lookahead (int, optional): Items in flight at once, which bounds memory. Defaults to twice the number of threads.
+
+    Yields:
+        Iterator: Processed items in order
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if lookahead is None:
+        lookahead = 2 * (n_readers + n_workers)
+
+    items = iter(items)
+    pending = collections.deque()
+    with ThreadPoolExecutor(n_readers) as readers, ThreadPoolExecutor(n_workers) as workers:
+
+        def submit(item):
+            # reads are queued in order, so a worker rarely waits on its read
+            data = readers.submit(read, item)
+            return workers.submit(lambda: process(item, data.result()))
+
+        try:
+            for item in items:
+                pending.append(submit(item))
+                if len(pending) >= lookahead:
+                    break
+
+            while pending:
+                result = pending.popleft().result()
+                for item in items:
+                    pending.append(submit(item))
+                    break
+                yield result
+        finally:
+            # stop early if the consumer goes away or a step fails
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,178 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Preflight check of the input tiles before stitching. Every section is validated against the
+Mosaic grid (rows x columns x layers x channels) from its tile index, and the TIFF header of every
+tile is checked for truncation without decoding the image. Problems are written to a report so gaps
+are found before hours of stitching instead of after.
+"""
+
+# Standard library imports
+import os
+import json
+import struct
+import logging
+
+# Third party imports
+from joblib import Parallel, delayed
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# Local imports
+from tile_index import load_tile_index
+
+
+TIFF_HEADERS = {b'II*\x00': ('<', False), b'MM\x00*': ('>', False),
+                b'II+\x00': ('<', True), b'MM\x00+': ('>', True)}
+
+
+def check_tile_file(path: str) -> str:
+    """Checks that a tile file is a complete TIFF file from its size and headers.
+
+    Args:
+        path (str): Tile file path
+
+    Returns:
+        str: 'ok', 'missing', 'empty', 'not_tiff', 'truncated' or 'unreadable'
+    """
+    try:
+        size = os.path.getsize(path)
+        if size == 0:
+            return 'empty'
+        with open(path, 'rb') as fp:
+            header = fp.read(16)
+    except FileNotFoundError:
+        return 'missing'
+    except OSError:
+        return 'unreadable'
+
+    if header[:4] not in TIFF_HEADERS:
+        return 'not_tiff'
+    byteorder, bigtiff = TIFF_HEADERS[header[:4]]
+    if len(header) < (16 if bigtiff else 8):
+        return 'truncated'
+    offset = struct.unpack(byteorder + 'Q', header[8:16])[0] if bigtiff else struct.unpack(byteorder + 'I', header[4:8])[0]
+    if offset >= size:
+        return 'truncated'
+
+    # The image data of the first page has to be inside the file
+    if tifffile is not None:
+        try:
+            with tifffile.TiffFile(path) as tif:
+                page = tif.pages[0]
+                end = max((o + n for o, n in zip(page.dataoffsets, page.databytecounts)), default=0)
+        except Exception:
+            return 'truncated'
+        if end > size:
+            return 'truncated'
+    return 'ok'
+
+
+def get_expected_tiles(sno: int, mosaic_data: dict, depth: int) -> list:
+    """Tile indices of a section layer in the Mosaic grid, numbered like create_section_json.
+
+    Args:
+        sno (int): Section index number
+        mosaic_data (dict): Mosaic data information
+        depth (int): Layer of the section
+
+    Returns:
+        list: Tile indices
+    """
+    ntiles = int(mosaic_data['mrows']) * int(mosaic_data['mcolumns'])
+    index_ = (sno * int(mosaic_data['layers']) + depth) * ntiles
+    return list(range(index_, index_ + ntiles))
+
+
+def get_section_problems(sno: int, section_dir: str, mosaic_data: dict, depth: int = 1,
+                         index_dir: str = None) -> tuple:
+    """Lists the tiles of a section missing from its tile index.
+
+    Args:
+        sno (int): Section index number
+        section_dir (str): Section directory
+        mosaic_data (dict): Mosaic data information
+        depth (int, optional): Number of layers stitched. Defaults to 1.
+        index_dir (str, optional): Directory the tile index is persisted in. Defaults to None.
+
+    Returns:
+        tuple: Problems found and the paths of the tiles present
+    """
+    tile_index = load_tile_index(section_dir, index_dir)
+    channels = range(1, int(mosaic_data['channels']) + 1)
+    problems = []
+    paths = []
+    for d in range(depth):
+        for index in get_expected_tiles(sno, mosaic_data, d):
+            names = tile_index.get(index, {})
+            for ch in channels:
+                entry = {'section': sno + 1, 'layer': d + 1, 'index': index, 'channel': ch}
+                if ch in names:
+                    paths.append((entry, os.path.join(section_dir, names[ch])))
+                else:
+                    entry.update({'path': None, 'status': 'missing'})
+                    problems.append(entry)
+    return problems, paths
+
+
+def run_preflight(section_dirs: dict, mosaic_data: dict, depth: int = 1, index_dir: str = None,
+                  n_threads: int = 16, expected_sections: list = None, sections: list = None) -> dict:
+    """Validates every section against the Mosaic grid and checks the headers of the tiles of the sections
+    about to be stitched.
+
+    Args:
+        section_dirs (dict): Directory of each section index number
+        mosaic_data (dict): Mosaic data information
+        depth (int, optional): Number of layers stitched. Defaults to 1.
+        index_dir (str, optional): Directory the tile indices are persisted in. Defaults to None.
+        n_threads (int, optional): Threads checking the tile files. Defaults to 16.
+        expected_sections (list, optional): Section index numbers that should exist. Defaults to the
+                                            sections in section_dirs.
+        sections (list, optional): Section index numbers whose tiles are checked, e.g. the sections pending
+                                   stitching. Defaults to every section in section_dirs.
+
+    Returns:
+        dict: Report with the number of tiles checked and every missing section and problem tile
+    """
+    section_dirs = {sno: section_dir for sno, section_dir in section_dirs.items() if os.path.isdir(section_dir)}
+    if expected_sections is None:
+        expected_sections = sorted(section_dirs)
+    missing_sections = [sno + 1 for sno in expected_sections if sno not in section_dirs]
+
+    checked = sorted(section_dirs) if sections is None else sorted(sno for sno in section_dirs if sno in set(sections))
+
+    problems = []
+    paths = []
+    for sno in checked:
+        section_problems, section_paths = get_section_problems(sno, section_dirs[sno], mosaic_data, depth, index_dir)
+        problems.extend(section_problems)
+        paths.extend(section_paths)
+
+    # Header reads are I/O bound, so the files are checked in threads
+    statuses = Parallel(n_jobs=n_threads, prefer='threads')(delayed(check_tile_file)(path) for _, path in paths)
+    for (entry, path), status in zip(paths, statuses):
+        if status != 'ok':
+            entry.update({'path': path, 'status': status})
+            problems.append(entry)
+
+    problems.sort(key=lambda entry: (entry['section'], entry['layer'], entry['index'], entry['channel']))
+    report = {'sections': len(section_dirs),
+              'sections_checked': len(checked),
+              'tiles_expected': len(expected_sections if sections is None else checked) * depth * len(get_expected_tiles(0, mosaic_data, 0)) *
+                                int(mosaic_data['channels']),
+              'tiles_checked': len(paths),
+              'missing_sections': missing_sections,
+              'problems': problems}
+    logging.info('Preflight: {0} of {1} tiles checked, {2} problems, {3} missing sections'.format(
+        len(paths), report['tiles_expected'], len(problems), len(missing_sections)))
+    return report
+
+
+def write_report(report: dict, path: str):
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(report, fp, indent=1)
+    os.replace(path + '.tmp', path)
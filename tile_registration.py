@@ -0,0 +1,276 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Refinement of the tile positions of a section. The nominal layout from create_section_json uses
+fixed stage offsets, which drift between acquisitions. The offset between every pair of
+neighbouring tiles is measured by cross-correlating their overlap, and the tile positions are
+solved for by weighted least squares, anchored to the nominal layout so tiles with empty or
+unreliable overlaps keep their nominal position.
+"""
+
+# Standard library imports
+import os
+import json
+import logging
+import itertools
+import collections
+
+# Third party imports
+import cv2
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+def get_tile_positions(tiles: list) -> dict:
+    """Nominal (row, column) start of every tile index.
+
+    Args:
+        tiles (list): Tile information
+
+    Returns:
+        dict: Position of each tile index
+    """
+    return {tile['index']: (tile['bounds']['row']['start'], tile['bounds']['column']['start']) for tile in tiles}
+
+
+def get_neighbour_pairs(positions: dict, shape: tuple, min_overlap: int = 8) -> list:
+    """Pairs of tiles sharing an edge in their nominal placements. Diagonal neighbours only share a
+    corner, too small to correlate.
+
+    Args:
+        positions (dict): Position of each tile index
+        shape (tuple): (rows, columns) of a tile
+        min_overlap (int, optional): Minimum overlap across the shared edge. Defaults to 8.
+
+    Returns:
+        list: Pairs of tile indices
+    """
+    # Overlapping tiles start less than a tile apart, so they fall in adjacent cells of a tile sized grid
+    cells = collections.defaultdict(list)
+    for index, (row, col) in positions.items():
+        cells[(row // shape[0], col // shape[1])].append(index)
+
+    pairs = []
+    for (cell_row, cell_col), indices in cells.items():
+        for a in indices:
+            for neighbour in itertools.product((cell_row - 1, cell_row, cell_row + 1), (cell_col - 1, cell_col, cell_col + 1)):
+                for b in cells.get(neighbour, ()):
+                    if b <= a:
+                        continue
+                    overlap = [n - abs(positions[b][axis] - positions[a][axis]) for axis, n in enumerate(shape)]
+                    if min(overlap) >= min_overlap and any(o >= n // 2 for o, n in zip(overlap, shape)):
+                        pairs.append((a, b))
+    return sorted(pairs)
+
+
+def get_overlap_windows(offset: tuple, shape: tuple, search: int) -> tuple:
+    """Windows matching the overlap of two tiles. The window of the first tile is its side of the
+    overlap, trimmed so it stays inside the window of the second tile, which extends the overlap by
+    the search range into the second tile.
+
+    Args:
+        offset (tuple): Nominal (row, column) offset of the second tile relative to the first
+        shape (tuple): (rows, columns) of a tile
+        search (int): Largest deviation from the nominal offset searched for in pixels
+
+    Returns:
+        tuple: Window slices in the first tile and in the second tile, or None if the overlap is too small
+    """
+    windows_a, windows_b = [], []
+    for d, n in zip(offset, shape):
+        lo, hi = max(d, 0), min(n, n + d)
+        search_lo, search_hi = max(lo - search, d), min(hi + search, d + n)
+        template_lo, template_hi = max(lo, search_lo + search), min(hi, search_hi - search)
+        if template_hi - template_lo < 1:
+            return None
+        windows_a.append(slice(template_lo, template_hi))
+        windows_b.append(slice(search_lo - d, search_hi - d))
+    return tuple(windows_a), tuple(windows_b)
+
+
+def estimate_pair_offset(window_a: np.ndarray, window_b: np.ndarray, offset: tuple, windows: tuple) -> tuple:
+    """Measures the offset of the second tile relative to the first by normalized cross-correlation
+    of their overlap windows.
+
+    Args:
+        window_a (np.ndarray): Window of the first tile
+        window_b (np.ndarray): Window of the second tile
+        offset (tuple): Nominal (row, column) offset of the second tile relative to the first
+        windows (tuple): Window slices returned by get_overlap_windows
+
+    Returns:
+        tuple: Measured (row, column) offset, None if the peak is on the edge of the search range,
+               and the correlation peak
+    """
+    if window_a.std() == 0 or window_b.std() == 0:
+        return None, 0.0
+    response = cv2.matchTemplate(window_b, window_a, cv2.TM_CCOEFF_NORMED)
+    _, peak, _, (x, y) = cv2.minMaxLoc(response)
+    # A peak on the edge may be outside the search range
+    for p, n in ((y, response.shape[0]), (x, response.shape[1])):
+        if n > 1 and p in (0, n - 1):
+            return None, peak
+
+    # The windows line up at the nominal offset when the match is where the first window was cut
+    windows_a, windows_b = windows
+    nominal = [wa.start - wb.start - d for wa, wb, d in zip(windows_a, windows_b, offset)]
+    return (offset[0] + nominal[0] - y, offset[1] + nominal[1] - x), peak
+
+
+def solve_layout(positions: dict, measurements: list, prior_weight: float = 1e-2) -> dict:
+    """Solves the tile positions best matching the measured pair offsets, anchored to the nominal positions.
+
+    Args:
+        positions (dict): Nominal position of each tile index
+        measurements (list): (a, b, (row, column) offset, weight) for every reliable pair
+        prior_weight (float, optional): Weight pulling every tile to its nominal position. Defaults to 1e-2.
+
+    Returns:
+        dict: Solved integer position of each tile index
+    """
+    indices = sorted(positions)
+    column = {index: i for i, index in enumerate(indices)}
+    n = len(indices)
+    m = len(measurements)
+
+    # One row per measured pair, weight * (b - a) = weight * offset, and one anchoring every tile to its 
+    # nominal position. The system has at most two nonzeros per row, so it is solved sparsely.
+    weights = np.asarray([weight for _, _, _, weight in measurements], dtype=np.float64)
+    pair_rows = np.repeat(np.arange(m), 2)
+    pair_columns = np.asarray([[column[a], column[b]] for a, b, _, _ in measurements], dtype=np.int64).reshape(-1)
+    pair_values = np.stack([-weights, weights], axis=1).reshape(-1)
+    matrix = scipy.sparse.csr_matrix((np.concatenate([pair_values, np.full(n, prior_weight)]), 
+                                      (np.concatenate([pair_rows, m + np.arange(n)]), 
+                                       np.concatenate([pair_columns, np.arange(n)]))), shape=(m + n, n))
+    offsets = np.asarray([offset for _, _, offset, _ in measurements], dtype=np.float64).reshape(m, 2)
+    nominal = np.asarray([positions[index] for index in indices], dtype=np.float64).reshape(n, 2)
+    targets = np.concatenate([offsets * weights[:, np.newaxis], nominal * prior_weight])
+
+    solution = np.stack([scipy.sparse.linalg.lsqr(matrix, targets[:, axis], atol=1e-12, btol=1e-12)[0] 
+                         for axis in range(2)], axis=1)
+    return {index: (int(round(solution[column[index], 0])), int(round(solution[column[index], 1])))
+            for index in indices}
+
+
+def register_tiles(tiles: list, images, search: int = 10, min_response: float = 0.5) -> dict:
+    """Refines the positions of the tiles of a section.
+
+    Args:
+        tiles (list): Tile information of the registration channel
+        images (iterable): Corrected image of each tile in the same order, None for tiles that could not be read
+        search (int, optional): Largest deviation from the nominal offset of a pair in pixels. Defaults to 10.
+        min_response (float, optional): Smallest accepted correlation peak. Defaults to 0.5.
+
+    Returns:
+        dict: Refined (row, column) position of each tile index
+    """
+    positions = get_tile_positions(tiles)
+    if len(tiles) == 0:
+        return positions
+    bounds = tiles[0]['bounds']
+    shape = (bounds['row']['end'] - bounds['row']['start'], bounds['column']['end'] - bounds['column']['start'])
+
+    # Only the overlap windows of every tile are kept, not the tiles
+    needed = {}
+    windows = {}
+    for a, b in get_neighbour_pairs(positions, shape):
+        offset = (positions[b][0] - positions[a][0], positions[b][1] - positions[a][1])
+        pair_windows = get_overlap_windows(offset, shape, search)
+        if pair_windows is None:
+            continue
+        windows[(a, b)] = pair_windows
+        needed.setdefault(a, []).append(((a, b), 0))
+        needed.setdefault(b, []).append(((a, b), 1))
+
+    crops = {}
+    for tile, image in zip(tiles, images):
+        if image is None or tile['index'] not in needed:
+            continue
+        for pair, side in needed[tile['index']]:
+            crops[(pair, side)] = np.asarray(image[windows[pair][side]], dtype=np.float32)
+
+    measurements = []
+    for a, b in windows:
+        if ((a, b), 0) not in crops or ((a, b), 1) not in crops:
+            continue
+        nominal = (positions[b][0] - positions[a][0], positions[b][1] - positions[a][1])
+        offset, response = estimate_pair_offset(crops[((a, b), 0)], crops[((a, b), 1)], nominal, windows[(a, b)])
+        if offset is None or response < min_response:
+            continue
+        measurements.append((a, b, offset, response))
+
+    logging.info('Registered {0} of {1} tile pairs'.format(len(measurements), len(windows)))
+    return solve_layout(positions, measurements)
+
+
+def apply_tile_positions(data: dict, positions: dict) -> dict:
+    """Copy of the section data with the tiles moved to the given positions. The tiles of every layer 
+    of a merged section are moved with the tile at their position in the first layer.
+
+    Args:
+        data (dict): Section data
+        positions (dict): (row, column) position of each tile index
+
+    Returns:
+        dict: Section data with the refined tile bounds
+    """
+    data = data.copy()
+    tiles = []
+    for tile in data['tiles']:
+        tile = tile.copy()
+        index = tile.get('position', tile['index'])
+        if index in positions:
+            row, col = positions[index]
+            rows = tile['bounds']['row']['end'] - tile['bounds']['row']['start']
+            cols = tile['bounds']['column']['end'] - tile['bounds']['column']['start']
+            # keep every tile inside the section image
+            row = min(max(row, 0), data['image_dimensions']['row'] - rows)
+            col = min(max(col, 0), data['image_dimensions']['column'] - cols)
+            tile['bounds'] = {'row': {'start': row, 'end': row + rows},
+                              'column': {'start': col, 'end': col + cols}}
+        tiles.append(tile)
+    data['tiles'] = tiles
+    return data
+
+
+class LayoutCache(object):
+
+    def __init__(self, output_dir):
+
+        self.layout_dir = os.path.join(output_dir, 'layout')
+        if not os.path.isdir(self.layout_dir):
+            os.makedirs(self.layout_dir)
+
+
+    def get_path(self, data: dict) -> str:
+        return os.path.join(self.layout_dir, data['slice_fname'] + '.json')
+
+
+    def load(self, data: dict, key: dict):
+        """Returns the cached tile positions of a section if they were solved from the same inputs.
+
+        Args:
+            data (dict): Section data
+            key (dict): Registration inputs and parameters
+
+        Returns:
+            dict: Position of each tile index, or None
+        """
+        try:
+            with open(self.get_path(data)) as fp:
+                record = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+        if record.get('key') != key:
+            return None
+        return {int(index): tuple(position) for index, position in record['positions'].items()}
+
+
+    def save(self, data: dict, key: dict, positions: dict):
+        path = self.get_path(data)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump({'key': key, 'positions': positions}, fp)
+        os.replace(path + '.tmp', path)
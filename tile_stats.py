@@ -0,0 +1,129 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Per-tile quality control statistics. The intensity percentiles, tissue mask coverage, saturation
+and focus of every tile are computed while the tile is in memory for stitching, and written to a
+columnar table per section that is merged into one table per run. Percentiles of integer tiles
+come from a single histogram pass instead of sorting the tile.
+"""
+
+# Standard library imports
+import os
+import glob
+import logging
+
+# Third party imports
+import cv2
+import numpy as np
+import pandas as pd
+
+
+PERCENTILES = (1, 5, 50, 95, 99)
+
+
+def get_percentiles(image: np.ndarray, q) -> np.ndarray:
+    """Percentiles of an image, equal to np.percentile with linear interpolation.
+
+    Args:
+        image (np.ndarray): Image array
+        q (array_like): Percentiles to compute, between 0 and 100
+
+    Returns:
+        np.ndarray: Percentile values
+    """
+    q = np.asarray(q, dtype=np.float64)
+    if image.dtype.kind != 'u' or image.dtype.itemsize > 2 or image.size == 0:
+        return np.percentile(image, q)
+
+    # Ranks of the sorted pixels are looked up in the cumulative histogram
+    counts = np.cumsum(np.bincount(image.ravel()))
+    position = q / 100 * (image.size - 1)
+    lower = np.floor(position)
+    values_lower = np.searchsorted(counts, lower, side='right')
+    values_upper = np.searchsorted(counts, np.ceil(position), side='right')
+    return values_lower + (values_upper - values_lower) * (position - lower)
+
+
+def get_median(image: np.ndarray) -> float:
+    return float(get_percentiles(image, [50])[0])
+
+
+def compute_tile_stats(image: np.ndarray, mask: np.ndarray = None, saturation: float = None) -> dict:
+    """Quality control statistics of a raw tile.
+
+    Args:
+        image (np.ndarray): Tile image array
+        mask (np.ndarray, optional): Tissue mask of the tile. Defaults to None.
+        saturation (float, optional): Saturated intensity. Defaults to the largest value of an integer dtype.
+
+    Returns:
+        dict: Mean, percentiles, mask coverage, saturation fraction and focus of the tile
+    """
+    if saturation is None:
+        saturation = np.iinfo(image.dtype).max if image.dtype.kind in 'ui' else np.inf
+
+    stats = {'mean': float(image.mean())}
+    for q, value in zip(PERCENTILES, get_percentiles(image, PERCENTILES)):
+        stats['p{0}'.format(q)] = float(value)
+    stats['median'] = stats['p50']
+    stats['mask_coverage'] = float(np.count_nonzero(mask)) / mask.size if mask is not None else np.nan
+    stats['saturation_fraction'] = float(np.count_nonzero(image >= saturation)) / image.size
+    # Variance of the Laplacian drops for out of focus tiles
+    stats['focus'] = float(cv2.Laplacian(image.astype(np.float32), cv2.CV_32F).var())
+    return stats
+
+
+def write_table(rows: list, path: str) -> str:
+    """Writes rows to a Parquet file, or to a CSV file next to it if no Parquet engine is installed.
+
+    Args:
+        rows (list): Dictionary for each row
+        path (str): Parquet file path
+
+    Returns:
+        str: Path written
+    """
+    table = pd.DataFrame(rows)
+    try:
+        table.to_parquet(path + '.tmp', index=False)
+    except ImportError:
+        logging.warning('No Parquet engine installed, writing {0} as CSV'.format(path))
+        path = os.path.splitext(path)[0] + '.csv'
+        table.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def read_table(path: str) -> pd.DataFrame:
+    if path.endswith('.csv'):
+        return pd.read_csv(path)
+    return pd.read_parquet(path)
+
+
+def get_stats_dir(output_dir: str) -> str:
+    return os.path.join(output_dir, 'tile_stats')
+
+
+def write_section_stats(rows: list, output_dir: str, slice_fname: str) -> str:
+    stats_dir = get_stats_dir(output_dir)
+    os.makedirs(stats_dir, exist_ok=True)
+    return write_table(rows, os.path.join(stats_dir, slice_fname + '.parquet'))
+
+
+def merge_tile_stats(output_dir: str) -> str:
+    """Merges the statistics of every section stitched into the output directory into one table.
+
+    Args:
+        output_dir (str): Output directory of the run
+
+    Returns:
+        str: Path of the merged table, or None if no section statistics were written
+    """
+    paths = sorted(glob.glob(os.path.join(get_stats_dir(output_dir), '*.parquet')) +
+                   glob.glob(os.path.join(get_stats_dir(output_dir), '*.csv')))
+    if len(paths) == 0:
+        return None
+    rows = pd.concat([read_table(path) for path in paths], ignore_index=True).to_dict('records')
+    return write_table(rows, os.path.join(output_dir, 'tile_stats.parquet'))
@@ -0,0 +1,136 @@
+"""
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+Code developed at UC Irvine.
+
+Tissue masks computed on a downsampled tile. The mask is a heavily blurred threshold, so it is
+smoothed, thresholded and filtered for specks and holes at a fraction of the resolution with
+OpenCV connected components, then upsampled back to the tile size.
+"""
+
+# Third party imports
+import cv2
+import numpy as np
+
+
+def get_gaussian_sigma(ksize: int) -> float:
+    """Sigma OpenCV uses for a Gaussian kernel of the given size when no sigma is provided.
+
+    Args:
+        ksize (int): Kernel size
+
+    Returns:
+        float: Gaussian sigma
+    """
+    return 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+
+
+def get_small_components(mask: np.ndarray, max_size: float, connectivity: int = 4) -> np.ndarray:
+    """Selects the connected components of a mask smaller than max_size.
+
+    Args:
+        mask (np.ndarray): Binary mask
+        max_size (float): Component area in pixels of the mask
+        connectivity (int, optional): 4 or 8 connectivity. Defaults to 4.
+
+    Returns:
+        np.ndarray: Binary mask of the small components
+    """
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=connectivity)
+    small = stats[:, cv2.CC_STAT_AREA] < max_size
+    # label 0 is the zero-valued region
+    small[0] = False
+    return small[labels]
+
+
+def threshold_tissue_mask(small: np.ndarray, thresh: int, sigma: float, min_area: float,
+                          hole_area: float) -> np.ndarray:
+    """Smooths and thresholds a downsampled 8-bit image, then removes small specks and fills small holes.
+
+    Args:
+        small (np.ndarray): Downsampled image scaled to 0-255
+        thresh (int): Threshold to determine which is tissue and which is background
+        sigma (float): Gaussian sigma at the downsampled resolution
+        min_area (float): The minimum size of a speck for it to not be removed, in downsampled pixels
+        hole_area (float): The minimum size of a hole for it not to be filled in, in downsampled pixels
+
+    Returns:
+        np.ndarray: Binary tissue mask at the downsampled resolution
+    """
+    small = cv2.GaussianBlur(small, (0, 0), sigma)
+    mask = small > thresh
+    mask = mask & ~get_small_components(mask, min_area)
+    mask = mask | get_small_components(~mask, hole_area)
+    return mask
+
+
+def generate_tissue_mask(im: np.ndarray, thresh: int = 15, gauss_kernel: int = 55,
+                         min_size: int = 64, area_threshold: int = 64, downsample: int = 4) -> np.ndarray:
+    """Generates the tissue mask of generate_mask on a downsampled image. Intensities are scaled
+    like preprocess, using the range of the full resolution image.
+
+    Args:
+        im (np.ndarray): Input image array
+        thresh (int, optional): Threshold to determine which is tissue and which is background. Defaults to 15.
+        gauss_kernel (int, optional): Size of the Gaussian kernel at full resolution. Defaults to 55.
+        min_size (int, optional): The minimum size of a speck for it to not be removed. Defaults to 64.
+        area_threshold (int, optional): The minimum size of a hole for it not to be filled in. Defaults to 64.
+        downsample (int, optional): Downsampling factor. Defaults to 4.
+
+    Returns:
+        np.ndarray: Binary tissue mask
+    """
+    y, x = im.shape
+    # Settings
+    min_size = max(min_size,
+                   int(max(y, x) * 0.20))
+    area_threshold = max(area_threshold,
+                         int(max(y, x) * 20))
+
+    # Clip and downsample, then stretch to 0-255 with the full resolution range
+    data = np.minimum(im, 400).astype(np.float32)
+    low, high = float(data.min()), float(data.max())
+    size = (max(int(round(x / downsample)), 1), max(int(round(y / downsample)), 1))
+    small = cv2.resize(data, size, interpolation=cv2.INTER_AREA)
+    scale = 255.0 / (high - low) if high > low else 0.0
+    small = np.clip(np.rint((small - low) * scale), 0, 255).astype(np.uint8)
+
+    # Smooth, threshold and filter at the lower resolution, with areas in full resolution pixels
+    pixel_area = (x / float(size[0])) * (y / float(size[1]))
+    mask = threshold_tissue_mask(small, thresh, get_gaussian_sigma(gauss_kernel) / downsample,
+                                 min_size / pixel_area, area_threshold / pixel_area)
+
+    # Upsample back to the image size
+    mask = cv2.resize(mask.astype(np.uint8) * 255, (x, y), interpolation=cv2.INTER_LINEAR)
+    return mask > 127
+
+
+def generate_downsampled_mask(small: np.ndarray, thresh: int = 15, gauss_kernel: int = 55,
+                              min_size: int = 64, area_threshold: int = 64, downsample: int = 4) -> np.ndarray:
+    """Generates the tissue mask of generate_mask for an image that is already downsampled, at its
+    resolution. Intensities are scaled like preprocess, using the range of the downsampled image.
+
+    Args:
+        small (np.ndarray): Image array downsampled from full resolution
+        thresh (int, optional): Threshold to determine which is tissue and which is background. Defaults to 15.
+        gauss_kernel (int, optional): Size of the Gaussian kernel at full resolution. Defaults to 55.
+        min_size (int, optional): The minimum size of a speck for it to not be removed. Defaults to 64.
+        area_threshold (int, optional): The minimum size of a hole for it not to be filled in. Defaults to 64.
+        downsample (int, optional): Downsampling factor of the image. Defaults to 4.
+
+    Returns:
+        np.ndarray: Binary tissue mask of the downsampled image
+    """
+    # Settings, from the size of the full resolution image
+    size = max(small.shape) * downsample
+    min_size = max(min_size, int(size * 0.20))
+    area_threshold = max(area_threshold, int(size * 20))
+
+    data = np.minimum(small, 400).astype(np.float32)
+    low, high = float(data.min()), float(data.max())
+    scale = 255.0 / (high - low) if high > low else 0.0
+    data = np.clip(np.rint((data - low) * scale), 0, 255).astype(np.uint8)
+
+    pixel_area = float(downsample) ** 2
+    return threshold_tissue_mask(data, thresh, get_gaussian_sigma(gauss_kernel) / downsample,
+                                 min_size / pixel_area, area_threshold / pixel_area)